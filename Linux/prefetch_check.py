@@ -0,0 +1,137 @@
+#!/usr/bin/python3
+# -*- coding: ascii -*-
+""" Checks the workshop mod prefetch of server.py against the stand-in steamcmd of the Utilities folder
+
+- Runs in a temporary home folder removed afterwards, so it does not touch the servers of the user
+- Verifies that the items reported by steamcmd are downloaded and the failed ones are not
+- Verifies that a hung steamcmd is killed along with its children holding the output open
+- Verifies that start waits for the prefetch started by create only until it finishes
+- Verifies that zombie and reused PIDs in the prefetch pid file are not waited for
+
+Exits with a non-zero code if any of the checks fail.
+
+"""
+import importlib
+import os
+import subprocess
+import sys
+from time import time, sleep
+
+import psutil
+
+LINUX_DIR = os.path.dirname(os.path.abspath(__file__))
+UTILITIES_DIR = os.path.join(os.path.dirname(LINUX_DIR), 'Utilities')
+FAKE_STEAMCMD = os.path.join(UTILITIES_DIR, 'fake_steamcmd.py')
+
+sys.path.insert(0, UTILITIES_DIR)
+from check_support import check, temporary_home
+
+NUMBER = 5
+MODS = ['1001', '1002']
+
+SANDBOX_SBC = '''<?xml version="1.0"?>
+<MyObjectBuilder_Checkpoint>
+<Mods>
+''' + ''.join(f'<ModItem FriendlyName="Mod {item_id}"><Name>{item_id}.sbm</Name><PublishedFileId>{item_id}</PublishedFileId></ModItem>\n' for item_id in MODS) + '''</Mods>
+</MyObjectBuilder_Checkpoint>
+'''
+
+
+def setup(home_dir: str):
+    os.environ['STEAMCMD'] = FAKE_STEAMCMD
+    os.environ.setdefault('USER', 'ds')
+    for name in ('.local', 'logs'):
+        os.makedirs(os.path.join(home_dir, name))
+
+    items_dir = os.path.join(home_dir, 'items')
+    os.environ['FAKE_STEAMCMD_ITEMS'] = items_dir
+    for item_id in MODS:
+        os.makedirs(os.path.join(items_dir, item_id, 'Data'))
+        with open(os.path.join(items_dir, item_id, 'Data', 'Mod.sbc'), 'wt') as f:
+            f.write(f'<Definitions>{item_id}</Definitions>')
+
+    sys.path.insert(0, LINUX_DIR)
+    return importlib.import_module('server')
+
+
+def check_download(server) -> bool:
+    os.environ['FAKE_STEAMCMD_FAIL'] = MODS[1]
+    try:
+        downloaded = server.download_workshop_items(MODS, 30)
+    finally:
+        del os.environ['FAKE_STEAMCMD_FAIL']
+    return check('download', sorted(downloaded) == MODS[:1] and os.path.isdir(downloaded.get(MODS[0], '')), str(downloaded))
+
+
+def check_hung_steamcmd(server) -> bool:
+    os.environ['FAKE_STEAMCMD_HANG'] = '1'
+    started = time()
+    try:
+        downloaded = server.download_workshop_items(MODS, 2)
+    finally:
+        del os.environ['FAKE_STEAMCMD_HANG']
+    duration = time() - started
+    return check('hung steamcmd', not downloaded and duration < 10, f'killed after {duration:.1f}s')
+
+
+def create_world(server):
+    instance = server.Server(NUMBER)
+    os.makedirs(instance.world_dir)
+    with open(os.path.join(instance.world_dir, 'Sandbox.sbc'), 'wt') as f:
+        f.write(SANDBOX_SBC)
+    os.makedirs(server.mod_view_dir(NUMBER))
+    return instance
+
+
+def check_prefetch(server) -> bool:
+    instance = create_world(server)
+    started = time()
+    instance.start_mod_prefetch()
+    instance.wait_for_mod_prefetch()
+    duration = time() - started
+
+    view = sorted(os.listdir(server.mod_view_dir(NUMBER)))
+    passed = check('prefetch in the same process', duration < 30 and view == MODS, f'waited {duration:.1f}s, view {view}')
+    passed = check('prefetch pid file removed', not os.path.exists(instance.mod_prefetch_pid_path)) and passed
+    return passed
+
+
+def check_stale_pids(server) -> bool:
+    instance = server.Server(NUMBER)
+
+    # An exited prefetch not reaped by its parent yet
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    while psutil.Process(process.pid).status() != psutil.STATUS_ZOMBIE:
+        sleep(0.05)
+    with open(instance.mod_prefetch_pid_path, 'wt') as f:
+        f.write(str(process.pid))
+    passed = check('zombie prefetch', instance.mod_prefetch_pid is None)
+    process.wait()
+
+    # PID reused by an unrelated process
+    process = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(60)'])
+    with open(instance.mod_prefetch_pid_path, 'wt') as f:
+        f.write(str(process.pid))
+    passed = check('reused prefetch pid', instance.mod_prefetch_pid is None) and passed
+    process.kill()
+    process.wait()
+
+    return passed
+
+
+def main():
+    with temporary_home('prefetch_check.') as home_dir:
+        server = setup(home_dir)
+        server.MOD_PREFETCH_TIMEOUT = 60.0
+        print(f'Home folder: {home_dir}')
+
+        passed = check_download(server)
+        passed = check_hung_steamcmd(server) and passed
+        passed = check_prefetch(server) and passed
+        passed = check_stale_pids(server) and passed
+
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -98,14 +98,14 @@ if ! [[ -f ~/.ssh/id_rsa ]]; then
     /usr/bin/ssh-keygen -q -t rsa -N "" -f ~/.ssh/id_rsa
 fi
 
-if ! [[ -e /usr/bin/gpg-agent ]] || ! [[ -e /usr/games/steamcmd ]] || ! [[ -e /usr/bin/xvfb-run ]] || ! [[ -e /usr/sbin/ufw ]]; then
+if ! [[ -e /usr/bin/gpg-agent ]] || ! [[ -e /usr/games/steamcmd ]] || ! [[ -e /usr/bin/xvfb-run ]] || ! [[ -e /usr/bin/zstd ]] || ! [[ -e /usr/sbin/ufw ]]; then
     echo
     echo "Installing Debian package dependencies"
     echo
     echo 'debconf steam/question select I AGREE' | debconf-set-selections
     echo 'debconf steam/license note' | debconf-set-selections
     echo 'debconf steam/purge note' | debconf-set-selections
-    withRetry apt-get -y install gnupg2 steamcmd xauth xvfb psmisc mc rsync ntp ufw cpufrequtils python3 python3-psutil python3-argcomplete python3-defusedxml python3-filelock
+    withRetry apt-get -y install gnupg2 steamcmd xauth xvfb psmisc mc rsync zstd ntp ufw cpufrequtils python3 python3-psutil python3-argcomplete python3-defusedxml python3-filelock
 fi
 
 if ! [[ -e /etc/bash_completion.d/python-argcomplete.sh ]]; then
@@ -7,6 +7,9 @@ Requires Python 3.7
 
 Requires Python packages:
 - psutil
+- filelock
+- argcomplete
+- defusedxml
 
 Clones a reference Wine dedicated server setup,
 configures and starts a Torch server.
@@ -58,7 +61,10 @@ Torch.cfg
 
 """
 import argparse
+import fcntl
+import functools
 import hashlib
+import io
 import subprocess
 import traceback
 import argcomplete
@@ -71,14 +77,19 @@ import shutil
 import signal
 import socket
 import string
+import struct
 import sys
+import threading
 import uuid
 import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from time import time, sleep
-from typing import Optional, List
+from typing import Optional, List, Dict, Callable, Iterable, Tuple
 
 import filelock
 import psutil
+from defusedxml.ElementTree import iterparse, fromstring, ParseError
 
 ENVIRONMENT = os.getenv('ENVIRONMENT', 'dev')
 assert ENVIRONMENT in ('dev', 'test', 'prod')
@@ -89,13 +100,38 @@ HOME_DIR = os.path.expanduser('~')
 WORLD_ZIP_DIR = os.path.expanduser('~/')
 PLUGINS_DIR = os.path.expanduser('~/plugins')
 ARCHIVE_DIR = os.path.expanduser('~/archive')
+ARCHIVE_STAGING_DIR = os.path.join(ARCHIVE_DIR, '.staging')
+ARCHIVE_OBJECTS_DIR = os.path.join(ARCHIVE_DIR, 'objects')
+ARCHIVE_MANIFESTS_DIR = os.path.join(ARCHIVE_DIR, 'manifests')
+ARCHIVE_INDEX_PATH = os.path.join(ARCHIVE_DIR, 'index.json')
 TEMPLATE_WINE_DIR = os.path.expanduser('~/.wine00')
 TEMPLATE_SERVER_DIR = os.path.expanduser('~/ds00')
 ASTEROIDS_DIR = os.path.expanduser('~/asteroids')
-CACHE_DIR_TEMPLATE = '~/.cache/ds%02d'
+SLOTS_CONFIG_PATH = os.path.expanduser('~/.config/torch-hosting/slots.json')
 BINARY_CACHE_DIR = os.path.expanduser('~/.cache/binary_cache')
+ASTEROID_LIST_CACHE_DIR = os.path.expanduser('~/.cache/asteroid_lists')
+PLUGIN_CACHE_DIR = os.path.expanduser('~/.cache/plugins')
+MOD_STORE_DIR = os.path.expanduser('~/.cache/mods')
+MOD_DOWNLOAD_DIR = os.path.expanduser('~/.cache/mod_downloads')
+WORLD_FACTS_CACHE_DIR = os.path.expanduser('~/.cache/world_facts')
+PLUGIN_CATALOG_PATH = os.path.join(PLUGIN_CACHE_DIR, 'catalog.json')
+WORLD_STAGING_DIR = f'/dev/shm/{USER_NAME}-worlds'
+
+STEAM_SPACE_ENGINEERS_APP_ID = '244850'
 
 SHA1SUM = '/usr/bin/sha1sum'
+STEAMCMD = os.getenv('STEAMCMD', '/usr/games/steamcmd')
+ZSTD = '/usr/bin/zstd'
+XVFB = '/usr/bin/Xvfb'
+
+XVFB_POOL_SIZE = 4
+# Each user of the host gets its own range of displays
+XVFB_DISPLAY_OFFSET = 100 + (os.getuid() % 1000) * XVFB_POOL_SIZE
+XVFB_SCREEN = '1024x768x24'
+XVFB_STARTUP_TIMEOUT = 10.0
+X11_SOCKET_TEMPLATE = '/tmp/.X11-unix/X%d'
+X11_LOCK_TEMPLATE = '/tmp/.X%d-lock'
+XAUTH_FAMILY_WILD = 0xffff
 
 CLONE_SKIP_EXTENSIONS = set('log cache hash sbcB5 sbsB5'.split())
 
@@ -105,9 +141,102 @@ CLONE_SAFE_TO_LINK_EXTENSIONS = set((
                                         'hkt mwl vx2 hash nlp h rtf pdf old sql nls vxd xsd master mof tlb rsp man msu cs mod ' +
                                         'ascx brain').split())
 
+# Paths of the template configured per instance by create, upgrade must not overwrite them
+UPGRADE_SKIP_PATHS = {'Torch.cfg', 'Instance'}
+UPGRADE_PARALLELISM = 4
+BULK_PARALLELISM = 8
+CREATE_PARALLELISM = 4
+
+# Fields of world.json used by create with their expected types
+WORLD_JSON_FIELDS = dict(name=str, maxPlayers=int, plugins=list)
+# Errors of reading or parsing a member of a world ZIP, defusedxml raises ValueError subclasses for entities
+WORLD_MEMBER_ERRORS = (ParseError, ValueError, zipfile.BadZipFile, zlib.error, EOFError)
+
+WORLD_FILES = ('Sandbox.sbc', 'Sandbox_config.sbc', 'SANDBOX_0_0_0_.sbs')
+
 RX_REGISTRY_STRING = re.compile(r'^"(\w+)"=".*?"$')
 RX_GUID_ELEMENT = re.compile(r'<Guid>(.*?)</Guid>')
-RX_ASTEROID = re.compile(r'<StorageName>(.*?Asteroid.*?)</StorageName>')
+RX_VERSION_ELEMENT = re.compile(r'<Version>(.*?)</Version>')
+RX_MODS_ELEMENT = re.compile(rb'<Mods>(.*?)</Mods>', re.DOTALL)
+RX_PUBLISHED_FILE_ID = re.compile(rb'<PublishedFileId>(\d+)</PublishedFileId>')
+RX_STEAMCMD_DOWNLOADED = re.compile(r'Success\. Downloaded item (\d+) to "(.*?)"')
+RX_ASTEROID = re.compile(rb'<StorageName>([^<]*?Asteroid[^<]*?)</StorageName>')
+RX_NUMBER_PLACEHOLDER = re.compile(r'%0?\d*d')
+RX_STAGED_ARCHIVE = re.compile(r'^(.+?)_(\d{8}-\d{6}_.+)$')
+
+# Large buffers for scanning the world files, the overlap keeps elements cut at buffer boundaries
+SCAN_BUFFER_SIZE = 4 * 1024 ** 2
+SCAN_OVERLAP = 1024
+
+# Linux ioctl to clone the extents of a file (copy-on-write) on btrfs and XFS
+FICLONE = 0x40049409
+
+# Hard links are shared with the asteroid store, so the game could modify the store if it saved
+# voxel files in place. Enable it only if the file system of the home folder does not support reflinks.
+ASTEROID_HARDLINKS = False
+
+# Server slots, can be overridden by SLOTS_CONFIG_PATH (JSON with the same keys in lower case).
+# The game and admin ports of each range are the ports of its first server number.
+SLOTS = dict(
+    ranges=[dict(first=1, last=99, game_port=27001, admin_port=9001)],
+    server_dir_pattern='~/ds%02d',
+    wine_dir_pattern='~/.wine%02d',
+    cache_dir_pattern='~/.cache/ds%02d',
+)
+SLOT_RANGE_KEYS = ('first', 'last', 'game_port', 'admin_port')
+
+
+def validate_slots(config: dict):
+    """Raises ValueError if the slot configuration is invalid or its numbers or ports overlap"""
+    if not isinstance(config, dict):
+        raise ValueError(f'{SLOTS_CONFIG_PATH} must contain a JSON object')
+    unknown = set(config) - set(SLOTS)
+    if unknown:
+        raise ValueError(f'Unknown keys in {SLOTS_CONFIG_PATH}: {", ".join(sorted(unknown))}')
+    slots = dict(SLOTS, **config)
+
+    for key in ('server_dir_pattern', 'wine_dir_pattern', 'cache_dir_pattern'):
+        pattern = slots[key]
+        if not isinstance(pattern, str) or len(RX_NUMBER_PLACEHOLDER.findall(os.path.basename(pattern))) != 1 or pattern.count('%') != 1:
+            raise ValueError(f'{key} in {SLOTS_CONFIG_PATH} must have a single number placeholder like %02d in its last path component: {pattern!r}')
+
+    ranges = slots['ranges']
+    if not isinstance(ranges, list) or not ranges:
+        raise ValueError(f'ranges in {SLOTS_CONFIG_PATH} must be a non-empty list')
+
+    numbers = []
+    ports = []
+    for slot_range in ranges:
+        if not isinstance(slot_range, dict) or sorted(slot_range) != sorted(SLOT_RANGE_KEYS) or not all(
+                isinstance(slot_range[key], int) and not isinstance(slot_range[key], bool) for key in SLOT_RANGE_KEYS):
+            raise ValueError(f'Slot ranges in {SLOTS_CONFIG_PATH} must have the integer keys {", ".join(SLOT_RANGE_KEYS)}: {slot_range!r}')
+        first, last = slot_range['first'], slot_range['last']
+        if not 0 < first <= last:
+            raise ValueError(f'Invalid slot range in {SLOTS_CONFIG_PATH}: {first}-{last}')
+        numbers.append((first, last, f'servers {first}-{last}'))
+        for key in ('game_port', 'admin_port'):
+            port = slot_range[key]
+            if not 0 < port <= port + last - first <= 65535:
+                raise ValueError(f'Invalid {key} of slot range {first}-{last} in {SLOTS_CONFIG_PATH}: {port}')
+            ports.append((port, port + last - first, f'{key} of servers {first}-{last}'))
+
+    for intervals in (numbers, ports):
+        intervals.sort()
+        for (_, previous_last, previous), (first, _, current) in zip(intervals, intervals[1:]):
+            if first <= previous_last:
+                raise ValueError(f'Overlapping slot configuration in {SLOTS_CONFIG_PATH}: {previous} and {current}')
+
+
+if os.path.exists(SLOTS_CONFIG_PATH):
+    with open(SLOTS_CONFIG_PATH, 'rt', encoding='utf8') as _f:
+        _config = json.load(_f)
+    validate_slots(_config)
+    SLOTS.update(_config)
+
+SLOT_RANGES = SLOTS['ranges']
+SERVER_DIR_PATTERN = SLOTS['server_dir_pattern']
+WINE_DIR_PATTERN = SLOTS['wine_dir_pattern']
+CACHE_DIR_TEMPLATE = SLOTS['cache_dir_pattern']
 
 FREE = 'FREE'
 STOPPED = 'STOPPED'
@@ -118,6 +247,20 @@ FAILED = 'FAILED'
 CANARY_TIMEOUT = 3 * 60.0
 MAX_STARTUP_TIME = 8 * 60.0
 WAIT_AFTER_KEEPALIVE_ACTION = 30.0
+MOD_PREFETCH_TIMEOUT = 15 * 60.0
+# Workshop items modified more recently may still be downloaded by the game, they are ingested later
+MOD_INGEST_SETTLE_TIME = 60.0
+
+# Free space required on the staging file system relative to the world size (autosave keeps backups)
+WORLD_STAGING_HEADROOM = 3.0
+# Files modified more recently are considered to be still written by an autosave in progress
+WORLD_SYNC_SETTLE_TIME = 5.0
+# World files loaded by the game last, they are written back to the disk only after all the others
+WORLD_SYNC_LAST_FILES = ('Sandbox_config.sbc', 'Sandbox.sbc')
+
+# Retention policy of the archive store enforced by the prune command
+ARCHIVE_KEEP_LAST = 10
+ARCHIVE_KEEP_DAILY_DAYS = 30
 
 LOW_PRIORITY = 10
 NORMAL_PRIORITY = 0
@@ -141,8 +284,756 @@ def timestamp_for_filename() -> str:
     return datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
 
 
+def server_dir_name(number: int) -> str:
+    """Name of the server folder, also used for the per-server files outside of it"""
+    return os.path.basename(os.path.expanduser(SERVER_DIR_PATTERN % number))
+
+
 def get_file_lock_path(number: int) -> str:
-    return os.path.expanduser(f'~/.local/server-{number}.lock')
+    return os.path.expanduser(f'~/.local/server-{server_dir_name(number)}.lock')
+
+
+def get_allocation_lock_path() -> str:
+    return os.path.expanduser('~/.local/allocate.lock')
+
+
+def find_slot_range(number: int) -> Optional[dict]:
+    for slot_range in SLOT_RANGES:
+        if slot_range['first'] <= number <= slot_range['last']:
+            return slot_range
+    return None
+
+
+def is_valid_number(number: int) -> bool:
+    return find_slot_range(number) is not None
+
+
+def scan_numbers(pattern: str) -> List[int]:
+    """Numbers of the existing folders named by a pattern like ~/ds%02d in a single directory listing"""
+    path = os.path.expanduser(pattern)
+    parent = os.path.dirname(path)
+    basename = os.path.basename(path)
+    placeholder = RX_NUMBER_PLACEHOLDER.search(basename)
+    rx = re.compile('^' + re.escape(basename[:placeholder.start()]) + r'(\d+)' + re.escape(basename[placeholder.end():]) + '$')
+    try:
+        names = os.listdir(parent)
+    except (IOError, OSError):
+        return []
+    numbers = set()
+    for name in names:
+        m = rx.match(name)
+        if m is not None and os.path.isdir(os.path.join(parent, name)):
+            number = int(m.group(1))
+            # Zero padding must match as well, ds5 is not the folder of server 5 with ds%02d
+            if is_valid_number(number) and name == basename % number:
+                numbers.add(number)
+    return sorted(numbers)
+
+
+def allocated_numbers() -> List[int]:
+    return scan_numbers(SERVER_DIR_PATTERN)
+
+
+def port_in_use(port: int, kind: int) -> bool:
+    with socket.socket(socket.AF_INET, kind) as s:
+        try:
+            s.bind(('0.0.0.0', port))
+        except (IOError, OSError):
+            return True
+    return False
+
+
+def allocate_slot() -> int:
+    """Returns the first free server number with no folders and no processes listening on its ports"""
+    allocated = set(allocated_numbers()) | set(scan_numbers(WINE_DIR_PATTERN))
+    for slot_range in SLOT_RANGES:
+        for number in range(slot_range['first'], slot_range['last'] + 1):
+            if number in allocated:
+                continue
+            server = Server(number)
+            if port_in_use(server.port, socket.SOCK_DGRAM) or port_in_use(server.admin_port, socket.SOCK_STREAM):
+                continue
+            return number
+    raise ValueError('No free server slot')
+
+
+def command_allocate() -> int:
+    print(allocate_slot())
+    return 0
+
+
+def run_pipeline(steps: Dict[str, Tuple[Callable[[], None], List[str]]], workers: int) -> Dict[str, Tuple[float, float]]:
+    """Runs the steps of a dependency graph in parallel as soon as their dependencies have finished
+
+    Steps are given by name as a tuple of the function to call and the names of the steps it depends on.
+    Returns the start time relative to the start of the pipeline and the duration of each step.
+    The first failure stops scheduling new steps, it is raised after the running ones have finished.
+
+    """
+    for name, (function, dependencies) in steps.items():
+        for dependency in dependencies:
+            if dependency not in steps:
+                raise ValueError(f'Step {name} depends on unknown step {dependency}')
+
+    started = time()
+    timings = {}
+
+    def run_step(name: str):
+        step_started = time()
+        steps[name][0]()
+        timings[name] = (step_started - started, time() - step_started)
+
+    done = set()
+    running = {}
+    failure = None
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while 1:
+            if failure is None:
+                for name, (function, dependencies) in steps.items():
+                    if name not in done and name not in running.values() and all(d in done for d in dependencies):
+                        running[executor.submit(run_step, name)] = name
+
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                if future.exception() is not None:
+                    failure = failure or future.exception()
+                else:
+                    done.add(name)
+
+    if failure is not None:
+        raise failure
+
+    if len(done) < len(steps):
+        raise ValueError(f'Dependency cycle between steps: {", ".join(sorted(set(steps) - done))}')
+
+    return timings
+
+
+def scan_file(path: str, rx) -> List[str]:
+    """Streams a large file in big binary buffers and returns the first group of all matches of a bytes regex"""
+    found = []
+    tail = b''
+    with open(path, 'rb') as f:
+        while 1:
+            data = f.read(SCAN_BUFFER_SIZE)
+            if not data:
+                break
+            buffer = tail + data
+            end = 0
+            for m in rx.finditer(buffer):
+                found.append(m.group(1).decode('utf8'))
+                end = m.end()
+            tail = buffer[max(end, len(buffer) - SCAN_OVERLAP):]
+    return found
+
+
+def reflink(src_path: str, dst_path: str) -> bool:
+    """Copy-on-write clone of a file, returns False if the file system does not support it"""
+    with open(src_path, 'rb') as sf:
+        with open(dst_path, 'wb') as tf:
+            try:
+                fcntl.ioctl(tf.fileno(), FICLONE, sf.fileno())
+            except (IOError, OSError):
+                pass
+            else:
+                return True
+    os.remove(dst_path)
+    return False
+
+
+def materialize_file(src_path: str, dst_path: str):
+    """Places a file from a shared store, so modifications of the copy never touch the store"""
+    if reflink(src_path, dst_path):
+        return
+
+    if ASTEROID_HARDLINKS:
+        os.link(src_path, dst_path)
+        return
+
+    shutil.copy(src_path, dst_path)
+
+
+def link_tree(src, dst):
+    """Hard links a read-only tree from a cache, files which may be modified are copied like clone does"""
+    for srcdir, dirnames, filenames in os.walk(src):
+        reldir = srcdir[len(src) + 1:]
+        dstdir = os.path.join(dst, reldir) if reldir else dst
+        os.makedirs(dstdir, exist_ok=True)
+        for filename in filenames:
+            srcpath = os.path.join(srcdir, filename)
+            dstpath = os.path.join(dstdir, filename)
+            if os.path.splitext(filename)[1][1:].lower() in CLONE_SAFE_TO_LINK_EXTENSIONS:
+                os.link(srcpath, dstpath)
+            else:
+                shutil.copy(srcpath, dstpath)
+
+
+def read_plugin_manifest(manifest_path: str) -> Tuple[str, str]:
+    """Returns the GUID and version of a Torch plugin from its manifest.xml"""
+    with open(manifest_path, 'rt') as f:
+        manifest = f.read()
+
+    m = RX_GUID_ELEMENT.search(manifest)
+    if m is None:
+        raise ValueError(f'No <Guid> found in {manifest_path}')
+    guid_ = m.group(1)
+
+    m = RX_VERSION_ELEMENT.search(manifest)
+    version = '' if m is None else m.group(1)
+
+    return guid_, version
+
+
+def load_plugin_catalog() -> Dict[str, dict]:
+    try:
+        with open(PLUGIN_CATALOG_PATH, 'rt', encoding='utf8') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def catalog_plugin(name: str) -> dict:
+    """Returns the catalog entry of a plugin ZIP, extracts it into the cache once per content hash
+
+    The entry is invalidated if the size or modification time of the ZIP changes. The ZIP
+    is extracted again only if its content hash changed as well.
+
+    """
+    zip_path = os.path.join(PLUGINS_DIR, name + '.zip')
+    os.makedirs(PLUGIN_CACHE_DIR, exist_ok=True)
+    with filelock.FileLock(PLUGIN_CATALOG_PATH + '.lock'):
+        catalog = load_plugin_catalog()
+        entry = catalog.get(name)
+
+        st = os.stat(zip_path)
+        if entry is not None and entry['zip_size'] == st.st_size and entry['zip_mtime_ns'] == st.st_mtime_ns:
+            return entry
+
+        digest = hash_file(zip_path)
+        extracted_dir = os.path.join(PLUGIN_CACHE_DIR, digest)
+        if not os.path.isdir(extracted_dir):
+            tmp_dir = extracted_dir + '.tmp'
+            if os.path.isdir(tmp_dir):
+                shutil.rmtree(tmp_dir)
+            unzip(tmp_dir, zip_path)
+            os.rename(tmp_dir, extracted_dir)
+
+        manifest_path = os.path.join(extracted_dir, 'manifest.xml')
+        guid_, version = read_plugin_manifest(manifest_path) if os.path.exists(manifest_path) else (None, '')
+
+        entry = dict(zip_size=st.st_size, zip_mtime_ns=st.st_mtime_ns, sha256=digest, guid=guid_, version=version)
+        catalog[name] = entry
+        write_json_atomically(PLUGIN_CATALOG_PATH, catalog)
+
+    return entry
+
+
+def command_plugins() -> int:
+    """Refreshes the plugin catalog from the plugin ZIPs, removes unused extracted plugins from the cache"""
+    names = sorted(fn[:-len('.zip')] for fn in os.listdir(PLUGINS_DIR) if fn.endswith('.zip'))
+    entries = {name: catalog_plugin(name) for name in names}
+
+    with filelock.FileLock(PLUGIN_CATALOG_PATH + '.lock'):
+        catalog = load_plugin_catalog()
+        for name in set(catalog) - set(names):
+            del catalog[name]
+        write_json_atomically(PLUGIN_CATALOG_PATH, catalog)
+
+        used = set(entry['sha256'] for entry in catalog.values())
+        for fn in os.listdir(PLUGIN_CACHE_DIR):
+            path = os.path.join(PLUGIN_CACHE_DIR, fn)
+            if os.path.isdir(path) and fn not in used:
+                shutil.rmtree(path)
+
+    for name, entry in entries.items():
+        print(f'{name} {entry["version"] or "-"} {entry["guid"] or "-"} {entry["sha256"][:12]}')
+
+    return 0
+
+
+def list_tree_files(path: str) -> List[str]:
+    relpaths = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        reldir = dirpath[len(path) + 1:]
+        relpaths.extend(os.path.join(reldir, fn) for fn in filenames)
+    return sorted(relpaths)
+
+
+def hash_tree(path: str, relpaths: List[str]) -> str:
+    sha256 = hashlib.sha256()
+    for relpath in relpaths:
+        sha256.update(f'{relpath}\0{hash_file(os.path.join(path, relpath))}\0'.encode('utf8'))
+    return sha256.hexdigest()
+
+
+def replace_with_link(src_path: str, dst_path: str):
+    tmp_path = dst_path + '.link'
+    os.link(src_path, tmp_path)
+    os.replace(tmp_path, dst_path)
+
+
+def tree_stats(path: str, relpaths: List[str]) -> Dict[str, List[int]]:
+    stats = {}
+    for relpath in relpaths:
+        st = os.stat(os.path.join(path, relpath))
+        stats[relpath] = [st.st_size, st.st_mtime_ns]
+    return stats
+
+
+def mod_version_intact(version_dir: str) -> bool:
+    """Whether the files of a store version still have the size and modification time recorded on ingestion
+
+    A file rewritten in place through the hard link of any server changes the version for all of them.
+    Versions without a record are verified by hashing their content again.
+
+    """
+    relpaths = list_tree_files(version_dir)
+    record_path = version_dir + '.json'
+    try:
+        with open(record_path, 'rt', encoding='utf8') as f:
+            recorded = json.load(f)
+    except (IOError, OSError, ValueError):
+        if hash_tree(version_dir, relpaths) != os.path.basename(version_dir):
+            return False
+        write_json_atomically(record_path, tree_stats(version_dir, relpaths))
+        return True
+    return recorded == tree_stats(version_dir, relpaths)
+
+
+def set_current_mod_version(item_store_dir: str, version: str):
+    current_dir = os.path.join(item_store_dir, 'current')
+    tmp_link = current_dir + '.tmp'
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(version, tmp_link, target_is_directory=True)
+    os.replace(tmp_link, current_dir)
+
+
+def remove_mod_version(version_dir: str):
+    shutil.rmtree(version_dir)
+    if os.path.exists(version_dir + '.json'):
+        os.remove(version_dir + '.json')
+
+
+def reingest_mod_version(item_store_dir: str, version: str) -> str:
+    """Replaces a drifted store version by a copy named by the hash of its actual content, returns the new version
+
+    The servers still linking the files of the drifted version get the new one on their next share.
+
+    """
+    version_dir = os.path.join(item_store_dir, version)
+    relpaths = list_tree_files(version_dir)
+    tmp_dir = version_dir + '.copy'
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    for relpath in relpaths:
+        os.makedirs(os.path.dirname(os.path.join(tmp_dir, relpath)), exist_ok=True)
+        shutil.copy2(os.path.join(version_dir, relpath), os.path.join(tmp_dir, relpath))
+
+    new_version = hash_tree(tmp_dir, relpaths)
+    new_version_dir = os.path.join(item_store_dir, new_version)
+    if new_version != version and os.path.isdir(new_version_dir) and mod_version_intact(new_version_dir):
+        shutil.rmtree(tmp_dir)
+    else:
+        if os.path.isdir(new_version_dir):
+            remove_mod_version(new_version_dir)
+        os.rename(tmp_dir, new_version_dir)
+        write_json_atomically(new_version_dir + '.json', tree_stats(new_version_dir, relpaths))
+
+    if new_version != version:
+        remove_mod_version(version_dir)
+    current_dir = os.path.join(item_store_dir, 'current')
+    if os.path.islink(current_dir) and os.readlink(current_dir) == version:
+        set_current_mod_version(item_store_dir, new_version)
+
+    print(f'Mod {os.path.basename(item_store_dir)} version {version} was modified in place, re-ingested as {new_version}')
+    return new_version
+
+
+def ingest_mod(item_dir: str, item_id: str) -> bool:
+    """Moves a workshop item downloaded by a server into the shared mod store
+
+    The store keeps each version of an item once, named by the hash of its content. The files of
+    the server's copy are hard links to the store afterwards. Versions modified in place through
+    any of these links are detected by mod_version_intact and re-ingested before sharing them.
+
+    Returns True if the item was not yet shared with the store.
+
+    """
+    relpaths = list_tree_files(item_dir)
+    item_store_dir = os.path.join(MOD_STORE_DIR, item_id)
+    current_dir = os.path.join(item_store_dir, 'current')
+
+    if os.path.isdir(current_dir) and list_tree_files(current_dir) == relpaths and all(
+            os.path.samefile(os.path.join(item_dir, relpath), os.path.join(current_dir, relpath)) for relpath in relpaths):
+        current = os.readlink(current_dir)
+        if mod_version_intact(os.path.join(item_store_dir, current)):
+            return False
+        reingest_mod_version(item_store_dir, current)
+
+    version = hash_tree(item_dir, relpaths)
+    version_dir = os.path.join(item_store_dir, version)
+    if os.path.isdir(version_dir) and not mod_version_intact(version_dir):
+        reingest_mod_version(item_store_dir, version)
+    if os.path.isdir(version_dir):
+        for relpath in relpaths:
+            replace_with_link(os.path.join(version_dir, relpath), os.path.join(item_dir, relpath))
+    else:
+        tmp_dir = version_dir + '.tmp'
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        for relpath in relpaths:
+            os.makedirs(os.path.dirname(os.path.join(tmp_dir, relpath)), exist_ok=True)
+            os.link(os.path.join(item_dir, relpath), os.path.join(tmp_dir, relpath))
+        os.rename(tmp_dir, version_dir)
+        write_json_atomically(version_dir + '.json', tree_stats(version_dir, relpaths))
+
+    # The most recently downloaded version becomes the current one shared with new instances
+    newest = max((os.stat(os.path.join(version_dir, relpath)).st_mtime for relpath in relpaths), default=0.0)
+    if os.path.isdir(current_dir):
+        current_relpaths = list_tree_files(current_dir)
+        current_newest = max((os.stat(os.path.join(current_dir, relpath)).st_mtime for relpath in current_relpaths), default=0.0)
+        if current_newest > newest:
+            return True
+
+    set_current_mod_version(item_store_dir, version)
+    return True
+
+
+def newest_tree_mtime(path: str) -> float:
+    """Latest modification time of a folder, its subfolders and files"""
+    newest = os.stat(path).st_mtime
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in dirnames + filenames:
+            newest = max(newest, os.lstat(os.path.join(dirpath, name)).st_mtime)
+    return newest
+
+
+def share_mods(number: int, complete: Iterable[str] = ()) -> Tuple[int, int]:
+    """Shares the mods downloaded by a server via the store and links in the ones it misses
+
+    Items modified within MOD_INGEST_SETTLE_TIME are not ingested yet, unless their ID is
+    listed as complete, since the game of a running server may be downloading them.
+
+    Returns the number of items ingested from the server and the number of items linked into it.
+
+    """
+    view_dir = mod_view_dir(number)
+    os.makedirs(view_dir, exist_ok=True)
+    os.makedirs(MOD_STORE_DIR, exist_ok=True)
+
+    ingested = 0
+    linked = 0
+    with filelock.FileLock(os.path.join(MOD_STORE_DIR, '.lock')):
+        for item_id in os.listdir(view_dir):
+            item_dir = os.path.join(view_dir, item_id)
+            if not item_id.isdigit() or not os.path.isdir(item_dir):
+                continue
+            if item_id not in complete and time() - newest_tree_mtime(item_dir) < MOD_INGEST_SETTLE_TIME:
+                continue
+            if ingest_mod(item_dir, item_id):
+                ingested += 1
+
+        for item_id in os.listdir(MOD_STORE_DIR):
+            current_dir = os.path.join(MOD_STORE_DIR, item_id, 'current')
+            item_dir = os.path.join(view_dir, item_id)
+            if not os.path.isdir(current_dir) or os.path.exists(item_dir):
+                continue
+            current = os.readlink(current_dir)
+            if not mod_version_intact(os.path.join(MOD_STORE_DIR, item_id, current)):
+                reingest_mod_version(os.path.join(MOD_STORE_DIR, item_id), current)
+            # Linked into a temporary folder first, so the game never sees a partial item
+            tmp_dir = item_dir + '.link'
+            if os.path.isdir(tmp_dir):
+                shutil.rmtree(tmp_dir)
+            os.makedirs(tmp_dir)
+            for relpath in list_tree_files(current_dir):
+                os.makedirs(os.path.dirname(os.path.join(tmp_dir, relpath)), exist_ok=True)
+                os.link(os.path.join(current_dir, relpath), os.path.join(tmp_dir, relpath))
+            os.rename(tmp_dir, item_dir)
+            linked += 1
+
+    return ingested, linked
+
+
+def command_mods() -> int:
+    """Shares the mods of all servers via the store, removes versions no longer used by any server"""
+    for number in scan_numbers(CACHE_DIR_TEMPLATE):
+        if os.path.isdir(mod_view_dir(number)):
+            ingested, linked = share_mods(number)
+            if ingested or linked:
+                print(f'{number:02d} ingested {ingested} linked {linked}')
+
+    if not os.path.isdir(MOD_STORE_DIR):
+        return 0
+
+    removed = 0
+    with filelock.FileLock(os.path.join(MOD_STORE_DIR, '.lock')):
+        for item_id in os.listdir(MOD_STORE_DIR):
+            item_store_dir = os.path.join(MOD_STORE_DIR, item_id)
+            if not item_id.isdigit() or not os.path.isdir(item_store_dir):
+                continue
+            current_dir = os.path.join(item_store_dir, 'current')
+            current = os.readlink(current_dir) if os.path.islink(current_dir) else None
+            for version in os.listdir(item_store_dir):
+                version_dir = os.path.join(item_store_dir, version)
+                if version in ('current', current) or os.path.islink(version_dir) or not os.path.isdir(version_dir):
+                    continue
+                # Files of a version still used by a server have more than one link
+                if all(os.stat(os.path.join(version_dir, relpath)).st_nlink == 1 for relpath in list_tree_files(version_dir)):
+                    remove_mod_version(version_dir)
+                    removed += 1
+
+    print(f'Removed {removed} unused mod versions from the store')
+    return 0
+
+
+def read_world_mods(sandbox_sbc_path: str) -> List[str]:
+    """Returns the workshop IDs of the mods listed in the Sandbox.sbc of a world"""
+    with open(sandbox_sbc_path, 'rb') as f:
+        m = RX_MODS_ELEMENT.search(f.read())
+    if m is None:
+        return []
+    return [item_id.decode('ascii') for item_id in RX_PUBLISHED_FILE_ID.findall(m.group(1))]
+
+
+def download_workshop_items(item_ids: List[str], timeout: float) -> Dict[str, str]:
+    """Downloads or updates workshop items in a single steamcmd session
+
+    Returns the folders of the items reported as downloaded successfully by their ID.
+
+    """
+    command = [STEAMCMD, '+force_install_dir', MOD_DOWNLOAD_DIR, '+login', 'anonymous']
+    for item_id in item_ids:
+        command.extend(['+workshop_download_item', STEAM_SPACE_ENGINEERS_APP_ID, item_id])
+    command.append('+quit')
+
+    os.makedirs(MOD_DOWNLOAD_DIR, exist_ok=True)
+    # steamcmd is a wrapper script, its children must be killed along with it on timeout, since they hold the output open
+    process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, start_new_session=True)
+    try:
+        output = process.communicate(timeout=timeout)[0]
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        output = process.communicate()[0]
+        print(f'{timestamp()} ERROR: steamcmd timed out after {timeout}s')
+
+    return {m.group(1): m.group(2) for m in RX_STEAMCMD_DOWNLOADED.finditer(output.decode('utf8', errors='replace'))}
+
+
+def same_tree(a: str, b: str) -> bool:
+    relpaths = list_tree_files(a)
+    if relpaths != list_tree_files(b):
+        return False
+    for relpath in relpaths:
+        sa = os.stat(os.path.join(a, relpath))
+        sb = os.stat(os.path.join(b, relpath))
+        if sa.st_size != sb.st_size or sa.st_mtime_ns != sb.st_mtime_ns:
+            return False
+    return True
+
+
+def inspect_world_zip(zip_path: str) -> dict:
+    """Collects the problems of a world ZIP and the asteroids, plugins and mods it references
+
+    The world files are parsed as streams right from the ZIP without extracting them.
+
+    """
+    facts = dict(errors=[], asteroids=[], plugins=[], mods=[], world_files=[])
+    errors = facts['errors']
+
+    try:
+        zf = zipfile.ZipFile(zip_path, 'r')
+    except (IOError, OSError, zipfile.BadZipFile) as e:
+        errors.append(f'Cannot open ZIP: {e}')
+        return facts
+
+    with zf:
+        prefix = zip_top_folder(zf)
+        members = {zi.filename[len(prefix):].lstrip('/'): zi for zi in zf.filelist}
+
+        if 'world.json' not in members:
+            errors.append('Missing world.json')
+        else:
+            try:
+                world = json.loads(zf.read(members['world.json']).decode('utf8'))
+            except WORLD_MEMBER_ERRORS as e:
+                errors.append(f'Invalid world.json: {e}')
+                world = {}
+            if not isinstance(world, dict):
+                errors.append('Invalid world.json: not a JSON object')
+                world = {}
+            for field, expected_type in WORLD_JSON_FIELDS.items():
+                if not isinstance(world.get(field), expected_type):
+                    errors.append(f'Missing or invalid world.json field: {field} (expected {expected_type.__name__})')
+            if isinstance(world.get('plugins'), list):
+                facts['plugins'] = [str(name) for name in world['plugins']]
+
+        world_prefix = 'Instance/Saves/World/'
+        facts['world_files'] = sorted(name[len(world_prefix):] for name in members if name.startswith(world_prefix))
+
+        for filename in WORLD_FILES:
+            if world_prefix + filename not in members:
+                errors.append(f'Missing world file: {filename}')
+
+        sandbox_sbc = members.get(world_prefix + 'Sandbox.sbc')
+        if sandbox_sbc is not None:
+            try:
+                data = zf.read(sandbox_sbc)
+                fromstring(data)
+            except WORLD_MEMBER_ERRORS as e:
+                errors.append(f'Malformed Sandbox.sbc: {e}')
+            else:
+                m = RX_MODS_ELEMENT.search(data)
+                if m is not None:
+                    facts['mods'] = [item_id.decode('ascii') for item_id in RX_PUBLISHED_FILE_ID.findall(m.group(1))]
+
+        sandbox_config_sbc = members.get(world_prefix + 'Sandbox_config.sbc')
+        if sandbox_config_sbc is not None:
+            try:
+                fromstring(zf.read(sandbox_config_sbc))
+            except WORLD_MEMBER_ERRORS as e:
+                errors.append(f'Malformed Sandbox_config.sbc: {e}')
+
+        sbs = members.get(world_prefix + 'SANDBOX_0_0_0_.sbs')
+        if sbs is not None:
+            try:
+                with zf.open(sbs) as f:
+                    for event, element in iterparse(f, events=('end',)):
+                        if element.tag == 'StorageName' and element.text and 'Asteroid' in element.text:
+                            facts['asteroids'].append(element.text)
+                        element.clear()
+            except WORLD_MEMBER_ERRORS as e:
+                errors.append(f'Malformed SANDBOX_0_0_0_.sbs: {e}')
+
+    return facts
+
+
+def world_zip_facts(zip_path: str) -> dict:
+    """Inspects a world ZIP, the results are cached by the hash of the ZIP"""
+    digest = hash_file(zip_path)
+    cache_path = os.path.join(WORLD_FACTS_CACHE_DIR, f'{digest}.json')
+    if os.path.exists(cache_path):
+        with open(cache_path, 'rt', encoding='utf8') as f:
+            return json.load(f)
+
+    facts = inspect_world_zip(zip_path)
+
+    os.makedirs(WORLD_FACTS_CACHE_DIR, exist_ok=True)
+    write_json_atomically(cache_path, facts)
+    return facts
+
+
+def validate_world(zip_path: str) -> Tuple[List[str], List[str]]:
+    """Returns the errors preventing the world from loading and warnings about it
+
+    The local stores are checked on every call, so only the inspection of the ZIP is cached.
+
+    """
+    if not os.path.isfile(zip_path):
+        return [f'Missing world ZIP: {zip_path}'], []
+
+    facts = world_zip_facts(zip_path)
+    errors = list(facts['errors'])
+    warnings = []
+
+    for name in ['Hosting'] + [name for name in facts['plugins'] if name != 'Hosting']:
+        if not os.path.isfile(os.path.join(PLUGINS_DIR, name + '.zip')):
+            errors.append(f'Unknown plugin: {name}')
+
+    world_files = set(facts['world_files'])
+    for storage_name in sorted(set(facts['asteroids'])):
+        filename = storage_name + '.vx2'
+        if filename not in world_files and not os.path.isfile(os.path.join(ASTEROIDS_DIR, filename)):
+            errors.append(f'Missing asteroid: {filename}')
+
+    for item_id in facts['mods']:
+        if not os.path.isdir(os.path.join(MOD_STORE_DIR, item_id, 'current')):
+            warnings.append(f'Mod not in the local store yet, it will be downloaded: {item_id}')
+
+    return errors, warnings
+
+
+def command_validate(*, world: str) -> int:
+    errors, warnings = validate_world(world)
+    for warning in warnings:
+        print(f'WARNING: {warning}')
+    for error in errors:
+        print(f'ERROR: {error}')
+    if errors:
+        return 1
+    print('OK')
+    return 0
+
+
+def is_script_process(pid: int, *arguments: str) -> bool:
+    """Checks whether the PID from a pid file is still this script running with the given arguments
+
+    PIDs are reused by the system, zombie processes have exited already.
+
+    """
+    try:
+        process = psutil.Process(pid)
+        if process.status() == psutil.STATUS_ZOMBIE:
+            return False
+        cmdline = process.cmdline()
+    except psutil.Error:
+        return False
+
+    script = os.path.basename(__file__)
+    for position, argument in enumerate(cmdline):
+        if os.path.basename(argument) == script:
+            return cmdline[position + 1:position + 1 + len(arguments)] == list(arguments)
+    return False
+
+
+def remove_pid_file(path: str, pid: int):
+    """Removes the pid file, unless a newer process has overwritten it with its own PID meanwhile"""
+    try:
+        with open(path, 'rt') as f:
+            if int(f.read()) != pid:
+                return
+        os.remove(path)
+    except (IOError, OSError, ValueError):
+        pass
+
+
+def find_torch_pids() -> Dict[str, int]:
+    """Maps the instance folders of the running Torch servers to their PIDs in a single process scan"""
+    pids = {}
+    for process in psutil.process_iter(attrs=['pid', 'cmdline']):
+        try:
+            cmdline = process.cmdline()
+        except psutil.NoSuchProcess:
+            continue
+        if cmdline and 'Torch.Server.exe' in cmdline[0] and '-instancepath' in cmdline:
+            position = cmdline.index('-instancepath') + 1
+            if position < len(cmdline):
+                pids[cmdline[position]] = process.pid
+    return pids
+
+
+class ThreadOutput(io.TextIOBase):
+    """Standard output or error capturing the prints of each bulk worker thread separately"""
+
+    def __init__(self, default):
+        super().__init__()
+        self.default = default
+        self.local = threading.local()
+
+    def capture(self, buffer: Optional[io.StringIO]):
+        self.local.buffer = buffer
+
+    def write(self, text):
+        buffer = getattr(self.local, 'buffer', None)
+        return (self.default if buffer is None else buffer).write(text)
+
+    def flush(self):
+        self.default.flush()
 
 
 def change_registry(path, **kws):
@@ -200,6 +1091,10 @@ def content_cache_dir(number: int):
     return os.path.join(cache_dir(number), 'content')
 
 
+def mod_view_dir(number: int):
+    return os.path.join(content_cache_dir(number), STEAM_SPACE_ENGINEERS_APP_ID)
+
+
 def edit(editor, path: str):
     with open(path, 'rt', encoding='utf8') as f:
         original = f.read()
@@ -210,6 +1105,21 @@ def edit(editor, path: str):
         f.write(edited)
 
 
+def zip_top_folder(zf: zipfile.ZipFile) -> str:
+    prefix = ''
+    for zi in zf.filelist:
+        dir_of_file = os.path.dirname(zi.filename)
+        if not prefix:
+            prefix = dir_of_file
+        elif dir_of_file.startswith(prefix):
+            continue
+        elif prefix.startswith(dir_of_file):
+            prefix = dir_of_file
+        else:
+            return ''
+    return prefix
+
+
 def unzip(target_dir, zip_path, *, remove_top_folder=True):
     """Unzip a ZIP archive
 
@@ -218,19 +1128,7 @@ def unzip(target_dir, zip_path, *, remove_top_folder=True):
     """
     with zipfile.ZipFile(zip_path, 'r') as zf:
 
-        prefix = ''
-        if remove_top_folder:
-            for zi in zf.filelist:
-                dir_of_file = os.path.dirname(zi.filename)
-                if not prefix:
-                    prefix = dir_of_file
-                elif dir_of_file.startswith(prefix):
-                    continue
-                elif prefix.startswith(dir_of_file):
-                    prefix = dir_of_file
-                else:
-                    prefix = ''
-                    break
+        prefix = zip_top_folder(zf) if remove_top_folder else ''
 
         for zi in zf.filelist:
             relative_path = zi.filename[len(prefix):].lstrip('/')
@@ -278,47 +1176,695 @@ def clone(source, target):
             if extension in CLONE_SKIP_EXTENSIONS:
                 continue
 
-            if os.path.islink(src_path):
-                original_target = os.readlink(src_path)
-                os.symlink(original_target, dst_path)
-                continue
+            if os.path.islink(src_path):
+                original_target = os.readlink(src_path)
+                os.symlink(original_target, dst_path)
+                continue
+
+            if extension in CLONE_SAFE_TO_LINK_EXTENSIONS:
+                os.link(src_path, dst_path)
+                continue
+
+            shutil.copy(src_path, dst_path)
+
+
+def list_template_files(src) -> List[str]:
+    """Relative paths of the files and symlinks a clone of the template receives and upgrade maintains"""
+    relpaths = []
+    for srcdir, dirnames, filenames in os.walk(src):
+        reldir = srcdir[len(src) + 1:]
+        if not reldir:
+            dirnames[:] = [dirname for dirname in dirnames if dirname not in UPGRADE_SKIP_PATHS]
+        for name in dirnames + filenames:
+            if not reldir and name in UPGRADE_SKIP_PATHS:
+                continue
+            srcpath = os.path.join(srcdir, name)
+            if name in dirnames and not os.path.islink(srcpath):
+                continue
+            if os.path.splitext(name)[1][1:].lower() in CLONE_SKIP_EXTENSIONS:
+                continue
+            relpaths.append(os.path.join(reldir, name))
+    return relpaths
+
+
+@functools.lru_cache(maxsize=None)
+def hash_template_file(path: str, size: int, mtime_ns: int) -> str:
+    # Size and modification time are part of the key, so the cache is invalidated on template changes
+    return hash_file(path)
+
+
+def upgrade_tree(src, dst, previous_relpaths: Optional[List[str]]) -> Dict[str, int]:
+    """Synchronizes the template files into a cloned instance incrementally
+
+    Unchanged files are skipped, files which are still identical to the template
+    but lost their hard link are re-linked, changed ones are linked or copied the
+    same way as clone does. Files removed from the template since the previous
+    create or upgrade are deleted. Files are replaced atomically.
+
+    """
+    counts = dict(unchanged=0, relinked=0, updated=0, deleted=0)
+    relpaths = list_template_files(src)
+
+    for relpath in relpaths:
+        srcpath = os.path.join(src, relpath)
+        dstpath = os.path.join(dst, relpath)
+        tmppath = dstpath + '.upgrade'
+        os.makedirs(os.path.dirname(dstpath), exist_ok=True)
+
+        if os.path.islink(srcpath):
+            link_target = os.readlink(srcpath)
+            if os.path.islink(dstpath) and os.readlink(dstpath) == link_target:
+                counts['unchanged'] += 1
+                continue
+            if os.path.isdir(dstpath) and not os.path.islink(dstpath):
+                shutil.rmtree(dstpath)
+            os.symlink(link_target, tmppath)
+            os.replace(tmppath, dstpath)
+            counts['updated'] += 1
+            continue
+
+        linkable = os.path.splitext(relpath)[1][1:].lower() in CLONE_SAFE_TO_LINK_EXTENSIONS
+        src_stat = os.stat(srcpath)
+        try:
+            dst_stat = os.lstat(dstpath)
+        except (IOError, OSError):
+            dst_stat = None
+
+        if dst_stat is not None:
+            if os.path.samestat(src_stat, dst_stat):
+                counts['unchanged'] += 1
+                continue
+
+            identical = dst_stat.st_size == src_stat.st_size and (
+                dst_stat.st_mtime_ns == src_stat.st_mtime_ns or
+                hash_file(dstpath) == hash_template_file(srcpath, src_stat.st_size, src_stat.st_mtime_ns))
+
+            if identical and not linkable:
+                counts['unchanged'] += 1
+                continue
+
+            counts['relinked' if identical else 'updated'] += 1
+        else:
+            counts['updated'] += 1
+
+        if linkable:
+            os.link(srcpath, tmppath)
+        else:
+            shutil.copy2(srcpath, tmppath)
+        os.replace(tmppath, dstpath)
+
+    if previous_relpaths is not None:
+        for relpath in set(previous_relpaths) - set(relpaths):
+            dstpath = os.path.join(dst, relpath)
+            if os.path.islink(dstpath) or os.path.isfile(dstpath):
+                os.remove(dstpath)
+                counts['deleted'] += 1
+
+    return counts
+
+
+def fsync_dir(path: str):
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def copy_file_durably(src_path: str, dst_path: str):
+    tmp_path = dst_path + '.sync'
+    with open(src_path, 'rb') as sf:
+        with open(tmp_path, 'wb') as tf:
+            shutil.copyfileobj(sf, tf, 1024 ** 2)
+            tf.flush()
+            os.fsync(tf.fileno())
+    shutil.copystat(src_path, tmp_path)
+    os.replace(tmp_path, dst_path)
+
+
+def sync_tree(src: str, dst: str) -> int:
+    """Writes back the changed files of a directory tree recursively and crash safely
+
+    Files are written into a temporary file, flushed to the disk, then atomically
+    renamed over the old version. The files the game loads the world from are
+    written last and removed files are deleted only after everything else is
+    written back, so a crash at any point leaves a loadable world on the disk.
+
+    Returns the number of files written back or deleted.
+
+    """
+    changed = []
+    deleted = []
+    for srcdir, dirnames, filenames in os.walk(src):
+        reldir = srcdir[len(src) + 1:]
+        dstdir = os.path.join(dst, reldir) if reldir else dst
+        os.makedirs(dstdir, exist_ok=True)
+        for filename in filenames:
+            src_stat = os.stat(os.path.join(srcdir, filename))
+            try:
+                dst_stat = os.stat(os.path.join(dstdir, filename))
+            except (IOError, OSError):
+                dst_stat = None
+            if dst_stat is None or dst_stat.st_size != src_stat.st_size or dst_stat.st_mtime_ns != src_stat.st_mtime_ns:
+                changed.append(os.path.join(reldir, filename))
+
+    for dstdir, dirnames, filenames in os.walk(dst):
+        reldir = dstdir[len(dst) + 1:]
+        for filename in filenames:
+            relpath = os.path.join(reldir, filename)
+            if not os.path.exists(os.path.join(src, relpath)):
+                deleted.append(relpath)
+
+    changed.sort(key=lambda relpath: os.path.basename(relpath) in WORLD_SYNC_LAST_FILES)
+
+    dirs_to_fsync = set()
+    for relpath in changed:
+        dst_path = os.path.join(dst, relpath)
+        copy_file_durably(os.path.join(src, relpath), dst_path)
+        dirs_to_fsync.add(os.path.dirname(dst_path))
+
+    for dir_path in dirs_to_fsync:
+        fsync_dir(dir_path)
+
+    for relpath in deleted:
+        os.remove(os.path.join(dst, relpath))
+
+    return len(changed) + len(deleted)
+
+
+def tree_size(path: str) -> int:
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            size += os.stat(os.path.join(dirpath, filename)).st_size
+    return size
+
+
+def cleanup_archive(archive_ds_dir: str):
+    for fn in os.listdir(archive_ds_dir):
+        if fn in ('Instance', 'Logs', 'Torch.cfg', 'start', 'start.log', 'zip_path', 'state.json'):
+            continue
+        fp = os.path.join(archive_ds_dir, fn)
+        if os.path.isdir(fp):
+            shutil.rmtree(fp)
+        else:
+            os.remove(fp)
+
+
+def hash_file(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while 1:
+            data = f.read(1024 ** 2)
+            if not data:
+                break
+            sha256.update(data)
+    return sha256.hexdigest()
+
+
+def write_json_atomically(path: str, data):
+    # Unique between the threads and processes writing the same file
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'wt', encoding='utf8') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def archive_object_path(digest: str) -> str:
+    return os.path.join(ARCHIVE_OBJECTS_DIR, digest[:2], digest + '.zst')
+
+
+def archive_manifest_path(server_name: str, archive_name: str) -> str:
+    return os.path.join(ARCHIVE_MANIFESTS_DIR, server_name, archive_name + '.json')
+
+
+def store_archive_object(path: str) -> str:
+    """Stores the zstd compressed content of a file once, returns its SHA-256 digest"""
+    digest = hash_file(path)
+    object_path = archive_object_path(digest)
+    if os.path.exists(object_path):
+        return digest
+
+    os.makedirs(os.path.dirname(object_path), exist_ok=True)
+    tmp_path = object_path + '.tmp'
+    subprocess.run([ZSTD, '-q', '-f', '-o', tmp_path, path], check=True)
+    os.replace(tmp_path, object_path)
+    return digest
+
+
+def load_archive_index() -> List[dict]:
+    """Returns the archives known to the store, oldest first"""
+    try:
+        with open(ARCHIVE_INDEX_PATH, 'rt', encoding='utf8') as f:
+            return json.load(f)
+    except (IOError, OSError):
+        return []
+
+
+def save_archive_index(index: List[dict]):
+    index.sort(key=lambda entry: (entry['created'], entry['server']))
+    write_json_atomically(ARCHIVE_INDEX_PATH, index)
+
+
+def store_archive(path: str, server_name: str, archive_name: str):
+    """Stores a folder into the deduplicated archive store
+
+    Every distinct file content is stored only once as a zstd compressed object
+    named by its hash, the folder structure is kept in a manifest per archive.
+    The index lists all archives, so listing needs no directory scans.
+
+    """
+    files = {}
+    symlinks = {}
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        reldir = dirpath[len(path) + 1:]
+        for name in dirnames + filenames:
+            fp = os.path.join(dirpath, name)
+            relpath = os.path.join(reldir, name)
+            if os.path.islink(fp):
+                symlinks[relpath] = os.readlink(fp)
+            elif name in filenames:
+                st = os.stat(fp)
+                files[relpath] = [store_archive_object(fp), st.st_size, st.st_mode & 0o777]
+                size += st.st_size
+
+    created = datetime.datetime.strptime(archive_name[:15], '%Y%m%d-%H%M%S').isoformat()
+    manifest = dict(server=server_name, name=archive_name, created=created, files=files, symlinks=symlinks)
+
+    manifest_path = archive_manifest_path(server_name, archive_name)
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    write_json_atomically(manifest_path, manifest)
+
+    index = [entry for entry in load_archive_index() if (entry['server'], entry['name']) != (server_name, archive_name)]
+    index.append(dict(server=server_name, name=archive_name, created=created, files=len(files), size=size))
+    save_archive_index(index)
+
+
+def restore_archive(server_name: str, archive_name: str, target_dir: str):
+    with open(archive_manifest_path(server_name, archive_name), 'rt', encoding='utf8') as f:
+        manifest = json.load(f)
+
+    for relpath, (digest, size, mode) in manifest['files'].items():
+        target_path = os.path.join(target_dir, relpath)
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        subprocess.run([ZSTD, '-q', '-d', '-f', '-o', target_path, archive_object_path(digest)], check=True)
+        os.chmod(target_path, mode)
+
+    for relpath, link_target in manifest['symlinks'].items():
+        target_path = os.path.join(target_dir, relpath)
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        os.symlink(link_target, target_path)
+
+
+def select_archives_to_prune(index: List[dict], keep_last: int, keep_daily_days: int) -> List[dict]:
+    """Keeps the last N archives and the newest one of each of the last D days per server"""
+    since = (datetime.datetime.now() - datetime.timedelta(days=keep_daily_days)).isoformat()
+    kept = set()
+    by_server = {}
+    for entry in index:
+        by_server.setdefault(entry['server'], []).append(entry)
+
+    for entries in by_server.values():
+        entries.sort(key=lambda e: e['created'], reverse=True)
+        days = set()
+        for position, entry in enumerate(entries):
+            day = entry['created'][:10]
+            if position < keep_last or (entry['created'] >= since and day not in days):
+                kept.add((entry['server'], entry['name']))
+            days.add(day)
+
+    return [entry for entry in index if (entry['server'], entry['name']) not in kept]
+
+
+def command_prune(*, keep_last: int, keep_daily: int) -> int:
+    with filelock.FileLock(get_archiver_lock_path()):
+        index = load_archive_index()
+        pruned = select_archives_to_prune(index, keep_last, keep_daily)
+        if not pruned:
+            return 0
+
+        # The index is saved first, so it never lists an archive whose manifest is already deleted
+        index = [entry for entry in index if entry not in pruned]
+        save_archive_index(index)
+
+        for entry in pruned:
+            try:
+                os.remove(archive_manifest_path(entry['server'], entry['name']))
+            except FileNotFoundError:
+                pass
+            print(f'Pruned {entry["server"]}/{entry["name"]}')
+
+        referenced = set()
+        missing = []
+        for entry in index:
+            try:
+                with open(archive_manifest_path(entry['server'], entry['name']), 'rt', encoding='utf8') as f:
+                    referenced.update(digest for digest, size, mode in json.load(f)['files'].values())
+            except FileNotFoundError:
+                print(f'Missing manifest of {entry["server"]}/{entry["name"]}, removing it from the index')
+                missing.append(entry)
+        if missing:
+            index = [entry for entry in index if entry not in missing]
+            save_archive_index(index)
+
+        freed = 0
+        for dirpath, dirnames, filenames in os.walk(ARCHIVE_OBJECTS_DIR):
+            for fn in filenames:
+                if fn[:-len('.zst')] not in referenced:
+                    fp = os.path.join(dirpath, fn)
+                    freed += os.stat(fp).st_size
+                    os.remove(fp)
+
+        print(f'Pruned {len(pruned)} archives, freed {freed} bytes')
+
+    return 0
+
+
+def command_archives(*, server: Optional[int]) -> int:
+    for entry in load_archive_index():
+        if server is None or entry['server'] == server_dir_name(server):
+            print(f'{entry["server"]}/{entry["name"]} {entry["files"]} {entry["size"]}')
+    return 0
+
+
+def command_restore(*, archive: str, target: str) -> int:
+    server_name, archive_name = archive.split('/', 1)
+    if os.path.exists(target):
+        raise ValueError(f'Restore target already exists: {target}')
+    restore_archive(server_name, archive_name, target)
+    return 0
+
+
+def get_archiver_lock_path() -> str:
+    return os.path.expanduser('~/.local/archiver.lock')
+
+
+def get_archiver_log_path() -> str:
+    return os.path.expanduser(f'~/logs/archiver.{datetime.date.today().isoformat()}.log')
+
+
+def start_archiver():
+    os.system(f'nohup {sys.executable} {os.path.abspath(__file__)} archiver >/dev/null 2>&1 &')
+
+
+def process_staged_archive(name: str):
+    """Finishes an archive renamed into the staging area by Server.command_archive
+
+    Entries are named ``<server folder>_<timestamp>_<initiator>_<mode>``, the Wine
+    prefix of the same archive has a ``.wine`` suffix and is only deleted.
+
+    """
+    path = os.path.join(ARCHIVE_STAGING_DIR, name)
+
+    if name.endswith('.wine'):
+        shutil.rmtree(path)
+        return
+
+    m = RX_STAGED_ARCHIVE.match(name)
+    if m is None:
+        raise ValueError(f'Invalid staged archive name: {name}')
+    server_name, archive_name = m.groups()
+    if not archive_name.endswith('_full'):
+        cleanup_archive(path)
+
+    store_archive(path, server_name, archive_name)
+    shutil.rmtree(path)
+
+
+def run_archiver(names: List[str]) -> int:
+    """Runs the archiver in a separate process and waits for it, so its priority and output settings stay there"""
+    return subprocess.run([sys.executable, os.path.abspath(__file__), 'archiver'] + names, stdin=subprocess.DEVNULL).returncode
+
+
+def command_archiver(*, names: List[str]) -> int:
+    """Background worker finishing the staged archives at idle I/O and CPU priority
+
+    Finishes only the staged archives given by name if there are any, all of them otherwise.
+
+    """
+    process = psutil.Process()
+    process.nice(19)
+    process.ionice(psutil.IOPRIO_CLASS_IDLE)
+
+    result = 0
+    with open(get_archiver_log_path(), 'at') as output:
+        sys.stdout = output
+        sys.stderr = output
+
+        # Workers started while another one is running wait here, then pick up anything left behind
+        with filelock.FileLock(get_archiver_lock_path()):
+            while 1:
+                staged = sorted(os.listdir(ARCHIVE_STAGING_DIR)) if os.path.isdir(ARCHIVE_STAGING_DIR) else []
+                if names:
+                    # The requested ones may have been finished by a background archiver already
+                    staged = [name for name in staged if name in names]
+                if not staged:
+                    break
+
+                for name in staged:
+                    started = time()
+                    # noinspection PyBroadException
+                    try:
+                        process_staged_archive(name)
+                    except Exception:
+                        print(f'{timestamp()} ERROR: Failed to process staged archive {name}: {traceback.format_exc()}', end='')
+                        result = 1
+                    else:
+                        print(f'{timestamp()}: Processed staged archive {name} in {time() - started:.3f}s')
+                    finally:
+                        output.flush()
+
+                if result:
+                    break
+
+    return result
+
+
+class Display:
+    """Long-lived Xvfb display shared by several headless Torch servers
+
+    Only respawned if its Xvfb process is gone and never stopped while processes
+    are connected to it. Clients are authenticated by the cookie in auth_path.
+
+    """
+
+    def __init__(self, index: int):
+        assert 0 <= index < XVFB_POOL_SIZE
+        self.index = index
+
+    @classmethod
+    def for_server(cls, number: int) -> 'Display':
+        return cls(number % XVFB_POOL_SIZE)
+
+    @property
+    def number(self) -> int:
+        return XVFB_DISPLAY_OFFSET + self.index
+
+    @property
+    def name(self) -> str:
+        return f':{self.number}'
+
+    @property
+    def socket_path(self) -> str:
+        return X11_SOCKET_TEMPLATE % self.number
+
+    @property
+    def pid_path(self) -> str:
+        return os.path.expanduser(f'~/.local/xvfb-{self.number}.pid')
+
+    @property
+    def file_lock_path(self) -> str:
+        return os.path.expanduser(f'~/.local/xvfb-{self.number}.lock')
+
+    @property
+    def log_path(self) -> str:
+        return os.path.expanduser(f'~/logs/xvfb-{self.number}.log')
+
+    @property
+    def auth_path(self) -> str:
+        return os.path.expanduser(f'~/.local/xvfb-{self.number}.auth')
+
+    @property
+    def pid(self) -> Optional[int]:
+        try:
+            with open(self.pid_path, 'rt') as f:
+                pid = int(f.read())
+        except (IOError, OSError, ValueError):
+            return None
+
+        try:
+            cmdline = psutil.Process(pid).cmdline()
+        except psutil.Error:
+            return None
+
+        if not cmdline or os.path.basename(cmdline[0]) != 'Xvfb' or self.name not in cmdline:
+            return None
+
+        return pid
+
+    @property
+    def owner_pid(self) -> Optional[int]:
+        """PID of the live process holding the display by the X server lock file, possibly of another user"""
+        try:
+            with open(X11_LOCK_TEMPLATE % self.number, 'rt') as f:
+                pid = int(f.read().strip())
+        except (IOError, OSError, ValueError):
+            return None
+        return pid if psutil.pid_exists(pid) else None
+
+    @property
+    def clients(self) -> List[int]:
+        """PIDs of the processes of this user using the display, like the Wine processes of the servers"""
+        pids = []
+        for process in psutil.process_iter(attrs=['pid', 'environ'], ad_value=None):
+            environ = process.info['environ']
+            if environ and environ.get('DISPLAY') == self.name:
+                pids.append(process.info['pid'])
+        return pids
+
+    @property
+    def accepting(self) -> bool:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            try:
+                s.connect(self.socket_path)
+            except (IOError, OSError):
+                return False
+        return True
+
+    def ensure(self) -> bool:
+        """Starts the display if its Xvfb process is gone, returns whether it was started"""
+        with filelock.FileLock(self.file_lock_path):
+            # A display not accepting connections for a moment is left alone, servers may be using it
+            if self.pid is not None:
+                return False
+
+            self.start()
+            return True
 
-            if extension in CLONE_SAFE_TO_LINK_EXTENSIONS:
-                os.link(src_path, dst_path)
-                continue
+    def write_auth(self):
+        """Writes a new MIT-MAGIC-COOKIE-1 for the display into an Xauthority file readable only by this user"""
+        fields = [b'', str(self.number).encode('ascii'), b'MIT-MAGIC-COOKIE-1', os.urandom(16)]
+        entry = struct.pack('>H', XAUTH_FAMILY_WILD) + b''.join(struct.pack('>H', len(field)) + field for field in fields)
+        fd = os.open(self.auth_path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(entry)
+        os.replace(self.auth_path + '.tmp', self.auth_path)
+
+    def start(self):
+        owner_pid = self.owner_pid
+        if owner_pid is not None:
+            raise IOError(f'Display {self.name} is in use by process {owner_pid}, which is not the Xvfb of this pool')
+
+        self.write_auth()
+        os.makedirs(os.path.dirname(self.log_path), exist_ok=True)
+        with open(self.log_path, 'at') as log:
+            process = subprocess.Popen(
+                [XVFB, self.name, '-screen', '0', XVFB_SCREEN, '-nolisten', 'tcp', '-auth', self.auth_path],
+                stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+                start_new_session=True)
+
+        with open(self.pid_path, 'wt') as f:
+            f.write(str(process.pid))
+
+        started = time()
+        while time() - started < XVFB_STARTUP_TIMEOUT:
+            if process.poll() is not None:
+                raise IOError(f'Xvfb exited with code {process.returncode} on display {self.name}, see {self.log_path}')
+            if self.accepting:
+                return
+            sleep(0.1)
 
-            shutil.copy(src_path, dst_path)
+        process.kill()
+        raise IOError(f'Xvfb did not start accepting connections on display {self.name} in {XVFB_STARTUP_TIMEOUT}s')
 
+    def stop(self):
+        clients = self.clients
+        if clients:
+            raise IOError(f'Display {self.name} is in use by {len(clients)} process(es): {" ".join(map(str, clients))}')
 
-def copy_tree(src, dst):
-    for srcdir, dirnames, filenames in os.walk(src):
-        reldir = srcdir[len(src) + 1:]
-        dstdir = os.path.join(dst, reldir) if reldir else dst
-        os.makedirs(dstdir, exist_ok=True)
-        for filename in filenames:
-            srcpath = os.path.join(srcdir, filename)
-            dstpath = os.path.join(dstdir, filename)
-            shutil.copy2(srcpath, dstpath)
+        pid = self.pid
+        if pid is not None:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                psutil.Process(pid).wait(5)
+            except psutil.TimeoutExpired:
+                os.kill(pid, signal.SIGKILL)
+            except (psutil.Error, OSError):
+                pass
 
+        try:
+            os.remove(self.pid_path)
+        except (IOError, OSError):
+            pass
 
-def cleanup_archive(archive_ds_dir: str):
-    for fn in os.listdir(archive_ds_dir):
-        if fn in ('Instance', 'Logs', 'Torch.cfg', 'start', 'start.log', 'zip_path'):
-            continue
-        fp = os.path.join(archive_ds_dir, fn)
-        if os.path.isdir(fp):
-            shutil.rmtree(fp)
-        else:
-            os.remove(fp)
+    @classmethod
+    def command_displays(cls, *, stop: bool) -> int:
+        result = 0
+        for index in range(XVFB_POOL_SIZE):
+            display = cls(index)
+            try:
+                if stop:
+                    with filelock.FileLock(display.file_lock_path):
+                        display.stop()
+                    continue
+                started = display.ensure()
+            except (IOError, OSError) as e:
+                print(f'{display.name} FAILED {e}')
+                result = 1
+                continue
+            status = 'RESPAWNED' if started else 'OK' if display.accepting else 'NOT ACCEPTING'
+            print(f'{display.name} {status} {display.pid}')
+        return result
 
 
 class Server:
     ip_cache: List[str] = []
 
-    def __init__(self, number: int):
-        assert 0 <= number < 100
+    def __init__(self, number: int, *, shadow: bool = False, pids: Optional[Dict[str, int]] = None):
+        assert is_valid_number(number)
         self.number = number
+        self.shadow = shadow
+        # Process snapshot shared by bulk operations, the processes are scanned on each access if None
+        self.pids = pids
         self.world = {}
+        # GUIDs of the plugins deployed from the plugin catalog by name
+        self.plugin_guids: Dict[str, Optional[str]] = {}
+        # Read-through cache of state.json, reloaded if the file changes
+        self.cached_state: Optional[dict] = None
+        self.cached_state_stat = None
+        self.state_lock = threading.Lock()
+        # Mod prefetch started by create in this process, it is reaped by polling
+        self.mod_prefetch_process: Optional[subprocess.Popen] = None
+
+    @classmethod
+    def select(cls, selector: str, pids: Dict[str, int]) -> List['Server']:
+        """Selects servers by a comma separated list of numbers, ranges like 10-20, all, status=... or zip=..."""
+        numbers = set()
+        existing = [cls(number, pids=pids) for number in allocated_numbers()]
+        for term in selector.split(','):
+            term = term.strip()
+            if term == 'all':
+                numbers.update(server.number for server in existing)
+            elif term.startswith('status='):
+                status = term[len('status='):].upper()
+                numbers.update(server.number for server in existing if server.status == status)
+            elif term.startswith('zip='):
+                name = term[len('zip='):]
+                numbers.update(server.number for server in existing if name in (server.zip_path, os.path.basename(server.zip_path)))
+            elif re.match(r'^\d+-\d+$', term):
+                first, last = map(int, term.split('-'))
+                numbers.update(range(first, last + 1))
+            elif term.isdigit():
+                numbers.add(int(term))
+            else:
+                raise ValueError(f'Invalid server selector: {term}')
+
+        invalid = [number for number in numbers if not is_valid_number(number)]
+        if invalid:
+            raise ValueError(f'Invalid server number: {invalid[0]}')
+
+        return [cls(number, pids=pids) for number in sorted(numbers)]
 
     @property
     def ip(self):
@@ -330,15 +1876,34 @@ class Server:
 
     @property
     def port(self) -> int:
-        return 27000 + self.number
+        slot_range = find_slot_range(self.number)
+        return slot_range['game_port'] + self.number - slot_range['first']
+
+    @property
+    def admin_port(self) -> int:
+        slot_range = find_slot_range(self.number)
+        return slot_range['admin_port'] + self.number - slot_range['first']
+
+    @property
+    def display(self) -> Display:
+        return Display.for_server(self.number)
+
+    @property
+    def live_wine_dir(self) -> str:
+        return os.path.expanduser(WINE_DIR_PATTERN % self.number)
+
+    @property
+    def live_server_dir(self) -> str:
+        return os.path.expanduser(SERVER_DIR_PATTERN % self.number)
 
     @property
     def wine_dir(self) -> str:
-        return os.path.expanduser('~/.wine%02d' % self.number)
+        # The shadow slot is prepared next to the live one, then swapped in by renaming
+        return self.live_wine_dir + '.shadow' if self.shadow else self.live_wine_dir
 
     @property
     def server_dir(self) -> str:
-        return os.path.expanduser('~/ds%02d' % self.number)
+        return self.live_server_dir + '.shadow' if self.shadow else self.live_server_dir
 
     @property
     def logs_dir(self) -> str:
@@ -352,6 +1917,39 @@ class Server:
     def world_dir(self) -> str:
         return os.path.join(self.instance_dir, 'Saves', 'World')
 
+    @property
+    def persistent_world_dir(self) -> str:
+        return os.path.join(self.instance_dir, 'Saves', 'World.disk')
+
+    @property
+    def staged_world_dir(self) -> str:
+        return os.path.join(WORLD_STAGING_DIR, server_dir_name(self.number))
+
+    @property
+    def world_staged(self) -> bool:
+        return os.path.islink(self.world_dir)
+
+    @property
+    def world_sync_pid_path(self):
+        return os.path.expanduser(f'~/.local/world-sync-{self.number}.pid')
+
+    @property
+    def world_sync_lock_path(self):
+        return os.path.expanduser(f'~/.local/world-sync-{server_dir_name(self.number)}.lock')
+
+    @property
+    def world_sync_log_path(self):
+        return os.path.expanduser(f'~/logs/world-sync-{self.number}.{datetime.date.today().isoformat()}.log')
+
+    @property
+    def world_sync_pid(self) -> Optional[int]:
+        try:
+            with open(self.world_sync_pid_path, 'rt') as f:
+                pid = int(f.read())
+        except (IOError, OSError, ValueError):
+            return None
+        return pid if is_script_process(pid, 'sync', str(self.number)) else None
+
     @property
     def canary_path(self) -> str:
         return os.path.join(self.instance_dir, 'canary')
@@ -372,28 +1970,71 @@ class Server:
         return plugins
 
     @property
-    def zip_path(self) -> str:
+    def state_path(self) -> str:
+        return os.path.join(self.server_dir, 'state.json')
+
+    @property
+    def state(self) -> dict:
+        """State owned by this script, the files written by Torch and other scripts are read separately"""
         try:
-            with open(os.path.join(self.server_dir, 'zip_path'), 'rt') as f:
-                return f.read().strip()
-        except (IOError, OSError):
-            return ''
+            st = os.stat(self.state_path)
+        except FileNotFoundError:
+            return self.load_legacy_state()
+
+        stat_key = (st.st_ino, st.st_size, st.st_mtime_ns)
+        if self.cached_state is None or self.cached_state_stat != stat_key:
+            try:
+                with open(self.state_path, 'rt', encoding='utf8') as f:
+                    self.cached_state = json.load(f)
+            except ValueError as e:
+                # Not the legacy files, the next update would write back only the keys found in those
+                raise ValueError(f'Corrupt state file {self.state_path}: {e}')
+            self.cached_state_stat = stat_key
+
+        return self.cached_state
+
+    def load_legacy_state(self) -> dict:
+        """Reads the separate state files of servers created before state.json was introduced"""
+        state = {}
+        for key, path in (('intent', os.path.join(self.server_dir, 'intent')),
+                          ('zip_path', os.path.join(self.server_dir, 'zip_path')),
+                          ('server_name_suffix', os.path.join(self.server_dir, 'server_name_suffix')),
+                          ('ready', os.path.join(self.server_dir, 'ready')),
+                          ('checksum', os.path.join(self.world_dir, 'checksum.txt'))):
+            try:
+                with open(path, 'rt') as f:
+                    state[key] = f.read().strip()
+            except (IOError, OSError):
+                pass
+        return state
+
+    @property
+    def state_lock_path(self) -> str:
+        return self.state_path + '.lock'
+
+    def update_state(self, **values):
+        # Create steps update the state from multiple threads, keepalive, sync and the CLI from separate processes
+        with self.state_lock, filelock.FileLock(self.state_lock_path):
+            self.cached_state = None
+            state = dict(self.state)
+            state.update(values)
+            write_json_atomically(self.state_path, state)
+
+    @property
+    def zip_path(self) -> str:
+        return self.state.get('zip_path', '')
 
     @property
     def world_checksum(self):
-        checksum_path = os.path.join(self.world_dir, 'checksum.txt')
-        if not os.path.exists(checksum_path):
-            return None
-        with open(checksum_path, 'rt') as f:
-            return f.read().strip()
+        return self.state.get('checksum')
+
+    @property
+    def server_name_suffix(self) -> str:
+        return self.state.get('server_name_suffix', '')
 
     @property
     def intent(self) -> str:
-        try:
-            with open(os.path.join(self.server_dir, 'intent'), 'rt') as f:
-                return f.read().strip()
-        except (IOError, OSError):
-            return ''
+        return self.state.get('intent', '')
 
     @property
     def exists(self) -> bool:
@@ -401,15 +2042,8 @@ class Server:
 
     @property
     def pid(self) -> Optional[int]:
-        instance_dir = self.instance_dir
-        for process in psutil.process_iter(attrs=['pid', 'cmdline']):
-            try:
-                cmdline = process.cmdline()
-            except psutil.NoSuchProcess:
-                continue
-            if cmdline and 'Torch.Server.exe' in cmdline[0] and '-instancepath' in cmdline and instance_dir in cmdline:
-                return process.pid
-        return None
+        pids = find_torch_pids() if self.pids is None else self.pids
+        return pids.get(self.instance_dir)
 
     @property
     def file_lock_path(self):
@@ -445,10 +2079,6 @@ class Server:
     def running(self) -> bool:
         return self.pid is not None
 
-    @property
-    def ready_path(self) -> str:
-        return os.path.join(self.server_dir, 'ready')
-
     @property
     def keen_log_path(self) -> Optional[str]:
         logs_dir = self.logs_dir
@@ -471,8 +2101,7 @@ class Server:
 
     @property
     def ready(self) -> bool:
-        ready_path = self.ready_path
-        if os.path.exists(ready_path):
+        if self.state.get('ready'):
             return True
 
         keen_log_path = self.keen_log_path
@@ -486,8 +2115,7 @@ class Server:
             else:
                 return False
 
-        with open(ready_path, 'wt') as f:
-            f.write(timestamp())
+        self.update_state(ready=timestamp())
 
         return True
 
@@ -616,59 +2244,108 @@ class Server:
 
     @classmethod
     def command_list(cls) -> int:
-        for number in range(1, 100):
-            server = cls(number)
+        pids = find_torch_pids()
+        for number in allocated_numbers():
+            server = cls(number, pids=pids)
             status = server.status
             if status != FREE:
                 print(f'{number:02d} {status} {server.zip_path}')
         return 0
 
-    def command_create(self, world_zip_path: str, suffix: str) -> int:
+    def command_create(self, world_zip_path: str, suffix: str, tmpfs: bool = False) -> int:
         if self.exists:
             if self.running:
                 raise ValueError(f'Server already exists and running with number {self.number}, stop and archive it before recreating')
             raise ValueError(f'Server already exists with number {self.number}, archive it before recreating')
 
+        errors, warnings = validate_world(world_zip_path)
+        if errors:
+            raise ValueError(f'Invalid world {world_zip_path}:\n' + '\n'.join(errors))
+
+        # The shadow slot of blue/green recreate reuses the ports of the live server
+        if not self.shadow:
+            if port_in_use(self.port, socket.SOCK_DGRAM):
+                raise ValueError(f'Game port {self.port} of server {self.number} is already in use')
+            if port_in_use(self.admin_port, socket.SOCK_STREAM):
+                raise ValueError(f'Admin port {self.admin_port} of server {self.number} is already in use')
+
         if os.path.isdir(self.wine_dir):
             shutil.rmtree(self.wine_dir)
 
-        self.clone()
-        self.extract_world(world_zip_path)
-        self.load_world_json()
-        self.deploy_asteroids()
-        self.extract_plugins()
-        self.configure_torch()
-        self.configure_dedicated_server(suffix)
-        self.configure_plugin()
-        self.write_start_script()
-        self.link_mod_cache()
-        self.write_zip_path(world_zip_path)
-        self.write_server_name_suffix(suffix)
-        self.checksum_world()
-        self.attempt_using_cached_binary()
+        steps = dict(
+            clone_wine=(self.clone_wine, []),
+            clone_server=(self.clone_server, []),
+            extract_world=(lambda: self.extract_world(world_zip_path), ['clone_server']),
+            load_world_json=(self.load_world_json, ['extract_world']),
+            deploy_asteroids=(self.deploy_asteroids, ['checksum_world']),
+            extract_plugins=(self.extract_plugins, ['load_world_json']),
+            configure_torch=(self.configure_torch, ['extract_plugins']),
+            configure_dedicated_server=(lambda: self.configure_dedicated_server(suffix), ['load_world_json']),
+            configure_plugin=(self.configure_plugin, ['extract_world']),
+            write_start_script=(self.write_start_script, ['load_world_json']),
+            link_mod_cache=(self.link_mod_cache, ['extract_world']),
+            prefetch_mods=(self.start_mod_prefetch, ['link_mod_cache']),
+            write_zip_path=(lambda: self.write_zip_path(world_zip_path), ['clone_server']),
+            write_server_name_suffix=(lambda: self.write_server_name_suffix(suffix), ['clone_server']),
+            checksum_world=(self.checksum_world, ['extract_world']),
+            attempt_using_cached_binary=(self.attempt_using_cached_binary, ['checksum_world']),
+        )
+        if tmpfs:
+            steps['stage_world'] = (self.stage_world, list(steps))
+
+        started = time()
+        timings = run_pipeline(steps, CREATE_PARALLELISM)
+        self.log_create_timings(world_zip_path, time() - started, timings)
         return 0
 
-    def command_archive(self, *, initiator='cmdline', full: bool = False) -> int:
+    @property
+    def create_log_path(self) -> str:
+        return os.path.expanduser(f'~/logs/create.{datetime.date.today().isoformat()}.jsonl')
+
+    def log_create_timings(self, world_zip_path: str, duration: float, timings: Dict[str, Tuple[float, float]]):
+        record = dict(
+            timestamp=timestamp(),
+            number=self.number,
+            shadow=self.shadow,
+            zip_path=world_zip_path,
+            duration=round(duration, 3),
+            steps={name: dict(start=round(start, 3), duration=round(step_duration, 3))
+                   for name, (start, step_duration) in sorted(timings.items(), key=lambda item: item[1][0])},
+        )
+        os.makedirs(os.path.dirname(self.create_log_path), exist_ok=True)
+        with open(self.create_log_path, 'at') as f:
+            f.write(json.dumps(record) + '\n')
+
+    def command_archive(self, *, initiator='cmdline', full: bool = False, wait: bool = False) -> int:
+        """Frees up the server number by renaming the folders into the archive staging area
+
+        Pruning, compression and deletion of the Wine prefix are done by a background
+        archiver process at idle priority, unless waiting for the results is requested.
+
+        """
         if self.running:
             raise ValueError(f'Server is still running with number {self.number}, stop it before archiving')
 
-        archive_dir = os.path.join(ARCHIVE_DIR, f'ds{self.number:02d}')
-        os.makedirs(archive_dir, exist_ok=True)
+        os.makedirs(ARCHIVE_STAGING_DIR, exist_ok=True)
 
         mode = 'full' if full else 'world_logs'
-        archive_ds_dir = os.path.join(archive_dir, f'{timestamp_for_filename()}_{initiator}_{mode}')
+        staged_name = f'{server_dir_name(self.number)}_{timestamp_for_filename()}_{initiator}_{mode}'
+        staged_path = os.path.join(ARCHIVE_STAGING_DIR, staged_name)
 
-        shutil.move(self.server_dir, archive_ds_dir)
+        if self.world_staged:
+            self.unstage_world()
 
-        try:
-            shutil.rmtree(self.wine_dir)
-        except OSError:
-            sleep(1)
-            shutil.rmtree(self.wine_dir)
+        os.rename(self.server_dir, staged_path)
+
+        staged_names = [staged_name]
+        if os.path.isdir(self.wine_dir):
+            os.rename(self.wine_dir, staged_path + '.wine')
+            staged_names.append(staged_name + '.wine')
 
-        if not full:
-            cleanup_archive(archive_ds_dir)
+        if wait:
+            return run_archiver(staged_names)
 
+        start_archiver()
         return 0
 
     def command_destroy(self) -> int:
@@ -676,7 +2353,8 @@ class Server:
             return 0
 
         self.command_kill()
-        for dir_path in (self.server_dir, self.wine_dir):
+        self.stop_world_sync()
+        for dir_path in (self.server_dir, self.wine_dir, self.staged_world_dir):
             try:
                 shutil.rmtree(dir_path)
             except (IOError, OSError):
@@ -685,9 +2363,14 @@ class Server:
 
     def command_start(self, update: bool = False) -> int:
         self.write_intent(SERVING)
-        os.chdir(self.server_dir)
+        self.display.ensure()
+        self.wait_for_mod_prefetch()
+        if self.world_staged:
+            self.restage_world()
+            self.start_world_sync()
         options = 'update' if update else ''
-        return os.system(f'nohup xvfb-run -a -n {self.number} bash start {options} >start.log 2>&1 &')
+        # Not changing the working directory of this process, bulk operations run in threads
+        return os.system(f'cd {self.server_dir} && nohup bash start {options} >start.log 2>&1 &')
 
     def command_stop(self) -> int:
         if not self.exists:
@@ -706,6 +2389,10 @@ class Server:
             return 0
 
         self.write_intent(STOPPED)
+
+        # The processes must be scanned again after each kill
+        self.pids = None
+
         for _ in range(50):
             pid = self.pid
             if not pid:
@@ -731,6 +2418,119 @@ class Server:
         print(self.status)
         return 0
 
+    def command_sync(self, *, period: int) -> int:
+        if not self.world_staged:
+            print(f'World of server {self.number:02d} is not staged in tmpfs', file=sys.stderr)
+            return 1
+
+        with filelock.FileLock(self.world_sync_lock_path):
+            if self.world_sync_pid is not None:
+                print(f'World of server {self.number:02d} is synced by another process already', file=sys.stderr)
+                return 1
+            with open(self.world_sync_pid_path, 'wt') as f:
+                f.write(str(os.getpid()))
+
+        try:
+            with open(self.world_sync_log_path, 'at') as output:
+                sys.stdout = output
+                sys.stderr = output
+                self.sync_world_periodically(period)
+        finally:
+            remove_pid_file(self.world_sync_pid_path, os.getpid())
+
+        return 0
+
+    def sync_world_periodically(self, period: float):
+        while 1:
+            # The final flush must come after the game has exited, since it saves the world on shutdown
+            final = self.intent != SERVING and not self.running
+
+            # noinspection PyBroadException
+            try:
+                self.sync_world(settle=not final)
+            except KeyboardInterrupt:
+                print(f'{timestamp()}: World sync terminated (SIGTERM)')
+                break
+            except Exception:
+                print(f'{timestamp()} ERROR: {traceback.format_exc()}', end='')
+            finally:
+                sys.stdout.flush()
+
+            if final:
+                # The server may have been started again during the final flush, its start found
+                # this process still running, so it must keep syncing instead of exiting
+                with filelock.FileLock(self.world_sync_lock_path):
+                    if self.intent != SERVING:
+                        remove_pid_file(self.world_sync_pid_path, os.getpid())
+                        print(f'{timestamp()}: World sync finished, server is stopped')
+                        break
+                print(f'{timestamp()}: Server started again during the final flush, continuing the world sync')
+
+            sleep(period)
+
+    def sync_world(self, settle: bool = False):
+        src = self.staged_world_dir
+        if settle:
+            newest = max((os.stat(os.path.join(dirpath, fn)).st_mtime
+                          for dirpath, dirnames, filenames in os.walk(src)
+                          for fn in filenames), default=0.0)
+            if time() - newest < WORLD_SYNC_SETTLE_TIME:
+                return
+
+        started = time()
+        count = sync_tree(src, self.persistent_world_dir)
+        if count:
+            print(f'{timestamp()}: Written back {count} world file changes in {time() - started:.3f}s')
+
+    def start_world_sync(self):
+        # Serialized with the decision of a stopping sync process to exit, see sync_world_periodically
+        with filelock.FileLock(self.world_sync_lock_path):
+            if self.world_sync_pid is not None:
+                return
+            os.system(f'nohup {sys.executable} {os.path.abspath(__file__)} sync {self.number} >/dev/null 2>&1 &')
+
+    def stop_world_sync(self):
+        pid = self.world_sync_pid
+        if pid is None:
+            return
+
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except (OSError, IOError):
+            pass
+
+    def stage_world(self):
+        world_size = tree_size(self.world_dir)
+        os.makedirs(WORLD_STAGING_DIR, mode=0o700, exist_ok=True)
+        free = shutil.disk_usage(WORLD_STAGING_DIR).free
+        if free < world_size * WORLD_STAGING_HEADROOM:
+            print(f'{timestamp()} WARNING: Not enough space in {WORLD_STAGING_DIR} to stage a world of {world_size} bytes, keeping it on the disk', file=sys.stderr)
+            return
+
+        os.rename(self.world_dir, self.persistent_world_dir)
+        self.restage_world()
+
+    def restage_world(self):
+        """Populates the tmpfs staging area from the persistent copy if missing (after a reboot)"""
+        staged_world_dir = self.staged_world_dir
+        if not os.path.isdir(staged_world_dir):
+            if os.path.exists(staged_world_dir + '.tmp'):
+                shutil.rmtree(staged_world_dir + '.tmp')
+            shutil.copytree(self.persistent_world_dir, staged_world_dir + '.tmp')
+            os.rename(staged_world_dir + '.tmp', staged_world_dir)
+
+        if not os.path.islink(self.world_dir):
+            os.symlink(staged_world_dir, self.world_dir, target_is_directory=True)
+
+    def unstage_world(self):
+        """Final flush and move of the world back to persistent storage before archiving"""
+        self.stop_world_sync()
+        if os.path.isdir(self.staged_world_dir):
+            self.sync_world()
+        os.unlink(self.world_dir)
+        os.rename(self.persistent_world_dir, self.world_dir)
+        shutil.rmtree(self.staged_world_dir, ignore_errors=True)
+
     def command_keepalive(self, *, stop: bool, period: int) -> int:
         self.stop_keepalive()
         if stop:
@@ -781,8 +2581,13 @@ class Server:
         if self.intent != SERVING:
             return
 
+        if self.display.ensure():
+            print(f'{timestamp()}: Respawned display {self.display.name}')
+
         if self.working:
             self.set_priority()
+            if self.world_staged:
+                self.start_world_sync()
             return
 
         result = self.keepalive_action()
@@ -816,25 +2621,68 @@ class Server:
 
     # Helpers
 
-    def command_recreate(self, *, initiator='cmdline') -> int:
-        print(f'{timestamp()}: Recreating {self.number:02d}')
+    def command_recreate(self, *, initiator='cmdline', blue_green: bool = False) -> int:
+        if blue_green:
+            return self.recreate_blue_green(initiator)
 
-        self.command_kill()
+        print(f'{timestamp()}: Recreating {self.number:02d}')
 
         zip_path = self.zip_path
+        suffix = self.server_name_suffix
+        tmpfs = self.world_staged
 
-        path = os.path.join(self.server_dir, 'server_name_suffix')
-        if os.path.isfile(path):
-            with open(path, 'rt') as f:
-                suffix = f.read().strip()
-        else:
-            suffix = ''
+        # Checked before the live server is killed, a broken ZIP must not leave the slot empty
+        errors, warnings = validate_world(zip_path)
+        if errors:
+            raise ValueError(f'Invalid world {zip_path}:\n' + '\n'.join(errors))
+
+        self.command_kill()
 
         print(f'{timestamp()}: Archiving logs and world files of {self.number:02d}')
         self.command_archive(initiator=initiator)
 
         print(f'{timestamp()}: Recreating {self.number:02d} from {zip_path}')
-        self.command_create(zip_path, suffix)
+        self.command_create(zip_path, suffix, tmpfs)
+
+        print(f'{timestamp()}: Starting {self.number:02d}')
+        result = self.command_start()
+        if result:
+            return result
+
+        print(f'{timestamp()}: Recreated and started {self.number:02d}')
+        return 0
+
+    def recreate_blue_green(self, initiator: str) -> int:
+        """Recreates the server into a shadow slot while the old one keeps serving
+
+        The downtime is only the kill, the folder swap and the startup of Torch.
+
+        """
+        zip_path = self.zip_path
+        suffix = self.server_name_suffix
+        tmpfs = self.world_staged
+
+        shadow = Server(self.number, shadow=True)
+        shadow.discard()
+
+        print(f'{timestamp()}: Preparing {self.number:02d} from {zip_path} in shadow slot {shadow.server_dir}')
+        try:
+            shadow.command_create(zip_path, suffix)
+        except Exception:
+            shadow.discard()
+            raise
+
+        print(f'{timestamp()}: Stopping and archiving {self.number:02d}')
+        self.command_kill()
+        if self.exists:
+            self.command_archive(initiator=initiator)
+
+        print(f'{timestamp()}: Swapping in shadow slot of {self.number:02d}')
+        os.rename(shadow.server_dir, self.server_dir)
+        os.rename(shadow.wine_dir, self.wine_dir)
+
+        if tmpfs:
+            self.stage_world()
 
         print(f'{timestamp()}: Starting {self.number:02d}')
         result = self.command_start()
@@ -844,15 +2692,57 @@ class Server:
         print(f'{timestamp()}: Recreated and started {self.number:02d}')
         return 0
 
+    def discard(self):
+        for dir_path in (self.server_dir, self.wine_dir):
+            if os.path.isdir(dir_path):
+                shutil.rmtree(dir_path)
+
     def command_upgrade(self) -> int:
         if self.running:
             print('Cannot upgrade, server is running', file=sys.stderr)
             return 1
 
-        copy_tree(TEMPLATE_SERVER_DIR, self.server_dir)
+        started = time()
+        counts = upgrade_tree(TEMPLATE_SERVER_DIR, self.server_dir, self.template_files)
+        self.write_template_files()
+
+        summary = ', '.join(f'{count} {name}' for name, count in counts.items())
+        print(f'{timestamp()}: Upgraded {self.number:02d} in {time() - started:.3f}s: {summary}')
         return 0
 
-    def clone(self):
+    @classmethod
+    def command_upgrade_all(cls, *, jobs: int) -> int:
+        """Upgrades all stopped servers concurrently, skipping the ones locked by other commands"""
+
+        def upgrade(server: Server) -> int:
+            try:
+                with filelock.FileLock(server.file_lock_path, timeout=0):
+                    return server.command_upgrade()
+            except filelock.Timeout:
+                print('Skipped, it is locked by another command')
+                return 1
+
+        pids = find_torch_pids()
+        servers = [cls(number, pids=pids) for number in allocated_numbers()]
+        servers = [server for server in servers if server.exists and not server.running]
+        return run_bulk(servers, upgrade, jobs)
+
+    @property
+    def template_files_path(self) -> str:
+        return os.path.join(self.server_dir, 'template_files.json')
+
+    @property
+    def template_files(self) -> Optional[List[str]]:
+        try:
+            with open(self.template_files_path, 'rt', encoding='utf8') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def write_template_files(self):
+        write_json_atomically(self.template_files_path, list_template_files(TEMPLATE_SERVER_DIR))
+
+    def clone_wine(self):
         clone(TEMPLATE_WINE_DIR, self.wine_dir)
 
         change_registry(
@@ -866,12 +2756,14 @@ class Server:
             UserId="{%s}" % guid().upper(),
         )
 
-        clone(TEMPLATE_SERVER_DIR, self.server_dir)
-
-        relink_my_folders(self.server_dir, self.wine_dir)
+        relink_my_folders(self.live_server_dir, self.wine_dir)
 
         change_wine_server_id(self.wine_dir)
 
+    def clone_server(self):
+        clone(TEMPLATE_SERVER_DIR, self.server_dir)
+        self.write_template_files()
+
     def load_world_json(self):
         with open(self.world_json_path, 'rt', encoding='utf8') as f:
             self.world = json.load(f)
@@ -880,25 +2772,107 @@ class Server:
         cache = content_cache_dir(self.number)
         if not os.path.isdir(cache):
             os.makedirs(cache, exist_ok=True)
+        share_mods(self.number)
         if not os.path.isdir(self.instance_dir):
             raise IOError('Missing Instance folder: ' + self.instance_dir)
         link = os.path.join(self.instance_dir, 'content')
         os.symlink(cache, link, target_is_directory=True)
 
+    @property
+    def world_mods(self) -> List[str]:
+        return read_world_mods(os.path.join(self.world_dir, 'Sandbox.sbc'))
+
+    @property
+    def mod_prefetch_pid_path(self):
+        return os.path.expanduser(f'~/.local/prefetch-{self.number}.pid')
+
+    @property
+    def mod_prefetch_log_path(self):
+        return os.path.expanduser(f'~/logs/prefetch-{self.number}.{datetime.date.today().isoformat()}.log')
+
+    @property
+    def mod_prefetch_pid(self) -> Optional[int]:
+        process = self.mod_prefetch_process
+        if process is not None:
+            if process.poll() is None:
+                return process.pid
+            self.mod_prefetch_process = None
+            remove_pid_file(self.mod_prefetch_pid_path, process.pid)
+            return None
+
+        try:
+            with open(self.mod_prefetch_pid_path, 'rt') as f:
+                pid = int(f.read())
+        except (IOError, OSError, ValueError):
+            return None
+        return pid if is_script_process(pid, 'prefetch', str(self.number)) else None
+
+    def start_mod_prefetch(self):
+        item_ids = self.world_mods
+        if not item_ids:
+            return
+        command = [sys.executable, os.path.abspath(__file__), 'prefetch', str(self.number)] + item_ids
+        with open(self.mod_prefetch_log_path, 'at') as log:
+            process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+        self.mod_prefetch_process = process
+        with open(self.mod_prefetch_pid_path, 'wt') as f:
+            f.write(str(process.pid))
+
+    def wait_for_mod_prefetch(self):
+        started = time()
+        while self.mod_prefetch_pid is not None:
+            if time() - started > MOD_PREFETCH_TIMEOUT:
+                print(f'{timestamp()} WARNING: Starting {self.number:02d} without waiting for the mod prefetch to finish', file=sys.stderr)
+                return
+            sleep(1)
+
+    def command_prefetch(self, *, item_ids: List[str]) -> int:
+        """Downloads missing or outdated workshop items of the world into the mod cache of the server"""
+        try:
+            return self.prefetch_mods(item_ids)
+        finally:
+            remove_pid_file(self.mod_prefetch_pid_path, os.getpid())
+
+    def prefetch_mods(self, item_ids: List[str]) -> int:
+        started = time()
+        share_mods(self.number)
+
+        downloaded = download_workshop_items(item_ids, MOD_PREFETCH_TIMEOUT)
+
+        view_dir = mod_view_dir(self.number)
+        updated = 0
+        for item_id, path in downloaded.items():
+            item_dir = os.path.join(view_dir, item_id)
+            if os.path.isdir(item_dir) and same_tree(path, item_dir):
+                continue
+            # Copied, because steamcmd may update its own copy in place
+            tmp_dir = item_dir + '.tmp'
+            if os.path.isdir(tmp_dir):
+                shutil.rmtree(tmp_dir)
+            shutil.copytree(path, tmp_dir)
+            if os.path.isdir(item_dir):
+                shutil.rmtree(item_dir)
+            os.rename(tmp_dir, item_dir)
+            updated += 1
+
+        # Placed by renaming the complete copies, nothing is writing them
+        share_mods(self.number, complete=downloaded)
+
+        failed = sorted(set(item_ids) - set(downloaded))
+        print(f'{timestamp()}: Prefetched {len(item_ids)} mods of {self.number:02d} in {time() - started:.3f}s, updated {updated}, failed {len(failed)} {" ".join(failed)}')
+        return 1 if failed else 0
+
     def write_intent(self, intent):
-        with open(os.path.join(self.server_dir, 'intent'), 'wt') as f:
-            f.write(intent)
+        self.update_state(intent=intent)
 
     def write_server_name_suffix(self, suffix):
-        with open(os.path.join(self.server_dir, 'server_name_suffix'), 'wt') as f:
-            f.write(suffix)
+        self.update_state(server_name_suffix=suffix)
 
     def checksum_world(self):
         stdout, stderr = subprocess.Popen([SHA1SUM, 'Sandbox.sbc', 'Sandbox_config.sbc', 'SANDBOX_0_0_0_.sbs'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=1024, cwd=self.world_dir).communicate()
         assert not stderr, 'sha1sum failed: ' + stderr.decode('utf8')
         sha256 = hashlib.sha256(stdout)
-        with open(os.path.join(self.world_dir, 'checksum.txt'), 'wt') as f:
-            f.write(sha256.hexdigest())
+        self.update_state(checksum=sha256.hexdigest())
 
     def cache_binary_world_file(self):
         checksum = self.world_checksum
@@ -932,8 +2906,7 @@ class Server:
         shutil.copy(sbsb5_cache_path, sbsb5_path)
 
     def write_zip_path(self, world_zip_path):
-        with open(os.path.join(self.server_dir, 'zip_path'), 'wt') as f:
-            f.write(world_zip_path)
+        self.update_state(zip_path=world_zip_path)
 
     def write_start_script(self):
         path = os.path.join(self.server_dir, 'start')
@@ -946,7 +2919,10 @@ if [ -z "$1" ]; then
     NOUPDATE="-noupdate"
 fi
 
-WINEPREFIX={self.wine_dir} WINEDEBUG=fixme-all wine Torch.Server.exe -nogui $NOUPDATE -ticktimeout 60 -autostart -instancepath {self.server_dir}/Instance -instancename "{self.server_name}"
+export DISPLAY={self.display.name}
+export XAUTHORITY={self.display.auth_path}
+
+WINEPREFIX={self.live_wine_dir} WINEDEBUG=fixme-all wine Torch.Server.exe -nogui $NOUPDATE -ticktimeout 60 -autostart -instancepath {self.live_server_dir}/Instance -instancename "{self.server_name}"
 ''')
 
         os.chmod(path, 0o755)
@@ -956,10 +2932,11 @@ WINEPREFIX={self.wine_dir} WINEDEBUG=fixme-all wine Torch.Server.exe -nogui $NOU
             self.extract_plugin(name)
 
     def extract_plugin(self, name: str):
-        zip_path = os.path.join(PLUGINS_DIR, name + '.zip')
+        entry = catalog_plugin(name)
         plugin_dir = os.path.join(self.plugins_dir, name)
         os.mkdir(plugin_dir)
-        unzip(plugin_dir, zip_path)
+        link_tree(os.path.join(PLUGIN_CACHE_DIR, entry['sha256']), plugin_dir)
+        self.plugin_guids[name] = entry['guid']
 
     def configure_plugin(self):
         config = '''<?xml version="1.0" encoding="utf-8"?>
@@ -978,19 +2955,14 @@ WINEPREFIX={self.wine_dir} WINEDEBUG=fixme-all wine Torch.Server.exe -nogui $NOU
 
     def iter_plugin_guids(self):
         for plugin in os.listdir(self.plugins_dir):
+            if plugin in self.plugin_guids:
+                if self.plugin_guids[plugin] is not None:
+                    yield self.plugin_guids[plugin]
+                continue
             manifest_path = os.path.join(self.plugins_dir, plugin, 'manifest.xml')
             if not os.path.exists(manifest_path):
                 continue
-            with open(manifest_path, 'rt') as f:
-                for line in f:
-                    for m in RX_GUID_ELEMENT.finditer(line):
-                        yield m.group(1)
-                        break
-                    else:
-                        continue
-                    break
-                else:
-                    raise ValueError(f'No <Guid> found in {manifest_path}')
+            yield read_plugin_manifest(manifest_path)[0]
 
     def configure_torch(self):
         config_path = os.path.join(self.server_dir, 'Torch.cfg')
@@ -1006,7 +2978,7 @@ WINEPREFIX={self.wine_dir} WINEDEBUG=fixme-all wine Torch.Server.exe -nogui $NOU
         edit(replace_instance_path, config_path)
 
     def configure_dedicated_server(self, server_name_suffix: str) -> None:
-        admin_port = 9000 + self.number
+        admin_port = self.admin_port
 
         server_name = ('%s %s' % (self.server_name, server_name_suffix)).rstrip()
 
@@ -1026,23 +2998,32 @@ WINEPREFIX={self.wine_dir} WINEDEBUG=fixme-all wine Torch.Server.exe -nogui $NOU
         if not os.path.isfile(self.world_json_path):
             raise IOError('Invalid world archive (missing world.json file): ' + world_zip_path)
 
+    @property
+    def asteroids(self) -> List[str]:
+        """Storage names of the asteroids referenced by the world, cached by world checksum"""
+        checksum = self.world_checksum
+        cache_path = os.path.join(ASTEROID_LIST_CACHE_DIR, f'{checksum}.json') if checksum else None
+        if cache_path is not None and os.path.exists(cache_path):
+            with open(cache_path, 'rt') as f:
+                return json.load(f)
+
+        asteroids = scan_file(os.path.join(self.world_dir, 'SANDBOX_0_0_0_.sbs'), RX_ASTEROID)
+
+        if cache_path is not None:
+            os.makedirs(ASTEROID_LIST_CACHE_DIR, exist_ok=True)
+            write_json_atomically(cache_path, asteroids)
+
+        return asteroids
+
     def deploy_asteroids(self):
         world_dir = os.path.join(self.instance_dir, 'Saves', 'World')
 
-        asteroids = []
-        sbs_path = os.path.join(world_dir, 'SANDBOX_0_0_0_.sbs')
-        with open(sbs_path, 'rt') as f:
-            for line in f:
-                m = RX_ASTEROID.match(line.strip())
-                if m is not None:
-                    asteroids.append(m.group(1))
-
-        for storage_name in asteroids:
+        for storage_name in self.asteroids:
             filename = storage_name + '.vx2'
             src_path = os.path.join(ASTEROIDS_DIR, filename)
             dst_path = os.path.join(world_dir, filename)
             if not os.path.exists(dst_path):
-                shutil.copy(src_path, dst_path)
+                materialize_file(src_path, dst_path)
 
     def set_priority(self):
         process = self.process
@@ -1061,6 +3042,46 @@ WINEPREFIX={self.wine_dir} WINEDEBUG=fixme-all wine Torch.Server.exe -nogui $NOU
         self.process.nice(nice_level)
 
 
+def run_bulk(servers: List[Server], run, jobs: int) -> int:
+    """Runs a command on multiple servers in parallel, prints a result table"""
+    output = ThreadOutput(sys.stdout)
+    errors = ThreadOutput(sys.stderr)
+    sys.stdout = output
+    sys.stderr = errors
+
+    def run_one(server: Server):
+        # Warnings printed to the standard error go into the result of the server as well
+        buffer = io.StringIO()
+        output.capture(buffer)
+        errors.capture(buffer)
+        started = time()
+        # noinspection PyBroadException
+        try:
+            result = run(server)
+            outcome = 'OK' if not result else f'FAILED({result})'
+        except Exception as e:
+            result = 1
+            outcome = 'ERROR'
+            print(f'[{e.__class__.__name__}] {e}')
+        finally:
+            output.capture(None)
+            errors.capture(None)
+        message = ' | '.join(line for line in buffer.getvalue().splitlines() if line.strip())
+        return server.number, result, outcome, time() - started, message
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            rows = list(executor.map(run_one, servers))
+    finally:
+        sys.stdout = output.default
+        sys.stderr = errors.default
+
+    for number, result, outcome, duration, message in rows:
+        print(f'{number:02d} {outcome:<10} {duration:8.3f}s {message}')
+
+    return 1 if any(row[1] for row in rows) else 0
+
+
 def main():
     parser = argparse.ArgumentParser()
 
@@ -1070,6 +3091,10 @@ def main():
         parser.print_usage(sys.stderr)
         sys.exit(1)
 
+    def add_server_selector(subparser, help='Server number'):
+        subparser.add_argument('number', type=str, help=f'{help}; or a comma separated list of numbers, ranges like 10-20, all, status=FAILED or zip=moon-ring.zip')
+        subparser.add_argument('-j', '--jobs', type=int, default=BULK_PARALLELISM, help='Number of servers to process in parallel')
+
     subparsers = parser.add_subparsers(
         title='commands',
         description='server management command',
@@ -1078,63 +3103,115 @@ def main():
     subparser = subparsers.add_parser('list', description='List servers and their status')
     subparser.set_defaults(command=Server.command_list)
 
+    subparser = subparsers.add_parser('displays', description='Checks the shared Xvfb display pool and respawns dead displays')
+    subparser.set_defaults(command=Display.command_displays)
+    subparser.add_argument('-s', '--stop', action='store_true', default=False, help='Stops all displays of the pool instead')
+
+    subparser = subparsers.add_parser('plugins', description='Refreshes and lists the catalog of plugin ZIPs, cleans up the extracted plugin cache')
+    subparser.set_defaults(command=command_plugins)
+
+    subparser = subparsers.add_parser('mods', description='Shares the downloaded workshop mods of all servers via the host-wide mod store')
+    subparser.set_defaults(command=command_mods)
+
+    subparser = subparsers.add_parser('validate', description='Validates a world ZIP against the local plugins, asteroids and mods')
+    subparser.set_defaults(command=command_validate)
+    subparser.add_argument('world', type=str, help='Path of the archive (ZIP) file to validate')
+
+    subparser = subparsers.add_parser('allocate', description='Prints the next free server number')
+    subparser.set_defaults(command=command_allocate)
+
     subparser = subparsers.add_parser('create', description='Creates a Torch server (does not start it)')
     subparser.set_defaults(command=Server.command_create)
-    subparser.add_argument('number', type=int, help='Server number 01..99, port number is 27000 + server number')
+    add_server_selector(subparser, 'Server number, port number is 27000 + server number by default')
     subparser.add_argument('world', type=str, help='Path of the archive (ZIP) file to load the world from')
     subparser.add_argument('-s', '--suffix', type=str, default='', help='Suffix to append to the server name')
+    subparser.add_argument('-t', '--tmpfs', action='store_true', default=False, help=f'Stages the world in {WORLD_STAGING_DIR} with periodic write-back to the disk')
 
     subparser = subparsers.add_parser('archive', description='Archives a stopped Torch server (frees up the server number)')
     subparser.set_defaults(command=Server.command_archive)
-    subparser.add_argument('number', type=int, help='Server number 01..99')
+    add_server_selector(subparser)
     subparser.add_argument('-f', '--full', action='store_true', default=False, help='Archives the full dsNN folder, not just the world and the logs')
+    subparser.add_argument('-w', '--wait', action='store_true', default=False, help='Waits for the archive to be finished instead of leaving it to the background archiver')
+
+    subparser = subparsers.add_parser('archiver', description='Background process finishing staged archives at idle priority (started automatically)')
+    subparser.set_defaults(command=command_archiver)
+    subparser.add_argument('names', type=str, nargs='*', help='Names of the staged archives to finish, all of them by default')
+
+    subparser = subparsers.add_parser('archives', description='Lists archives from the archive store index')
+    subparser.set_defaults(command=command_archives)
+    subparser.add_argument('-n', '--server', type=int, default=None, help='Lists only the archives of this server number')
+
+    subparser = subparsers.add_parser('restore', description='Restores an archive from the archive store into a new folder')
+    subparser.set_defaults(command=command_restore)
+    subparser.add_argument('archive', type=str, help='Archive as listed by the archives command, like ds16/20210206-101010_cmdline_world_logs')
+    subparser.add_argument('target', type=str, help='Folder to restore the archive into, must not exist')
+
+    subparser = subparsers.add_parser('prune', description='Enforces the retention policy on the archive store')
+    subparser.set_defaults(command=command_prune)
+    subparser.add_argument('-l', '--keep-last', type=int, default=ARCHIVE_KEEP_LAST, help='Number of the most recent archives to keep per server')
+    subparser.add_argument('-d', '--keep-daily', type=int, default=ARCHIVE_KEEP_DAILY_DAYS, help='Keeps the last archive of each day for this many days')
 
     subparser = subparsers.add_parser('destroy', description='Kills and deletes a Torch server without archiving')
     subparser.set_defaults(command=Server.command_destroy)
-    subparser.add_argument('number', type=int, help='Server number 01..99')
+    add_server_selector(subparser)
 
     subparser = subparsers.add_parser('start', description='Starts a Torch server, does nothing if already running')
     subparser.set_defaults(command=Server.command_start)
-    subparser.add_argument('number', type=int, help='Server number 01..99')
+    add_server_selector(subparser)
     subparser.add_argument('-u', '--update', action='store_true', default=False, help='Requests Dedicated Server (game) update on startup')
 
     subparser = subparsers.add_parser('stop', description='Stops a Torch server, does nothing if not running currently')
     subparser.set_defaults(command=Server.command_stop)
-    subparser.add_argument('number', type=int, help='Server number 01..99')
+    add_server_selector(subparser)
 
     subparser = subparsers.add_parser('kill', description='Kills a Torch server, does nothing if not running currently')
     subparser.set_defaults(command=Server.command_kill)
-    subparser.add_argument('number', type=int, help='Server number 01..99')
+    add_server_selector(subparser)
 
     subparser = subparsers.add_parser('pid', description='Prints the PID of the Torch server process if running, nothing otherwise')
     subparser.set_defaults(command=Server.command_pid)
-    subparser.add_argument('number', type=int, help='Server number 01..99')
+    add_server_selector(subparser)
 
     subparser = subparsers.add_parser('check', description='Checks whether a game server is working (starting on serving requests)')
     subparser.set_defaults(command=Server.command_check)
-    subparser.add_argument('number', type=int, help='Server number 01..99')
+    add_server_selector(subparser)
 
     subparser = subparsers.add_parser('status', description='Prints the status of a game server or nothing if it does not exist')
     subparser.set_defaults(command=Server.command_status)
-    subparser.add_argument('number', type=int, help='Server number 01..99')
+    add_server_selector(subparser)
 
     subparser = subparsers.add_parser('keepalive', description='Background process to keep the server alive by restarting or recreating it')
     subparser.set_defaults(command=Server.command_keepalive)
-    subparser.add_argument('number', type=int, help='Server number 01..99')
+    subparser.add_argument('number', type=int, help='Server number')
     subparser.add_argument('-s', '--stop', action='store_true', default=False, help='Stops a running keepalive rather than starting one')
     subparser.add_argument('-p', '--period', type=int, default=10, help='Period of repeated checks [seconds]')
 
+    subparser = subparsers.add_parser('sync', description='Background process writing back the tmpfs staged world to the disk (started automatically)')
+    subparser.set_defaults(command=Server.command_sync)
+    subparser.add_argument('number', type=int, help='Server number')
+    subparser.add_argument('-p', '--period', type=int, default=60, help='Period of write-backs [seconds]')
+
+    subparser = subparsers.add_parser('prefetch', description='Downloads missing or outdated workshop mods into the mod cache of a server (started by create)')
+    subparser.set_defaults(command=Server.command_prefetch)
+    subparser.add_argument('number', type=int, help='Server number')
+    subparser.add_argument('item_ids', type=str, nargs='+', help='Workshop IDs of the mods')
+
     subparser = subparsers.add_parser('recreate', description='Recreates and starts an existing Torch server')
     subparser.set_defaults(command=Server.command_recreate)
-    subparser.add_argument('number', type=int, help='Server number 01..99, port number is 27000 + server number')
+    add_server_selector(subparser, 'Server number, port number is 27000 + server number by default')
+    subparser.add_argument('-b', '--blue-green', action='store_true', default=False, help='Prepares the new instance in a shadow slot while the old one keeps serving')
 
     subparser = subparsers.add_parser('restart', description='Stops and restarts an existing Torch server')
     subparser.set_defaults(command=Server.command_restart)
-    subparser.add_argument('number', type=int, help='Server number 01..99, port number is 27000 + server number')
+    add_server_selector(subparser, 'Server number, port number is 27000 + server number by default')
 
     subparser = subparsers.add_parser('upgrade', description='Upgrades Torch from the ds00 template (must be stopped)')
     subparser.set_defaults(command=Server.command_upgrade)
-    subparser.add_argument('number', type=int, help='Server number 01..99')
+    add_server_selector(subparser)
+
+    subparser = subparsers.add_parser('upgrade-all', description='Upgrades all stopped servers from the ds00 template concurrently')
+    subparser.set_defaults(command=Server.command_upgrade_all)
+    subparser.add_argument('-j', '--jobs', type=int, default=UPGRADE_PARALLELISM, help='Number of servers to upgrade in parallel')
 
     argcomplete.autocomplete(parser)
 
@@ -1146,27 +3223,80 @@ def main():
 
     command = args.command
 
-    if 'number' in args:
-        number = args.number
-        if number < 1 or number > 99:
+    if command is Server.command_keepalive or command is Server.command_sync or command is Server.command_prefetch:
+        if not is_valid_number(args.number):
             fail(f'Invalid server number: {args.number}')
 
-        server = Server(number)
-
-        if command is Server.command_create:
-            with filelock.FileLock(get_file_lock_path(number)):
-                result = server.command_create(world_zip_path=os.path.abspath(args.world), suffix=args.suffix)
-        elif command is Server.command_start:
-            with filelock.FileLock(get_file_lock_path(number)):
-                result = server.command_start(args.update)
-        elif command is Server.command_start:
-            with filelock.FileLock(get_file_lock_path(number)):
-                result = server.command_archive(full=args.full)
-        elif command is Server.command_keepalive:
+        server = Server(args.number)
+
+        if command is Server.command_keepalive:
             result = server.command_keepalive(stop=args.stop, period=args.period)
+        elif command is Server.command_sync:
+            result = server.command_sync(period=args.period)
+        else:
+            result = server.command_prefetch(item_ids=args.item_ids)
+
+    elif 'number' in args:
+
+        def run(server: Server) -> int:
+            with filelock.FileLock(server.file_lock_path):
+                if command is Server.command_create:
+                    return server.command_create(world_zip_path=os.path.abspath(args.world), suffix=args.suffix, tmpfs=args.tmpfs)
+                if command is Server.command_start:
+                    return server.command_start(args.update)
+                if command is Server.command_archive:
+                    return server.command_archive(full=args.full, wait=args.wait)
+                if command is Server.command_recreate:
+                    return server.command_recreate(blue_green=args.blue_green)
+                return command(server)
+
+        if command is Server.command_create and args.number == 'next':
+            # Allocation and create are serialized, so parallel creates never get the same slot
+            with filelock.FileLock(get_allocation_lock_path()):
+                try:
+                    number = allocate_slot()
+                except ValueError as e:
+                    fail(str(e))
+                    return
+                print(f'Allocated server number {number}')
+                result = run(Server(number))
+
+        elif args.number.isdigit():
+            number = int(args.number)
+            if not is_valid_number(number):
+                fail(f'Invalid server number: {args.number}')
+
+            result = run(Server(number))
+
         else:
-            with filelock.FileLock(get_file_lock_path(number)):
-                result = command(server)
+            try:
+                servers = Server.select(args.number, find_torch_pids())
+            except ValueError as e:
+                fail(str(e))
+                return
+
+            result = run_bulk(servers, run, args.jobs)
+
+    elif command == Display.command_displays:
+        result = command(stop=args.stop)
+
+    elif command == Server.command_upgrade_all:
+        result = command(jobs=args.jobs)
+
+    elif command is command_archiver:
+        result = command(names=args.names)
+
+    elif command is command_archives:
+        result = command(server=args.server)
+
+    elif command is command_restore:
+        result = command(archive=args.archive, target=os.path.abspath(args.target))
+
+    elif command is command_validate:
+        result = command(world=os.path.abspath(args.world))
+
+    elif command is command_prune:
+        result = command(keep_last=args.keep_last, keep_daily=args.keep_daily)
 
     else:
         result = command()
@@ -0,0 +1,218 @@
+#!/usr/bin/python3
+# -*- coding: ascii -*-
+""" Benchmarks the blueprint cleaning engines of blueprint_downloader.py
+
+- Generates a corpus of synthetic blueprints shaped like the real ones (with and without deep projections)
+- Adds the real bp.sbc files given on the command line (files or folders)
+- Cleans each of them with the SAX based BlueprintCleaner and the ProjectionPruner
+- Verifies that the outputs are equivalent (canonical XML) and prints the throughput of both
+- Verifies that both engines reject the same hostile XMLs
+- Verifies that both engines count, trim and reject the same way when enforcing the complexity budget
+
+Exits with a non-zero code if any of the checks fail.
+
+"""
+import argparse
+import io
+import os
+import sys
+from time import perf_counter
+from typing import List, Tuple
+from xml.etree.ElementTree import canonicalize
+
+import blueprint_downloader
+from blueprint_downloader import CHUNK_SIZE, MAX_PROJECTION_DEPTH, ProjectionPruner, SaxCleaningStream
+
+REPEATS = 3
+
+HOSTILE_XMLS = {
+    'entity expansion': b'<?xml version="1.0"?><!DOCTYPE a [<!ENTITY x "xx"><!ENTITY y "&x;&x;">]><a>&y;</a>',
+    'external entity': b'<?xml version="1.0"?><!DOCTYPE a [<!ENTITY x SYSTEM "file:///etc/passwd">]><a>&x;</a>',
+    'undefined entity': b'<?xml version="1.0"?><a>&x;</a>',
+    'truncated': b'<?xml version="1.0"?><a><ProjectedGrids>',
+}
+
+
+def cube_block(index: int, projected: str = '') -> str:
+    block_type = 'MyObjectBuilder_Projector' if projected else 'MyObjectBuilder_CargoContainer'
+    return (
+        f'<MyObjectBuilder_CubeBlock xsi:type="{block_type}">'
+        f'<SubtypeName>LargeBlockSmallContainer</SubtypeName>'
+        f'<EntityId>{100000000000 + index}</EntityId>'
+        f'<Min x="{index % 50}" y="{index // 50 % 50}" z="{index // 2500}" />'
+        f'<ColorMaskHSV x="0.575" y="0" z="0" />'
+        f'<Owner>144115188075855895</Owner><BuiltBy>144115188075855895</BuiltBy><ShareMode>Faction</ShareMode>'
+        f'<ComponentContainer><Components><ComponentData><TypeId>MyInventoryBase</TypeId>'
+        f'<Component xsi:type="MyObjectBuilder_Inventory"><Items><MyObjectBuilder_InventoryItem>'
+        f'<Amount>{index % 7 + 1}</Amount><PhysicalContent xsi:type="MyObjectBuilder_Component"><SubtypeName>SteelPlate</SubtypeName></PhysicalContent>'
+        f'<ItemId>{index}</ItemId></MyObjectBuilder_InventoryItem></Items><nextItemId>1</nextItemId>'
+        f'<Volume>15.625</Volume><Mass>9.223372036854775807</Mass><MaxItemCount>2147483647</MaxItemCount>'
+        f'</Component></ComponentData></Components></ComponentContainer>'
+        f'{projected}'
+        f'</MyObjectBuilder_CubeBlock>\n'
+    )
+
+
+def cube_grid(blocks: int, projection_depth: int, projected_blocks: int, element: str = 'CubeGrid') -> str:
+    """Grid with one projector on each level, projecting the next level down to projection_depth"""
+    projected = ''
+    if projection_depth:
+        projected = '<ProjectedGrids>' + cube_grid(projected_blocks, projection_depth - 1, projected_blocks, 'MyObjectBuilder_CubeGrid') + '</ProjectedGrids>'
+    cube_blocks = ''.join(cube_block(index, projected if index == 0 else '') for index in range(blocks))
+    return (
+        f'<{element}>'
+        '<SubtypeName /><EntityId>98765432101234567</EntityId><PersistentFlags>CastShadows InScene</PersistentFlags>'
+        '<PositionAndOrientation><Position x="0" y="0" z="0" /><Forward x="0" y="0" z="-1" /><Up x="0" y="1" z="0" /></PositionAndOrientation>'
+        '<GridSizeEnum>Large</GridSizeEnum>'
+        f'<CubeBlocks>\n{cube_blocks}</CubeBlocks>'
+        '<DisplayName>Benchmark &amp; Co.</DisplayName>'
+        f'</{element}>'
+    )
+
+
+def blueprint(blocks: int, projection_depth: int = 0, projected_blocks: int = 0, grids: int = 1) -> bytes:
+    return (
+        '<?xml version="1.0"?>\n'
+        '<Definitions xmlns:xsd="http://www.w3.org/2001/XMLSchema" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">\n'
+        '<!-- Generated by blueprint_benchmark.py -->\n'
+        '<ShipBlueprints><ShipBlueprint xsi:type="MyObjectBuilder_ShipBlueprintDefinition">'
+        '<Id Type="MyObjectBuilder_ShipBlueprintDefinition" Subtype="Benchmark" />'
+        f'<CubeGrids>{cube_grid(blocks, projection_depth, projected_blocks) * grids}</CubeGrids>'
+        '</ShipBlueprint></ShipBlueprints>\n'
+        '</Definitions>\n'
+    ).encode('utf8')
+
+
+def synthetic_corpus() -> List[Tuple[str, bytes]]:
+    deep = MAX_PROJECTION_DEPTH + 2
+    return [
+        ('small', blueprint(100)),
+        ('large', blueprint(20000)),
+        (f'projections depth {MAX_PROJECTION_DEPTH}', blueprint(2000, MAX_PROJECTION_DEPTH, 2000)),
+        (f'projections depth {deep}', blueprint(2000, deep, 2000)),
+        (f'projections depth {deep} small projected grids', blueprint(20000, deep, 10)),
+    ]
+
+
+def real_corpus(paths: List[str]) -> List[Tuple[str, bytes]]:
+    corpus = []
+    for path in paths:
+        if os.path.isdir(path):
+            filenames = sorted(
+                os.path.join(dirpath, filename)
+                for dirpath, _, filenames in os.walk(path)
+                for filename in filenames
+                if filename.endswith('.sbc')
+            )
+        else:
+            filenames = [path]
+        for filename in filenames:
+            with open(filename, 'rb') as f:
+                corpus.append((filename, f.read()))
+    return corpus
+
+
+def clean(engine, data: bytes, repeats: int = REPEATS) -> Tuple[bytes, float, dict]:
+    """Returns the cleaned blueprint, the best time of the runs and the statistics collected"""
+    best = float('inf')
+    output = b''
+    stats = {}
+    for _ in range(repeats):
+        out = io.BytesIO()
+        started = perf_counter()
+        stream = engine(out)
+        for offset in range(0, len(data), CHUNK_SIZE):
+            stream.write(data[offset:offset + CHUNK_SIZE])
+        stream.close()
+        best = min(best, perf_counter() - started)
+        output = out.getvalue()
+        stats = stream.budget.as_dict()
+    return output, best, stats
+
+
+def equivalent(a: bytes, b: bytes) -> bool:
+    return canonicalize(a.decode('utf8')) == canonicalize(b.decode('utf8'))
+
+
+def check_security() -> bool:
+    passed = True
+    for name, data in HOSTILE_XMLS.items():
+        for engine in (SaxCleaningStream, ProjectionPruner):
+            try:
+                clean(engine, data, 1)
+            except Exception as e:
+                print(f'{engine.__name__} rejects {name}: [{e.__class__.__name__}] {e}')
+                continue
+            print(f'FAILED: {engine.__name__} accepts {name}')
+            passed = False
+    return passed
+
+
+def set_budget(grids, blocks, pcu, trim_grids):
+    blueprint_downloader.BUDGET_GRIDS = grids
+    blueprint_downloader.BUDGET_BLOCKS = blocks
+    blueprint_downloader.BUDGET_PCU = pcu
+    blueprint_downloader.BUDGET_TRIM_GRIDS = trim_grids
+
+
+def check_budget() -> bool:
+    data = blueprint(50, MAX_PROJECTION_DEPTH + 1, 20, grids=4)
+    cases = [
+        ('trim grids', (2, None, None, True)),
+        ('reject grids', (2, None, None, False)),
+        ('reject blocks', (None, 150, None, True)),
+        ('reject PCU', (None, None, 1000, True)),
+    ]
+    passed = True
+    for name, budget in cases:
+        set_budget(*budget)
+        results = []
+        for engine in (SaxCleaningStream, ProjectionPruner):
+            try:
+                output, _, stats = clean(engine, data, 1)
+                results.append((output, stats))
+            except ValueError as e:
+                results.append((None, str(e)))
+
+        (sax_output, sax_stats), (fast_output, fast_stats) = results
+        same = sax_stats == fast_stats and (sax_output is None) == (fast_output is None)
+        if same and sax_output is not None:
+            same = equivalent(sax_output, fast_output)
+        passed = passed and same
+        print(f'{name}: {"rejected" if fast_output is None else "accepted"} {fast_stats}{"" if same else " FAILED, SAX: " + str(sax_stats)}')
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the blueprint cleaning engines and verifies their outputs are equivalent')
+    parser.add_argument('paths', nargs='*', help='Real bp.sbc files or folders containing them')
+    args = parser.parse_args()
+
+    corpus = synthetic_corpus() + real_corpus(args.paths)
+
+    # The corpus measures the cleaning speed, the budget is checked separately
+    budget = (blueprint_downloader.BUDGET_GRIDS, blueprint_downloader.BUDGET_BLOCKS, blueprint_downloader.BUDGET_PCU, blueprint_downloader.BUDGET_TRIM_GRIDS)
+    set_budget(None, None, None, False)
+
+    passed = True
+    print(f'{"Blueprint":<50} {"Size":>10} {"Output":>10} {"SAX MB/s":>10} {"Fast MB/s":>10} {"Speedup":>8}  Equivalent')
+    for name, data in corpus:
+        sax_output, sax_time, sax_stats = clean(SaxCleaningStream, data)
+        fast_output, fast_time, fast_stats = clean(ProjectionPruner, data)
+        same = equivalent(sax_output, fast_output) and sax_stats == fast_stats
+        passed = passed and same
+        megabytes = len(data) / 1024 ** 2
+        print(f'{name[-50:]:<50} {len(data):>10} {len(fast_output):>10} {megabytes / sax_time:>10.1f} {megabytes / fast_time:>10.1f} {sax_time / fast_time:>7.1f}x  {"yes" if same else "NO"}')
+
+    print()
+    passed = check_security() and passed
+
+    print()
+    passed = check_budget() and passed
+    set_budget(*budget)
+
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == '__main__':
+    main()
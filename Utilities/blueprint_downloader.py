@@ -2,57 +2,142 @@
 # -*- coding: ascii -*-
 """ Downloads blueprints from Steam or direct `bp.sbc` URLs (like Discord file links or GitHub).
 
-- Monitors a folder for download requests (URLs in files)
-- Executes the downloads requested, removes the request files at the same time
-- Puts the downloaded blueprint bp.sbc file into a cache folders with the same filename as the request
-- Periodically cleans old downloads from the cache folder
-- Removes nested blueprints deeper than MAX_PROJECTION_DEPTH
+- Monitors a folder for download requests (URLs in files), using inotify on Linux with a polling fallback
+- Executes the downloads requested in parallel, removes the request files at the same time
+- Keeps the cleaned blueprints in a cache keyed by the Steam Workshop ID or URL, identical requests in progress are downloaded only once
+- Puts the blueprint bp.sbc file into the responses folder with the same filename as the request, hard linked from the cache
+- Cleans old downloads from the cache folder on startup and every CACHE_PRUNE_PERIOD
+- Removes nested blueprints deeper than MAX_PROJECTION_DEPTH, copying the rest of the XML verbatim
+- Enforces the BUDGET_* limits on grids, blocks and estimated PCU, writes these statistics next to the response
+- Applies the transform profile selected by the request (second line), configured in the rules file
 
 It should be executed in the background. Running multiple processes at the same time is supported.
 
 It is used for the racing maps to download cars and the Moon Ring world of the Space Battle server.
 
 """
+import ctypes
+import ctypes.util
+import hashlib
+import http.client
+import io
+import json
 import os
+import re
+import select
 import shutil
+import signal
 import ssl
+import struct
 import sys
+import threading
+import urllib.parse
 import urllib.request
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
 from datetime import datetime
-from subprocess import Popen, PIPE, STDOUT
+from subprocess import Popen, PIPE, STDOUT, DEVNULL, TimeoutExpired
 from time import time, sleep
 from traceback import format_exc
-from typing import Dict
-from xml.sax.saxutils import prepare_input_source, XMLGenerator
+from typing import BinaryIO, Deque, Dict, List, Optional, Set, Tuple
+from xml.parsers import expat
+from xml.sax.saxutils import XMLGenerator
 
-from defusedxml.sax import parse
+from defusedxml.common import EntitiesForbidden, ExternalReferenceForbidden
+from defusedxml.sax import make_parser
 
 WINDOWS = (sys.platform == 'win32')
 
 WORK_FOLDER = os.path.expanduser('~/.cache/blueprint_downloader')
 REQUESTS_FOLDER = os.path.join(WORK_FOLDER, 'requests')
 RESPONSES_FOLDER = os.path.join(WORK_FOLDER, 'responses')
+BLUEPRINT_CACHE_FOLDER = os.path.join(WORK_FOLDER, 'cache')
+RULES_PATH = os.path.join(WORK_FOLDER, 'rules.json')
 
 STEAM_SPACE_ENGINEERS_APP_ID = '244850'
 STEAM_WORKSHOP_URL = 'https://steamcommunity.com/sharedfiles/filedetails/?id='
-STEAMCMD_PATH = r'C:\SEServer\steamcmd\steamcmd.exe' if WINDOWS else '/usr/games/steamcmd'
+STEAM_PUBLISHED_FILE_DETAILS_URL = 'https://api.steampowered.com/ISteamRemoteStorage/GetPublishedFileDetails/v1/'
+STEAMCMD_PATH = os.getenv('STEAMCMD', r'C:\SEServer\steamcmd\steamcmd.exe' if WINDOWS else '/usr/games/steamcmd')
 STEAMCMD_CONTENT_DIR = r'C:\SEServer\steamcmd\steamapps\workshop\content' if WINDOWS else os.path.expanduser('~/.steam/steamapps/workshop/content')
+STEAMCMD_WORKSHOP_ACF_PATH = os.path.join(os.path.dirname(STEAMCMD_CONTENT_DIR), f'appworkshop_{STEAM_SPACE_ENGINEERS_APP_ID}.acf')
 STEAMCMD_TIMEOUT = 60  # seconds
+STEAMCMD_ITEM_TIMEOUT = 15  # seconds, added to the timeout for each additional item in a batch
+STEAMCMD_BATCH_WINDOW = 0.2  # seconds, workshop requests arriving within this time are downloaded together
+STEAMCMD_BATCH_LIMIT = 20  # items
+
+RX_STEAMCMD_DOWNLOADED = re.compile(r'Success\. Downloaded item (\d+) to "(.*?)"')
+RX_STEAMCMD_FAILED = re.compile(r'ERROR! Download item (\d+) failed \((.*?)\)')
+RX_TAG = re.compile(rb'<[^>"\']*(?:(?:"[^"]*"|\'[^\']*\')[^>"\']*)*>')
+RX_PRUNER_TOKEN = re.compile(
+    rb'<(?:!--|!\[CDATA\[|\?'
+    rb'|(/?)(ProjectedGrids|CubeGrid|MyObjectBuilder_CubeGrid)(?=[\s/>])'
+    rb'|MyObjectBuilder_CubeBlock(?=[\s/>])(?:\s+xsi:type="([^"]*)")?)'
+)
+RX_XSI_TYPE = re.compile(rb'\sxsi:type\s*=\s*["\']([^"\']*)')
+SKIPPED_MARKUP = {b'<!--': b'-->', b'<![CDATA[': b']]>', b'<?': b'?>'}
+RX_ELEMENT_NAME = re.compile(r'^[A-Za-z_][\w.\-]*$')
+RX_PROFILE_NAME = re.compile(r'^[\w\-]+$')
+RX_VDF_TOKEN = re.compile(r'"((?:[^"\\]|\\.)*)"|([{}])')
 
 URL_LENGTH_LIMIT = 1000
 DOWNLOAD_SIZE_LIMIT = 10 * 1024 ** 2
+HTTP_TIMEOUT = 30  # seconds
+CHUNK_SIZE = 64 * 1024
+HTTP_MAX_REDIRECTS = 5
+HTTP_IDLE_CONNECTIONS = 2  # kept alive per host
 
 WGET_HEADERS: Dict[str, str] = {
     'User-Agent': 'Wget/1.12 (cygwin)',
     'Accept': '*/*',
 }
 
-POLL_PERIOD = 0.77  # seconds
+# Slow Steam Workshop downloads must not hold up the fast direct URL downloads.
+# The workshop workers only wait for the steamcmd session, which runs a single steamcmd at a time.
+STEAMCMD_WORKERS = STEAMCMD_BATCH_LIMIT
+HTTP_WORKERS = 8
+HTTP_HOST_LIMIT = 2  # parallel downloads from the same host
+
+POLL_PERIOD = 0.77  # seconds, used only if inotify is not available
+WATCH_RESCAN_PERIOD = 60  # seconds, rescans the request folder even without inotify events
 LIFETIME = 3600  # seconds
-CACHE_TIMEOUT = 900  # seconds
+WORKSHOP_CHECK_PERIOD = 900  # seconds, the workshop version of a cached blueprint is checked again after this time
+WORKSHOP_API_TIMEOUT = 10  # seconds
+CACHE_RETENTION = 7 * 86400  # seconds, unused cache entries are removed after this time
+CACHE_PRUNE_PERIOD = 3600  # seconds, the cache folder is cleaned on startup and then after every period
 
 MAX_PROJECTION_DEPTH = 2
 
+# Transform profiles used without a rules file, requests select the profile on their second line
+DEFAULT_PROFILE = 'default'
+DEFAULT_RULES: Dict[str, List[dict]] = {DEFAULT_PROFILE: [{'transform': 'clean'}]}
+
+# Complexity budget of the grids spawned (projections are not counted), None means no limit
+BUDGET_GRIDS = 16
+BUDGET_BLOCKS = 30000
+BUDGET_PCU = 60000
+BUDGET_TRIM_GRIDS = True  # removes the grids over BUDGET_GRIDS instead of rejecting the blueprint
+
+# Rough PCU of the block types, the rest are assumed to be functional blocks of DEFAULT_BLOCK_PCU
+BLOCK_PCU_ESTIMATES: Dict[str, int] = {
+    'MyObjectBuilder_CubeBlock': 1,
+    'MyObjectBuilder_Passage': 1,
+    'MyObjectBuilder_Conveyor': 10,
+    'MyObjectBuilder_ConveyorConnector': 10,
+    'MyObjectBuilder_Wheel': 1,
+    'MyObjectBuilder_InteriorLight': 25,
+    'MyObjectBuilder_Thrust': 15,
+    'MyObjectBuilder_Gyro': 50,
+}
+DEFAULT_BLOCK_PCU = 25
+
+# inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct('iIII')
+
 
 if WINDOWS:
     LIFETIME *= 1000
@@ -79,18 +164,87 @@ def exc(message: str):
     error(message + '\n' + format_exc())
 
 
+class BlueprintBudget:
+    """Counts the grids, blocks and estimated PCU of a blueprint while it is cleaned
+
+    Raises ValueError as soon as the blueprint is over the limits, which default to BUDGET_*
+    and can be overridden by the budget_* keys of the clean transform's rule.
+
+    """
+
+    def __init__(self, rule: Optional[dict] = None):
+        rule = rule or {}
+        self.max_grids = rule.get('budget_grids', BUDGET_GRIDS)
+        self.max_blocks = rule.get('budget_blocks', BUDGET_BLOCKS)
+        self.max_pcu = rule.get('budget_pcu', BUDGET_PCU)
+        self.trim_grids = rule.get('budget_trim_grids', BUDGET_TRIM_GRIDS)
+        self.grids = 0
+        self.blocks = 0
+        self.pcu = 0
+        self.projected_grids = 0
+        self.projected_blocks = 0
+        self.trimmed_grids = 0
+
+    def add_grid(self, projected: bool) -> bool:
+        """Returns True if the grid has to be removed from the blueprint"""
+        if projected:
+            self.projected_grids += 1
+            return False
+
+        if self.max_grids is not None and self.grids >= self.max_grids:
+            if self.trim_grids:
+                self.trimmed_grids += 1
+                return True
+            raise ValueError(f'Blueprint has more than {self.max_grids} grids')
+
+        self.grids += 1
+        return False
+
+    def add_block(self, block_type: str, projected: bool):
+        if projected:
+            self.projected_blocks += 1
+            return
+
+        self.blocks += 1
+        self.pcu += BLOCK_PCU_ESTIMATES.get(block_type, DEFAULT_BLOCK_PCU)
+
+        if self.max_blocks is not None and self.blocks > self.max_blocks:
+            raise ValueError(f'Blueprint has more than {self.max_blocks} blocks')
+        if self.max_pcu is not None and self.pcu > self.max_pcu:
+            raise ValueError(f'Blueprint is estimated to have more than {self.max_pcu} PCU')
+
+    def as_dict(self) -> Dict[str, int]:
+        return dict(
+            grids=self.grids,
+            blocks=self.blocks,
+            pcu=self.pcu,
+            projected_grids=self.projected_grids,
+            projected_blocks=self.projected_blocks,
+            trimmed_grids=self.trimmed_grids,
+        )
+
+
 class BlueprintCleaner(XMLGenerator):
 
-    def __init__(self, out):
+    def __init__(self, out, rule: Optional[dict] = None):
         # Space Engineers is using UTF-8 encoded XMLs without a BOM and supports shorting empty elements
         super().__init__(out, encoding='UTF-8', short_empty_elements=True)
+        self.max_projection_depth = (rule or {}).get('max_projection_depth', MAX_PROJECTION_DEPTH)
+        self.budget = BlueprintBudget(rule)
         self.projection_depth = 0
+        self.trimmed_grid = ''
         self.keep = True
 
     def startElement(self, name, attrs):
         if name == 'ProjectedGrids':
             self.projection_depth += 1
             self.update_decision()
+        elif self.keep and name in ('CubeGrid', 'MyObjectBuilder_CubeGrid'):
+            if self.budget.add_grid(self.projection_depth > 0):
+                self.trimmed_grid = name
+                self.update_decision()
+        elif self.keep and name == 'MyObjectBuilder_CubeBlock':
+            self.budget.add_block(attrs.get('xsi:type', name), self.projection_depth > 0)
 
         if self.keep:
             super().startElement(name, attrs)
@@ -102,9 +256,12 @@ class BlueprintCleaner(XMLGenerator):
         if name == 'ProjectedGrids':
             self.projection_depth -= 1
             self.update_decision()
+        elif name == self.trimmed_grid and not self.projection_depth:
+            self.trimmed_grid = ''
+            self.update_decision()
 
     def update_decision(self):
-        self.keep = self.projection_depth <= MAX_PROJECTION_DEPTH
+        self.keep = self.projection_depth <= self.max_projection_depth and not self.trimmed_grid
 
     def characters(self, content):
         if self.keep:
@@ -119,138 +276,1088 @@ class BlueprintCleaner(XMLGenerator):
             super().processingInstruction(target, data)
 
 
-def download_from_steam_workshop(response_path: str, url: str):
+def skip_markup(data: bytes, m: re.Match) -> int:
+    """Returns the end of the comment, CDATA section or PI matched, -1 if it is not complete yet"""
+    terminator = SKIPPED_MARKUP[m.group(0)]
+    end = data.find(terminator, m.end())
+    return end if end < 0 else end + len(terminator)
+
+
+class ProjectionPruner:
+    """Fast equivalent of BlueprintCleaner, copies the XML verbatim except for the too deep ProjectedGrids
+
+    Expat checks the XML without any element callbacks, forbidding entity declarations
+    and external references the same way defusedxml does. The ProjectedGrids, grid and
+    block tags are located by scanning the bytes, skipping comments, CDATA sections and
+    processing instructions. Only the byte ranges of the too deep projections and the
+    trimmed grids are cut out, everything else is written right from the input buffers.
+
+    Works on ASCII compatible encodings only, see CleaningStream.
+
+    """
+
+    def __init__(self, out: BinaryIO, rule: Optional[dict] = None):
+        self.out = out
+        self.max_projection_depth = (rule or {}).get('max_projection_depth', MAX_PROJECTION_DEPTH)
+        self.parser = expat.ParserCreate()
+        self.parser.EntityDeclHandler = self.forbid_entity_decl
+        self.parser.UnparsedEntityDeclHandler = self.forbid_unparsed_entity_decl
+        self.parser.ExternalEntityRefHandler = self.forbid_external_entity_ref
+        self.budget = BlueprintBudget(rule)
+        self.projection_depth = 0
+        self.trimmed_grid = b''
+        self.cutting = False
+        # Bytes not scanned yet, they start with a tag, comment, CDATA or PI not complete yet
+        self.tail = b''
+
+    @staticmethod
+    def forbid_entity_decl(name, _is_parameter_entity, value, base, sysid, pubid, notation_name):
+        raise EntitiesForbidden(name, value, base, sysid, pubid, notation_name)
+
+    @staticmethod
+    def forbid_unparsed_entity_decl(name, base, sysid, pubid, notation_name):
+        raise EntitiesForbidden(name, None, base, sysid, pubid, notation_name)
+
+    @staticmethod
+    def forbid_external_entity_ref(context, base, sysid, pubid):
+        raise ExternalReferenceForbidden(context, base, sysid, pubid)
+
+    def write(self, chunk: bytes) -> int:
+        self.parser.Parse(chunk, False)
+        self.process(chunk, False)
+        return len(chunk)
+
+    def close(self):
+        self.parser.Parse(b'', True)
+        self.process(b'', True)
+
+    def process(self, chunk: bytes, final: bool):
+        data = self.tail + chunk if self.tail else bytes(chunk)
+
+        # Tags cannot contain <, so all the tags before the last < are complete
+        limit = len(data) if final else data.rfind(b'<')
+        if limit < 0:
+            limit = len(data)
+
+        position = 0
+        scan = 0
+        while True:
+            m = RX_PRUNER_TOKEN.search(data, scan, limit)
+            if m is None:
+                break
+
+            if m.group(0) in SKIPPED_MARKUP:
+                scan = skip_markup(data, m)
+                if scan < 0:
+                    limit = m.start()
+                    break
+                if scan > limit:
+                    # The last < was inside, only character data follows
+                    limit = len(data)
+                continue
+
+            name = m.group(2)
+            if name is None:
+                # Blocks are the most frequent by far, their end tags are not needed
+                if not self.cutting:
+                    block_type = m.group(3)
+                    if block_type is None:
+                        xsi_type = RX_XSI_TYPE.search(data, m.end(), data.find(b'>', m.end()))
+                        block_type = b'MyObjectBuilder_CubeBlock' if xsi_type is None else xsi_type.group(1)
+                    self.budget.add_block(block_type.decode('ascii', 'replace'), self.projection_depth > 0)
+                scan = m.end()
+                continue
+
+            tag = RX_TAG.match(data, m.start())
+            if tag is None:
+                limit = m.start()
+                break
+            scan = tag.end()
+
+            opening = m.group(1) != b'/'
+            closing = not opening or data[scan - 2] == 0x2f  # /
+            removed = False
+
+            if name == b'ProjectedGrids':
+                if opening:
+                    self.projection_depth += 1
+                    removed = self.projection_depth > self.max_projection_depth
+                if closing:
+                    self.projection_depth -= 1
+            elif self.cutting or not opening:
+                pass
+            elif self.budget.add_grid(self.projection_depth > 0):
+                removed = True
+                if not closing:
+                    self.trimmed_grid = name
+
+            if not opening and name == self.trimmed_grid and not self.projection_depth:
+                self.trimmed_grid = b''
+
+            cutting = self.cutting
+            self.cutting = self.projection_depth > self.max_projection_depth or bool(self.trimmed_grid)
+            if removed and not cutting:
+                self.out.write(memoryview(data)[position:m.start()])
+                if not self.cutting:
+                    # Empty element
+                    position = scan
+            elif cutting and not self.cutting:
+                position = scan
+
+        if not self.cutting:
+            self.out.write(memoryview(data)[position:limit])
+        self.tail = data[limit:]
+
+
+class ElementRemover:
+    """Removes the elements of the names listed by the rule along with their contents, copying the rest verbatim
+
+    Expects an XML checked already by the clean transform, which is always the first one.
+
+    """
+
+    def __init__(self, out: BinaryIO, rule: dict):
+        names = rule.get('names')
+        if not isinstance(names, list) or not names or not all(isinstance(name, str) and RX_ELEMENT_NAME.match(name) for name in names):
+            raise ValueError(f'The remove_elements transform needs a list of element names: {rule!r}')
+        self.out = out
+        self.rx_token = re.compile(rb'<(?:!--|!\[CDATA\[|\?|(/?)(' + b'|'.join(re.escape(name.encode('utf8')) for name in names) + rb')(?=[\s/>]))')
+        # Name of the element being removed and the nesting of the same name inside it
+        self.removed = b''
+        self.depth = 0
+        self.tail = b''
+
+    def write(self, chunk: bytes) -> int:
+        self.process(chunk, False)
+        return len(chunk)
+
+    def close(self):
+        self.process(b'', True)
+
+    def process(self, chunk: bytes, final: bool):
+        data = self.tail + chunk if self.tail else bytes(chunk)
+
+        limit = len(data) if final else data.rfind(b'<')
+        if limit < 0:
+            limit = len(data)
+
+        position = 0
+        scan = 0
+        while True:
+            m = self.rx_token.search(data, scan, limit)
+            if m is None:
+                break
+
+            if m.group(0) in SKIPPED_MARKUP:
+                scan = skip_markup(data, m)
+                if scan < 0:
+                    limit = m.start()
+                    break
+                if scan > limit:
+                    limit = len(data)
+                continue
+
+            tag = RX_TAG.match(data, m.start())
+            if tag is None:
+                limit = m.start()
+                break
+            scan = tag.end()
+
+            name = m.group(2)
+            opening = m.group(1) != b'/'
+            closing = not opening or data[scan - 2] == 0x2f  # /
+
+            if self.removed:
+                if name == self.removed:
+                    if opening:
+                        self.depth += 1
+                    if closing:
+                        self.depth -= 1
+                    if not self.depth:
+                        self.removed = b''
+                        position = scan
+            elif opening:
+                self.out.write(memoryview(data)[position:m.start()])
+                if closing:
+                    position = scan
+                else:
+                    self.removed = name
+                    self.depth = 1
+
+        if not self.removed:
+            self.out.write(memoryview(data)[position:limit])
+        self.tail = data[limit:]
+
+
+class RequestWatcher:
+    """Waits for request files written or moved into a folder
+
+    Uses inotify where available, so new requests are picked up right away.
+    Falls back to sleeping for POLL_PERIOD on other platforms and filesystems.
+    """
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        self.fd: Optional[int] = None
+
+        if WINDOWS:
+            return
+
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+            if libc.inotify_add_watch(fd, os.fsencode(folder), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+                errno = ctypes.get_errno()
+                os.close(fd)
+                raise OSError(errno, 'inotify_add_watch failed')
+        except (AttributeError, OSError) as e:
+            warn(f'Watching the request folder with inotify is not available, falling back to polling; [{e.__class__.__name__}] {e}')
+            return
+
+        self.fd = fd
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def wait(self, timeout: float):
+        """Returns once there may be new requests to handle or the timeout has elapsed"""
+        if self.fd is None:
+            sleep(min(timeout, POLL_PERIOD))
+            return
+
+        deadline = time() + timeout
+        while True:
+            remaining = deadline - time()
+            if remaining <= 0:
+                return
+            readable = select.select([self.fd], [], [], remaining)[0]
+            if not readable:
+                return
+            if self.read_events():
+                return
+
+    def read_events(self) -> bool:
+        """Drains the pending inotify events, returns True if any of them may be a new request"""
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return False
+
+        found = False
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(data):
+            _wd, mask, _cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0').decode('utf8', 'replace')
+            offset += length
+            if mask & IN_Q_OVERFLOW or is_request_filename(name):
+                found = True
+        return found
+
+
+def is_request_filename(filename: str) -> bool:
+    # Requests renamed to .taken are claimed by another process already
+    return bool(filename) and not filename.startswith('.') and not filename.endswith('.taken')
+
+
+def list_requests() -> List[str]:
+    return [filename for filename in os.listdir(REQUESTS_FOLDER) if is_request_filename(filename)]
+
+
+def run_steamcmd(item_ids: List[str]) -> Tuple[Set[str], Dict[str, str], str]:
+    """Downloads workshop items in a single steamcmd run
+
+    Returns the IDs of the items downloaded successfully, the failure reasons
+    reported for items by their ID and the output of steamcmd.
+    A hung steamcmd is killed along with its child processes.
+
+    """
+    command = [STEAMCMD_PATH, '+login', 'anonymous']
+    for item_id in item_ids:
+        command.extend(['+workshop_download_item', STEAM_SPACE_ENGINEERS_APP_ID, item_id])
+    command.append('+quit')
+
+    timeout = STEAMCMD_TIMEOUT + STEAMCMD_ITEM_TIMEOUT * (len(item_ids) - 1)
+    process = Popen(command, stdin=DEVNULL, stdout=PIPE, stderr=STDOUT, start_new_session=not WINDOWS)
+    try:
+        output = process.communicate(timeout=timeout)[0]
+    except TimeoutExpired:
+        error(f'Killing steamcmd after {timeout}s')
+        if WINDOWS:
+            process.kill()
+        else:
+            os.killpg(process.pid, signal.SIGKILL)
+        output = process.communicate()[0]
+
+    output = output.decode('utf8', errors='replace')
+    downloaded = {m.group(1) for m in RX_STEAMCMD_DOWNLOADED.finditer(output)}
+    failures = {m.group(1): m.group(2) for m in RX_STEAMCMD_FAILED.finditer(output)}
+    return downloaded, failures, output
+
+
+class SteamcmdSession:
+    """Collects the concurrent workshop downloads into batches run by a single steamcmd process
+
+    Most of the time of a workshop download is spent on steamcmd startup and login,
+    which is paid only once per batch this way.
+
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queued = threading.Condition(self.lock)
+        self.queue: Dict[str, Future] = {}
+        self.thread: Optional[threading.Thread] = None
+
+    def download(self, item_id: str) -> str:
+        """Returns the path of the downloaded bp.sbc file in the steamcmd content folder"""
+        with self.lock:
+            future = self.queue.get(item_id)
+            if future is None:
+                future = self.queue[item_id] = Future()
+                self.queued.notify()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='steamcmd-session', daemon=True)
+                self.thread.start()
+        return future.result()
+
+    def run(self):
+        while True:
+            with self.lock:
+                while not self.queue:
+                    self.queued.wait()
+
+            sleep(STEAMCMD_BATCH_WINDOW)
+
+            with self.lock:
+                batch = dict(list(self.queue.items())[:STEAMCMD_BATCH_LIMIT])
+                for item_id in batch:
+                    del self.queue[item_id]
+
+            # noinspection PyBroadException
+            try:
+                self.run_batch(batch)
+            except Exception as e:
+                exc(f'Failed to run steamcmd for items: {" ".join(batch)}')
+                for future in batch.values():
+                    if not future.done():
+                        future.set_exception(e)
+
+    @staticmethod
+    def run_batch(batch: Dict[str, Future]):
+        info(f'Running steamcmd for {len(batch)} item(s): {" ".join(batch)}')
+        downloaded, failures, output = run_steamcmd(list(batch))
+
+        failed = False
+        for item_id, future in batch.items():
+            steam_cache_path = os.path.join(STEAMCMD_CONTENT_DIR, STEAM_SPACE_ENGINEERS_APP_ID, item_id, 'bp.sbc')
+            if item_id in downloaded and os.path.isfile(steam_cache_path):
+                future.set_result(steam_cache_path)
+                continue
+            failed = True
+            reason = failures.get(item_id, 'no bp.sbc downloaded')
+            future.set_exception(IOError(f'Failed to download blueprint from Steam Workshop: {item_id} ({reason})'))
+
+        if failed:
+            error(f'steamcmd output:\n{output}')
+
+
+steamcmd_session = SteamcmdSession()
+
+
+def parse_vdf(text: str) -> dict:
+    """Parses the Valve KeyValues text format used by the steamcmd .acf files"""
+    root: dict = {}
+    stack = [root]
+    key = None
+    for m in RX_VDF_TOKEN.finditer(text):
+        string, brace = m.groups()
+        if brace == '{':
+            if key is None:
+                raise ValueError('Unexpected { in VDF')
+            child: dict = {}
+            stack[-1][key] = child
+            stack.append(child)
+            key = None
+        elif brace == '}':
+            if len(stack) == 1:
+                raise ValueError('Unexpected } in VDF')
+            stack.pop()
+        elif key is None:
+            key = string
+        else:
+            stack[-1][key] = string
+            key = None
+    return root
+
+
+def read_workshop_item_version(item_id: str) -> Optional[Dict[str, str]]:
+    """Returns the manifest ID and update time of the item as last downloaded by steamcmd"""
+    try:
+        with open(STEAMCMD_WORKSHOP_ACF_PATH, 'rt', encoding='utf8', errors='replace') as f:
+            acf = parse_vdf(f.read())
+    except (IOError, OSError, ValueError) as e:
+        warn(f'Failed to read the steamcmd workshop metadata: {STEAMCMD_WORKSHOP_ACF_PATH}; [{e.__class__.__name__}] {e}')
+        return None
+
+    item = acf.get('AppWorkshop', {}).get('WorkshopItemsInstalled', {}).get(item_id)
+    if not isinstance(item, dict):
+        return None
+    return dict(manifest=item.get('manifest', ''), timeupdated=item.get('timeupdated', ''))
+
+
+def query_workshop_time_updated(item_id: str) -> Optional[str]:
+    """Returns the time the item was last updated on the Steam Workshop, None if it cannot be determined"""
+    data = urllib.parse.urlencode({'itemcount': '1', 'publishedfileids[0]': item_id}).encode('ascii')
+    http_request = urllib.request.Request(STEAM_PUBLISHED_FILE_DETAILS_URL, data=data, method='POST')
+    try:
+        with urllib.request.urlopen(http_request, timeout=WORKSHOP_API_TIMEOUT) as connection:
+            details = json.load(connection)['response']['publishedfiledetails'][0]
+    except (IOError, OSError, ValueError, KeyError, IndexError) as e:
+        warn(f'Failed to query the Steam Workshop for item {item_id}; [{e.__class__.__name__}] {e}')
+        return None
+    time_updated = details.get('time_updated')
+    return None if time_updated is None else str(time_updated)
+
+
+def download_from_steam_workshop(out: BinaryIO, url: str):
     info(f'Downloading from Stream Workshop: {url}')
     started = time()
     blueprint_id = url[len(STEAM_WORKSHOP_URL):]
     if not blueprint_id.isdigit():
         raise ValueError(f'Invalid Steam blueprint ID: {blueprint_id}')
-    process = Popen([STEAMCMD_PATH, '+login', 'anonymous', '+workshop_download_item', STEAM_SPACE_ENGINEERS_APP_ID, blueprint_id, '+quit'], stdout=PIPE, stderr=STDOUT)
-    output = process.communicate(timeout=STEAMCMD_TIMEOUT)[0].decode('ascii')
-    steam_cache_path = os.path.join(STEAMCMD_CONTENT_DIR, STEAM_SPACE_ENGINEERS_APP_ID, blueprint_id, 'bp.sbc')
-    if process.returncode or not os.path.isfile(steam_cache_path):
-        message = f'Failed to download blueprint from Steam Workshop: {blueprint_id}'
-        error(f'{message}\n{output}')
-        raise IOError(message)
-    shutil.copy(steam_cache_path, response_path)
+    steam_cache_path = steamcmd_session.download(blueprint_id)
+    with open(steam_cache_path, 'rb') as f:
+        shutil.copyfileobj(f, out, CHUNK_SIZE)
     duration = time() - started
-    info(f'Downloaded blueprint from Steam Workshop in {duration:.3f}s: {response_path}')
+    info(f'Downloaded blueprint from Steam Workshop in {duration:.3f}s: {url}')
 
 
-def download_from_url(response_path: str, url: str):
-    info(f'Downloading blueprint from URL: {url}')
-    started = time()
-    ctx = ssl.create_default_context()
-    ctx.check_hostname = False
-    ctx.verify_mode = ssl.CERT_NONE
-    http_request = urllib.request.Request(url, method='GET', headers=WGET_HEADERS)
-    with urllib.request.urlopen(http_request, context=ctx) as connection:
-        data = connection.read(DOWNLOAD_SIZE_LIMIT + 1)
-    if len(data) > DOWNLOAD_SIZE_LIMIT:
-        raise IOError(f'Blueprint download is over the size limit of {DOWNLOAD_SIZE_LIMIT} bytes')
-    with open(response_path, 'wb') as f:
-        f.write(data)
-    duration = time() - started
-    info(f'Downloaded blueprint from URL in {duration:.3f}s: {response_path}')
+class HttpFetcher:
+    """Downloads direct URLs into files over kept-alive connections
+
+    Supports conditional requests with the ETag and Last-Modified validators of the previous download.
 
+    """
 
-def download(response_path: str, url: str):
-    steam_workshop = url.startswith(STEAM_WORKSHOP_URL)
+    def __init__(self):
+        self.ssl_context = ssl.create_default_context()
+        self.ssl_context.check_hostname = False
+        self.ssl_context.verify_mode = ssl.CERT_NONE
+        self.lock = threading.Lock()
+        self.idle: Dict[Tuple[str, str], List[http.client.HTTPConnection]] = {}
 
-    if os.path.isfile(response_path):
-        if steam_workshop:
-            age = time() - os.stat(response_path).st_mtime
-            if age < CACHE_TIMEOUT:
-                info(f'Returning cached workshop blueprint: {response_path}')
+    def connect(self, scheme: str, netloc: str) -> Tuple[http.client.HTTPConnection, bool]:
+        """Returns an idle connection to the host if there is any, otherwise a new one and whether it was reused"""
+        with self.lock:
+            connections = self.idle.get((scheme, netloc))
+            if connections:
+                return connections.pop(), True
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc, timeout=HTTP_TIMEOUT, context=self.ssl_context), False
+        return http.client.HTTPConnection(netloc, timeout=HTTP_TIMEOUT), False
+
+    def release(self, scheme: str, netloc: str, connection: http.client.HTTPConnection):
+        with self.lock:
+            connections = self.idle.setdefault((scheme, netloc), [])
+            if len(connections) < HTTP_IDLE_CONNECTIONS:
+                connections.append(connection)
                 return
-            info(f'Removing expired workshop blueprint: {response_path}')
+        connection.close()
 
-        try:
-            os.remove(response_path)
-        except (IOError, OSError) as e:
-            warn(f'Failed to remove blueprint: {response_path}; [{e.__class__.__name__}] {e}')
+    def request(self, url: str, headers: Dict[str, str]) -> Tuple[http.client.HTTPConnection, http.client.HTTPResponse]:
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError(f'Unsupported URL scheme: {url}')
+        target = urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+        while True:
+            connection, reused = self.connect(parts.scheme, parts.netloc)
+            try:
+                connection.request('GET', target, headers=headers)
+                return connection, connection.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                connection.close()
+                # The server may have closed an idle connection meanwhile, only those are retried
+                if not reused:
+                    raise
+            except BaseException:
+                connection.close()
+                raise
 
-    if url.startswith(STEAM_WORKSHOP_URL):
-        download_from_steam_workshop(response_path, url)
+    def fetch(self, url: str, out: BinaryIO, validators: Dict[str, str]) -> Optional[Dict[str, str]]:
+        """Downloads the URL into the out stream
+
+        Returns the validators of the new download, or None if it has not been modified since the validators given.
+
+        """
+        headers = dict(WGET_HEADERS)
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+
+        for _ in range(HTTP_MAX_REDIRECTS + 1):
+            parts = urllib.parse.urlsplit(url)
+            connection, response = self.request(url, headers)
+            try:
+                if response.status in (301, 302, 303, 307, 308):
+                    location = response.getheader('Location')
+                    response.read()
+                    if not location:
+                        raise IOError(f'HTTP {response.status} redirect without a location: {url}')
+                    url = urllib.parse.urljoin(url, location)
+                elif response.status == 304:
+                    response.read()
+                    self.release(parts.scheme, parts.netloc, connection)
+                    return None
+                elif response.status == 200:
+                    self.receive(response, out)
+                    self.release(parts.scheme, parts.netloc, connection)
+                    return dict(etag=response.getheader('ETag', ''), last_modified=response.getheader('Last-Modified', ''))
+                else:
+                    raise IOError(f'HTTP {response.status} {response.reason}: {url}')
+            except BaseException:
+                connection.close()
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                self.release(parts.scheme, parts.netloc, connection)
+
+        raise IOError(f'Too many redirects: {url}')
+
+    @staticmethod
+    def receive(response: http.client.HTTPResponse, out: BinaryIO):
+        length = response.getheader('Content-Length')
+        if length is not None and length.isdigit() and int(length) > DOWNLOAD_SIZE_LIMIT:
+            raise IOError(f'Blueprint download is over the size limit of {DOWNLOAD_SIZE_LIMIT} bytes')
+
+        size = 0
+        while True:
+            chunk = response.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > DOWNLOAD_SIZE_LIMIT:
+                raise IOError(f'Blueprint download is over the size limit of {DOWNLOAD_SIZE_LIMIT} bytes')
+            out.write(chunk)
+
+
+http_fetcher = HttpFetcher()
+
+
+def download_from_url(out: BinaryIO, url: str, validators: Dict[str, str]) -> Optional[Dict[str, str]]:
+    info(f'Downloading blueprint from URL: {url}')
+    started = time()
+    validators = http_fetcher.fetch(url, out, validators)
+    duration = time() - started
+    if validators is None:
+        info(f'Blueprint not modified at URL, checked in {duration:.3f}s: {url}')
     else:
-        download_from_url(response_path, url)
+        info(f'Downloaded blueprint from URL in {duration:.3f}s: {url}')
+    return validators
 
 
-def handle(request_path: str, response_path: str):
+def claim(request_path: str) -> Optional[Tuple[str, str]]:
+    """Takes the request from the folder, returns its URL and transform profile or None if there is nothing to do"""
     taken_path = request_path + '.taken'
     try:
         os.rename(request_path, taken_path)
     except (IOError, OSError):
-        return
+        return None
 
     with open(taken_path, 'rt') as f:
         request = f.readline().strip()
+        profile = f.readline().strip() or DEFAULT_PROFILE
 
     os.remove(taken_path)
 
     if len(request) > URL_LENGTH_LIMIT:
         raise ValueError(f'URL in request {request_path} is longer than {URL_LENGTH_LIMIT} characters: {request}...')
 
-    info(f'Request: {request}')
+    if not RX_PROFILE_NAME.match(profile):
+        raise ValueError(f'Invalid transform profile name in request {request_path}: {profile[:100]}')
+
+    info(f'Request: {request} ({profile})')
 
     if not request:
-        return
+        return None
 
     if request.isdigit():
         request = STEAM_WORKSHOP_URL + request
 
-    dirty_response_path = f'{response_path}.dirty'
-    if request.startswith('http://') or request.startswith('https://'):
-        download(dirty_response_path, request)
-    else:
+    if not (request.startswith('http://') or request.startswith('https://')):
         raise ValueError(f'Request is not a URL or Steam Workshop file ID: {request}')
 
-    clean_response_path = f'{response_path}.clean'
-    clean_blueprint(clean_response_path, dirty_response_path)
+    return request, profile
+
+
+def cache_key(url: str) -> str:
+    """Canonical cache key of a Steam Workshop URL or a direct URL"""
+    if url.startswith(STEAM_WORKSHOP_URL):
+        return 'workshop-' + url[len(STEAM_WORKSHOP_URL):]
+    parts = urllib.parse.urlsplit(url)
+    canonical = urllib.parse.urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path or '/', parts.query, ''))
+    return 'url-' + hashlib.sha256(canonical.encode('utf8')).hexdigest()[:32]
+
+
+def temp_suffix() -> str:
+    # Unique between the threads and processes working on the same cache entry
+    return f'.{os.getpid()}.{threading.get_ident()}'
+
+
+class BlueprintCache:
+    """Cleaned blueprints keyed by Steam Workshop ID or URL and the transform rules applied
+
+    Identical requests arriving while a download is in progress wait for that download.
+    Cache entries are only ever replaced by renaming, so responses can be hard linked to them.
+    """
+
+    def __init__(self, folder: str, rules: Dict[str, List[dict]]):
+        self.folder = folder
+        self.rules = rules
+        # Changing the rules of a profile or the defaults of their options invalidates its cached blueprints
+        defaults = dict(
+            max_projection_depth=MAX_PROJECTION_DEPTH,
+            budget_grids=BUDGET_GRIDS,
+            budget_blocks=BUDGET_BLOCKS,
+            budget_pcu=BUDGET_PCU,
+            budget_trim_grids=BUDGET_TRIM_GRIDS,
+        )
+        self.rules_digests = {
+            profile: hashlib.sha256(json.dumps([transforms, defaults], sort_keys=True).encode('utf8')).hexdigest()[:12]
+            for profile, transforms in rules.items()
+        }
+        self.lock = threading.Lock()
+        self.in_flight: Dict[str, Future] = {}
+
+    def path(self, url: str, profile: str) -> str:
+        digest = self.rules_digests.get(profile)
+        if digest is None:
+            raise ValueError(f'Unknown transform profile: {profile}')
+        return os.path.join(self.folder, f'{cache_key(url)}-{profile}-{digest}.sbc')
+
+    def is_fresh(self, url: str, cache_path: str) -> bool:
+        """Workshop blueprints are kept as long as their workshop version is unchanged, URLs are always revalidated"""
+        if not url.startswith(STEAM_WORKSHOP_URL):
+            return False
+
+        metadata_path = cache_path + '.json'
+        try:
+            age = time() - os.stat(cache_path).st_mtime
+            with open(metadata_path, 'rt', encoding='utf8') as f:
+                version = json.load(f)
+        except (IOError, OSError, ValueError):
+            return False
+
+        if age < WORKSHOP_CHECK_PERIOD:
+            return True
+
+        item_id = url[len(STEAM_WORKSHOP_URL):]
+        time_updated = query_workshop_time_updated(item_id)
+        if time_updated is None or time_updated != version.get('timeupdated'):
+            return False
+
+        # Unchanged, the version is checked again after WORKSHOP_CHECK_PERIOD
+        os.utime(cache_path)
+        os.utime(metadata_path)
+        return True
+
+    def fetch(self, url: str, profile: str) -> str:
+        """Returns the path of the cleaned blueprint in the cache, downloads it if needed"""
+        cache_path = self.path(url, profile)
+        key = os.path.basename(cache_path)
+        with self.lock:
+            future = self.in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self.in_flight[key] = Future()
+
+        if not leader:
+            info(f'Waiting for the download already in progress: {url}')
+            return future.result()
+
+        try:
+            if self.is_fresh(url, cache_path):
+                info(f'Returning cached blueprint: {url}')
+            else:
+                self.refresh(url, profile, cache_path)
+            future.set_result(cache_path)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+
+        return cache_path
+
+    def refresh(self, url: str, profile: str, cache_path: str):
+        """Downloads the blueprint and transforms it on the fly, writing only the clean one"""
+        clean_path = f'{cache_path}.clean{temp_suffix()}'
+        try:
+            with open(clean_path, 'wb') as clean_xml:
+                cleaner = TransformPipeline(clean_xml, self.rules[profile])
+                if url.startswith(STEAM_WORKSHOP_URL):
+                    download_from_steam_workshop(cleaner, url)
+                    metadata = read_workshop_item_version(url[len(STEAM_WORKSHOP_URL):])
+                    if metadata is None:
+                        # Without a known version the blueprint is downloaded again after WORKSHOP_CHECK_PERIOD
+                        metadata = dict(manifest='', timeupdated='')
+                else:
+                    validators = self.read_metadata(cache_path) if os.path.isfile(cache_path) else {}
+                    metadata = download_from_url(cleaner, url, validators)
+                if metadata is not None:
+                    cleaner.close()
+
+            if metadata is None:
+                os.utime(cache_path)
+                return
+
+            report = cleaner.report()
+            info(f'Transformed blueprint ({profile}): ' + ', '.join(f'{r["transform"]} saved {r["bytes_saved"]} bytes' for r in report))
+            # The statistics are installed after the blueprint they describe
+            os.replace(clean_path, cache_path)
+            write_json_atomically(cache_path + '.stats.json', dict(cleaner.budget.as_dict(), transforms=report))
+            write_json_atomically(cache_path + '.json', metadata)
+        finally:
+            if os.path.exists(clean_path):
+                os.remove(clean_path)
+
+    @staticmethod
+    def read_metadata(cache_path: str) -> Dict[str, str]:
+        """Workshop version or HTTP validators of the cached blueprint"""
+        try:
+            with open(cache_path + '.json', 'rt', encoding='utf8') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def prune(self):
+        now = time()
+        for filename in os.listdir(self.folder):
+            if filename.endswith('.json'):
+                # Removed along with their blueprint
+                continue
+            path = os.path.join(self.folder, filename)
+            try:
+                if now - os.stat(path).st_mtime > CACHE_RETENTION:
+                    for sidecar_path in (path + '.json', path + '.stats.json'):
+                        if os.path.exists(sidecar_path):
+                            os.remove(sidecar_path)
+                    os.remove(path)
+            except (IOError, OSError) as e:
+                warn(f'Failed to remove cached blueprint: {path}; [{e.__class__.__name__}] {e}')
+
+
+def write_json_atomically(path: str, data: dict):
+    temp_path = path + temp_suffix()
+    with open(temp_path, 'wt', encoding='utf8') as f:
+        json.dump(data, f)
+    os.replace(temp_path, path)
+
+
+def link_response(cache_path: str, response_path: str):
+    temp_path = response_path + temp_suffix()
+    try:
+        os.link(cache_path, temp_path)
+    except (IOError, OSError):
+        shutil.copyfile(cache_path, temp_path)
+    os.replace(temp_path, response_path)
+
+
+def handle(cache: BlueprintCache, request: str, profile: str, response_path: str):
+    cache_path = cache.fetch(request, profile)
+    if os.path.exists(cache_path + '.stats.json'):
+        link_response(cache_path + '.stats.json', response_path + '.stats.json')
+    elif os.path.exists(response_path + '.stats.json'):
+        # Cached before statistics were collected, the statistics of a previous response must not be left behind
+        os.remove(response_path + '.stats.json')
+    link_response(cache_path, response_path)
 
-    os.remove(dirty_response_path)
 
-    if os.path.exists(response_path):
-        os.remove(response_path)
+class SaxCleaningStream:
+    """Writable stream feeding the bytes written through BlueprintCleaner into the out stream"""
 
-    os.rename(clean_response_path, response_path)
+    def __init__(self, out: BinaryIO, rule: Optional[dict] = None):
+        self.cleaner = BlueprintCleaner(out, rule)
+        self.budget = self.cleaner.budget
+        self.parser = make_parser()
+        self.parser.setContentHandler(self.cleaner)
+
+    def write(self, data: bytes) -> int:
+        self.parser.feed(data)
+        return len(data)
+
+    def close(self):
+        """Completes the parsing, raises an error on incomplete XML"""
+        self.parser.close()
+
+
+def is_count(value) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+
+class CleaningStream:
+    """Writable stream cleaning the blueprint written into the out stream
+
+    Uses the ProjectionPruner, except for UTF-16 and UTF-32 encoded blueprints,
+    which are re-encoded as UTF-8 by the slower BlueprintCleaner.
+
+    """
+
+    def __init__(self, out: BinaryIO, rule: Optional[dict] = None):
+        rule = rule or {}
+        if not is_count(rule.get('max_projection_depth', 0)):
+            raise ValueError(f'The max_projection_depth of the clean transform must be a non-negative integer: {rule!r}')
+        for key in ('budget_grids', 'budget_blocks', 'budget_pcu'):
+            if rule.get(key) is not None and not is_count(rule[key]):
+                raise ValueError(f'The {key} of the clean transform must be a non-negative integer or null: {rule!r}')
+        if not isinstance(rule.get('budget_trim_grids', False), bool):
+            raise ValueError(f'The budget_trim_grids of the clean transform must be true or false: {rule!r}')
+        self.out = out
+        self.rule = rule
+        self.stream = None
+
+    @property
+    def budget(self) -> BlueprintBudget:
+        return self.stream.budget
+
+    def write(self, data: bytes) -> int:
+        if self.stream is None:
+            if not data:
+                return 0
+            wide = data.startswith((b'\xff\xfe', b'\xfe\xff', b'<\0', b'\0<', b'\0\0'))
+            self.stream = SaxCleaningStream(self.out, self.rule) if wide else ProjectionPruner(self.out, self.rule)
+        return self.stream.write(data)
+
+    def close(self):
+        if self.stream is None:
+            self.stream = ProjectionPruner(self.out, self.rule)
+        self.stream.close()
+
+
+class ByteCounter(io.RawIOBase):
+    """Writable stream counting the bytes passed to the out stream"""
+
+    def __init__(self, out: BinaryIO):
+        super().__init__()
+        self.out = out
+        self.count = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: bytes) -> int:
+        self.count += len(data)
+        self.out.write(data)
+        return len(data)
+
+
+# Transform name => (writable stream class taking the out stream and the rule, options allowed in the rule)
+TRANSFORMS = {
+    'clean': (CleaningStream, {'max_projection_depth', 'budget_grids', 'budget_blocks', 'budget_pcu', 'budget_trim_grids'}),
+    'remove_elements': (ElementRemover, {'names'}),
+}
+
+
+class TransformPipeline:
+    """Writable stream passing the blueprint through the transforms of a profile into the out stream
+
+    The first transform is always clean, which parses and checks the XML and enforces the budget.
+
+    """
+
+    def __init__(self, out: BinaryIO, rules: List[dict]):
+        self.counters: List[ByteCounter] = []
+        self.stages = []
+        for rule in reversed(rules):
+            counter = ByteCounter(out)
+            transform, _ = TRANSFORMS[rule['transform']]
+            out = transform(counter, rule)
+            self.counters.insert(0, counter)
+            self.stages.insert(0, out)
+        self.names = [rule['transform'] for rule in rules]
+        self.bytes_in = 0
+
+    @property
+    def budget(self) -> BlueprintBudget:
+        return self.stages[0].budget
+
+    def write(self, data: bytes) -> int:
+        self.bytes_in += len(data)
+        return self.stages[0].write(data)
+
+    def close(self):
+        for stage in self.stages:
+            stage.close()
+
+    def report(self) -> List[dict]:
+        """Bytes received and saved by each transform"""
+        bytes_in = [self.bytes_in] + [counter.count for counter in self.counters]
+        return [
+            dict(transform=name, bytes_in=bytes_in[i], bytes_saved=bytes_in[i] - bytes_in[i + 1])
+            for i, name in enumerate(self.names)
+        ]
+
+
+def load_rules(path: str = RULES_PATH) -> Dict[str, List[dict]]:
+    """Loads the transform profiles from the rules file, DEFAULT_RULES are used for the profiles it does not define"""
+    if not os.path.isfile(path):
+        return DEFAULT_RULES
+
+    with open(path, 'rt', encoding='utf8') as f:
+        rules = json.load(f)
+
+    if not isinstance(rules, dict) or not rules:
+        raise ValueError(f'Rules file must map profile names to lists of transforms: {path}')
+
+    for profile, transforms in rules.items():
+        if not RX_PROFILE_NAME.match(profile):
+            raise ValueError(f'Invalid profile name in rules file: {profile}')
+        if not isinstance(transforms, list) or not transforms or not all(isinstance(rule, dict) for rule in transforms):
+            raise ValueError(f'Profile {profile} must be a non-empty list of transforms')
+        if transforms[0].get('transform') != 'clean':
+            raise ValueError(f'The first transform of profile {profile} must be clean')
+        for rule in transforms:
+            if rule.get('transform') not in TRANSFORMS:
+                raise ValueError(f'Unknown transform in profile {profile}: {rule.get("transform")}')
+            transform, options = TRANSFORMS[rule['transform']]
+            unknown = set(rule) - options - {'transform'}
+            if unknown:
+                raise ValueError(f'Unknown options of transform {rule["transform"]} in profile {profile}: {", ".join(sorted(unknown))}')
+            transform(io.BytesIO(), rule)
+
+    # Requests without a profile keep working if the rules file does not define the default one
+    return dict(DEFAULT_RULES, **rules)
 
 
 def clean_blueprint(clean_response_path, dirty_response_path):
-    with open(dirty_response_path, 'rt', encoding='utf8') as dirty_xml:
-        reader = prepare_input_source(dirty_xml)
-        with open(clean_response_path, 'wt', encoding='utf8') as clean_xml:
-            content_handler = BlueprintCleaner(clean_xml)
-            parse(reader, content_handler)
+    with open(dirty_response_path, 'rb') as dirty_xml:
+        with open(clean_response_path, 'wb') as clean_xml:
+            cleaner = CleaningStream(clean_xml)
+            shutil.copyfileobj(dirty_xml, cleaner, CHUNK_SIZE)
+            cleaner.close()
+
+
+def write_error_response(response_path: str, e: Exception):
+    try:
+        # The previous response may be a hard link into the cache, it must not be overwritten in place
+        for path in (response_path, response_path + '.stats.json'):
+            if os.path.exists(path):
+                os.remove(path)
+        with open(response_path, 'wt') as f:
+            f.write(f'ERROR: [{e.__class__.__name__}] {e}')
+    except (IOError, OSError):
+        pass
+
+
+class Dispatcher:
+    """Runs the claimed requests on separate worker pools for steamcmd and direct URL downloads
+
+    Direct URL downloads are queued per host and submitted to the pool only while
+    fewer than HTTP_HOST_LIMIT of them are running for that host, so a burst of
+    requests to a single host does not occupy the workers needed by other hosts.
+
+    """
+
+    def __init__(self, cache: BlueprintCache):
+        self.cache = cache
+        self.steamcmd_pool = ThreadPoolExecutor(STEAMCMD_WORKERS, thread_name_prefix='steamcmd')
+        self.http_pool = ThreadPoolExecutor(HTTP_WORKERS, thread_name_prefix='http')
+        self.host_queues: Dict[str, Deque[Tuple[str, str, str, str]]] = {}
+        self.host_running: Dict[str, int] = {}
+        self.host_lock = threading.Lock()
+
+    def submit_http(self, host: str, job: Tuple[str, str, str, str]):
+        with self.host_lock:
+            if self.host_running.get(host, 0) >= HTTP_HOST_LIMIT:
+                self.host_queues.setdefault(host, deque()).append(job)
+                return
+            self.host_running[host] = self.host_running.get(host, 0) + 1
+        self.http_pool.submit(self.run_http, host, job)
+
+    def run_http(self, host: str, job: Tuple[str, str, str, str]):
+        while job is not None:
+            self.run(*job)
+            with self.host_lock:
+                queue = self.host_queues.get(host)
+                if queue:
+                    job = queue.popleft()
+                    if not queue:
+                        del self.host_queues[host]
+                else:
+                    job = None
+                    self.host_running[host] -= 1
+                    if not self.host_running[host]:
+                        del self.host_running[host]
+
+    def submit(self, filename: str):
+        request_path = os.path.join(REQUESTS_FOLDER, filename)
+        response_path = os.path.join(RESPONSES_FOLDER, filename)
+
+        # noinspection PyBroadException
+        try:
+            claimed = claim(request_path)
+        except Exception as e:
+            exc(f'Failed to handle request: {filename}')
+            write_error_response(response_path, e)
+            return
+
+        if claimed is None:
+            return
+
+        request, profile = claimed
+        if request.startswith(STEAM_WORKSHOP_URL):
+            self.steamcmd_pool.submit(self.run, filename, request, profile, response_path)
+        else:
+            host = urllib.parse.urlsplit(request).netloc.lower()
+            self.submit_http(host, (filename, request, profile, response_path))
+
+    def run(self, filename: str, request: str, profile: str, response_path: str):
+        # noinspection PyBroadException
+        try:
+            handle(self.cache, request, profile, response_path)
+        except Exception as e:
+            exc(f'Failed to handle request: {filename}')
+            write_error_response(response_path, e)
+
+    def shutdown(self):
+        self.steamcmd_pool.shutdown(wait=True)
+        self.http_pool.shutdown(wait=True)
 
 
 def main():
     info('Started')
     os.makedirs(REQUESTS_FOLDER, exist_ok=True)
     os.makedirs(RESPONSES_FOLDER, exist_ok=True)
+    os.makedirs(BLUEPRINT_CACHE_FOLDER, exist_ok=True)
+    rules = load_rules()
+    info(f'Transform profiles: {", ".join(sorted(rules))}')
+    cache = BlueprintCache(BLUEPRINT_CACHE_FOLDER, rules)
+    cache.prune()
+    prune_at = time() + CACHE_PRUNE_PERIOD
+    watcher = RequestWatcher(REQUESTS_FOLDER)
+    dispatcher = Dispatcher(cache)
     run_until = time() + LIFETIME
-    while time() < run_until:
-        requests = os.listdir(REQUESTS_FOLDER)
-        if not requests:
-            sleep(POLL_PERIOD)
-            continue
-        for filename in requests:
-            request_path = os.path.join(REQUESTS_FOLDER, filename)
-            response_path = os.path.join(RESPONSES_FOLDER, filename)
-            # noinspection PyBroadException
-            try:
-                handle(request_path, response_path)
-            except (KeyboardInterrupt, SystemExit):
-                raise
-            except Exception as e:
-                exc(f'Failed to handle request: {filename}')
-                try:
-                    with open(response_path, 'wt') as f:
-                        f.write(f'ERROR: [{e.__class__.__name__}] {e}')
-                except (IOError, OSError):
-                    pass
-            if time() < run_until:
-                break
+    try:
+        while time() < run_until:
+            if time() >= prune_at:
+                cache.prune()
+                prune_at = time() + CACHE_PRUNE_PERIOD
+            requests = list_requests()
+            if not requests:
+                watcher.wait(min(WATCH_RESCAN_PERIOD, max(0.0, run_until - time())))
+                continue
+            for filename in requests:
+                dispatcher.submit(filename)
+    finally:
+        watcher.close()
+        dispatcher.shutdown()
     info('Finished')
 
 
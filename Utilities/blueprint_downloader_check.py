@@ -0,0 +1,255 @@
+#!/usr/bin/python3
+# -*- coding: ascii -*-
+""" Checks the downloads of blueprint_downloader.py against the stand-in steamcmd and a local HTTP server
+
+- Runs in a temporary home folder removed afterwards, so it does not touch the cache and steamcmd folder of the user
+- Verifies that concurrent workshop requests are downloaded by a single steamcmd run
+- Verifies that an item failing in a batch fails only its own request
+- Verifies that a hung steamcmd is killed along with its children holding the output open
+- Verifies that unchanged URLs are revalidated by their ETag or Last-Modified with a 304 response
+- Verifies that redirects are followed up to the limit and downloads over the size limit are rejected
+- Verifies that consecutive downloads from the same host reuse the kept-alive connection
+
+Exits with a non-zero code if any of the checks fail.
+
+"""
+import importlib
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import time
+from typing import Dict, List, Optional, Tuple
+
+from check_support import check, temporary_home
+
+UTILITIES_DIR = os.path.dirname(os.path.abspath(__file__))
+FAKE_STEAMCMD = os.path.join(UTILITIES_DIR, 'fake_steamcmd.py')
+
+SIZE_LIMIT = 64 * 1024
+LAST_MODIFIED = 'Sat, 01 Jan 2022 00:00:00 GMT'
+BLUEPRINT = b'''<?xml version="1.0"?>
+<Definitions xmlns:xsd="http://www.w3.org/2001/XMLSchema" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
+<ShipBlueprints><ShipBlueprint xsi:type="MyObjectBuilder_ShipBlueprintDefinition">
+<Id Type="MyObjectBuilder_ShipBlueprintDefinition" Subtype="Direct" />
+<CubeGrids><CubeGrid><CubeBlocks><MyObjectBuilder_CubeBlock xsi:type="MyObjectBuilder_CubeBlock"><SubtypeName>LargeBlockArmorBlock</SubtypeName></MyObjectBuilder_CubeBlock></CubeBlocks></CubeGrid></CubeGrids>
+</ShipBlueprint></ShipBlueprints>
+</Definitions>
+'''
+
+
+def setup(home_dir: str):
+    os.environ['STEAMCMD'] = FAKE_STEAMCMD
+    os.environ['FAKE_STEAMCMD_LOG'] = os.path.join(home_dir, 'steamcmd.log')
+    downloader = importlib.import_module('blueprint_downloader')
+    for folder in (downloader.RESPONSES_FOLDER, downloader.BLUEPRINT_CACHE_FOLDER):
+        os.makedirs(folder)
+    return downloader
+
+
+class BlueprintHandler(BaseHTTPRequestHandler):
+    """Serves the blueprint with validators, redirects and oversized files, records each request"""
+
+    protocol_version = 'HTTP/1.1'
+    requests: List[Tuple[str, int, int]] = []  # path, status, client port
+
+    def do_GET(self):
+        if self.path == '/etag/bp.sbc':
+            if self.headers.get('If-None-Match') == '"v1"':
+                self.reply(304)
+            else:
+                self.reply(200, BLUEPRINT, ETag='"v1"')
+        elif self.path == '/last-modified/bp.sbc':
+            if self.headers.get('If-Modified-Since') == LAST_MODIFIED:
+                self.reply(304)
+            else:
+                self.reply(200, BLUEPRINT, **{'Last-Modified': LAST_MODIFIED})
+        elif self.path == '/redirect':
+            self.reply(302, Location='/etag/bp.sbc')
+        elif self.path == '/redirect-loop':
+            self.reply(302, Location='/redirect-loop')
+        elif self.path == '/large/bp.sbc':
+            self.reply(200, BLUEPRINT + b' ' * SIZE_LIMIT)
+        elif self.path == '/large-chunked/bp.sbc':
+            self.record(200)
+            self.send_response(200)
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for _ in range(4):
+                chunk = b' ' * (SIZE_LIMIT // 2)
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+            self.wfile.write(b'0\r\n\r\n')
+        else:
+            self.reply(404)
+
+    def record(self, status: int):
+        self.requests.append((self.path, status, self.client_address[1]))
+
+    def reply(self, status: int, body: bytes = b'', **headers: str):
+        self.record(status)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if status != 304:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class BlueprintServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # The downloader drops the connection of the oversized downloads
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def start_http_server() -> str:
+    server = BlueprintServer(('127.0.0.1', 0), BlueprintHandler)
+    threading.Thread(target=server.serve_forever, name='http-server', daemon=True).start()
+    return f'http://127.0.0.1:{server.server_address[1]}'
+
+
+def steamcmd_runs() -> List[str]:
+    log_path = os.environ['FAKE_STEAMCMD_LOG']
+    if not os.path.exists(log_path):
+        return []
+    with open(log_path, 'rt') as f:
+        return f.read().splitlines()
+
+
+def handle_concurrently(downloader, cache, item_ids: List[str]) -> Dict[str, str]:
+    """Handles the workshop requests in parallel, returns the response path or error of each"""
+    results = {}
+
+    def run(item_id: str):
+        response_path = os.path.join(downloader.RESPONSES_FOLDER, f'request-{item_id}')
+        try:
+            downloader.handle(cache, downloader.STEAM_WORKSHOP_URL + item_id, downloader.DEFAULT_PROFILE, response_path)
+        except IOError as e:
+            results[item_id] = f'error: {e}'
+        else:
+            results[item_id] = response_path
+
+    threads = [threading.Thread(target=run, args=(item_id,)) for item_id in item_ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def check_batch(downloader, cache) -> bool:
+    item_ids = ['2001', '2002', '2003']
+    runs_before = len(steamcmd_runs())
+    results = handle_concurrently(downloader, cache, item_ids)
+    runs = steamcmd_runs()[runs_before:]
+
+    passed = check('single steamcmd run', len(runs) == 1 and all(item_id in runs[0] for item_id in item_ids), f'{len(runs)} run(s)')
+    responses = [os.path.isfile(path) and os.path.isfile(path + '.stats.json') for path in results.values()]
+    passed = check('batched responses', len(responses) == len(item_ids) and all(responses), str(results)) and passed
+
+    version = downloader.read_workshop_item_version(item_ids[0])
+    passed = check('workshop version recorded', bool(version and version['manifest']), str(version)) and passed
+    return passed
+
+
+def check_item_failure(downloader, cache) -> bool:
+    os.environ['FAKE_STEAMCMD_FAIL'] = '3002'
+    try:
+        results = handle_concurrently(downloader, cache, ['3001', '3002'])
+    finally:
+        del os.environ['FAKE_STEAMCMD_FAIL']
+    passed = os.path.isfile(results['3001']) and results['3002'].startswith('error:') and '(Failure)' in results['3002']
+    return check('failed item in a batch', passed, str(results))
+
+
+def check_hung_steamcmd(downloader, cache) -> bool:
+    downloader.STEAMCMD_TIMEOUT = 2
+    os.environ['FAKE_STEAMCMD_HANG'] = '1'
+    started = time()
+    try:
+        results = handle_concurrently(downloader, cache, ['4001'])
+    finally:
+        del os.environ['FAKE_STEAMCMD_HANG']
+    duration = time() - started
+    return check('hung steamcmd', results['4001'].startswith('error:') and duration < 10, f'failed after {duration:.1f}s')
+
+
+def handle_url(downloader, cache, url: str) -> Optional[str]:
+    """Handles a direct URL request, returns the error or None on success"""
+    response_path = os.path.join(downloader.RESPONSES_FOLDER, 'request-url')
+    try:
+        downloader.handle(cache, url, downloader.DEFAULT_PROFILE, response_path)
+    except IOError as e:
+        return str(e)
+    with open(response_path, 'rb') as f:
+        return None if b'Subtype="Direct"' in f.read() else 'unexpected response content'
+
+
+def statuses(path: str) -> List[int]:
+    return [status for request_path, status, _ in BlueprintHandler.requests if request_path == path]
+
+
+def check_revalidation(downloader, cache, base_url: str) -> bool:
+    passed = True
+    for validator in ('etag', 'last-modified'):
+        path = f'/{validator}/bp.sbc'
+        errors = [handle_url(downloader, cache, base_url + path) for _ in range(2)]
+        passed = check(f'{validator} revalidation', errors == [None, None] and statuses(path) == [200, 304], f'{errors} {statuses(path)}') and passed
+    return passed
+
+
+def check_redirects(downloader, cache, base_url: str) -> bool:
+    error = handle_url(downloader, cache, base_url + '/redirect')
+    passed = check('redirect', error is None and statuses('/redirect') == [302], str(error))
+
+    error = handle_url(downloader, cache, base_url + '/redirect-loop')
+    limit = downloader.HTTP_MAX_REDIRECTS + 1
+    passed = check('redirect limit', bool(error) and 'Too many redirects' in error and len(statuses('/redirect-loop')) == limit, str(error)) and passed
+    return passed
+
+
+def check_size_limit(downloader, cache, base_url: str) -> bool:
+    downloader.DOWNLOAD_SIZE_LIMIT = SIZE_LIMIT
+    passed = True
+    for path in ('/large/bp.sbc', '/large-chunked/bp.sbc'):
+        url = base_url + path
+        error = handle_url(downloader, cache, url)
+        rejected = bool(error) and 'size limit' in error and not os.path.exists(cache.path(url, downloader.DEFAULT_PROFILE))
+        passed = check(f'size limit {path}', rejected, str(error)) and passed
+    return passed
+
+
+def check_keep_alive(downloader, cache, base_url: str) -> bool:
+    first = len(BlueprintHandler.requests)
+    for _ in range(3):
+        handle_url(downloader, cache, base_url + '/etag/bp.sbc')
+    ports = {port for _, _, port in BlueprintHandler.requests[first:]}
+    return check('kept-alive connection', len(ports) == 1, f'{len(BlueprintHandler.requests) - first} requests on {len(ports)} connection(s)')
+
+
+def main():
+    with temporary_home('blueprint_downloader_check.') as home_dir:
+        downloader = setup(home_dir)
+        print(f'Home folder: {home_dir}')
+        cache = downloader.BlueprintCache(downloader.BLUEPRINT_CACHE_FOLDER, downloader.DEFAULT_RULES)
+        base_url = start_http_server()
+
+        passed = check_batch(downloader, cache)
+        passed = check_item_failure(downloader, cache) and passed
+        passed = check_hung_steamcmd(downloader, cache) and passed
+        passed = check_revalidation(downloader, cache, base_url) and passed
+        passed = check_redirects(downloader, cache, base_url) and passed
+        passed = check_size_limit(downloader, cache, base_url) and passed
+        passed = check_keep_alive(downloader, cache, base_url) and passed
+
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+# -*- coding: ascii -*-
+""" Helpers shared by the check scripts, which run the tools against stand-ins in a temporary home folder
+"""
+import contextlib
+import os
+import shutil
+import tempfile
+from typing import Iterator
+
+
+@contextlib.contextmanager
+def temporary_home(prefix: str) -> Iterator[str]:
+    """Points HOME to a new temporary folder, removes the folder along with the fake downloads on exit"""
+    home_dir = tempfile.mkdtemp(prefix=prefix)
+    previous = os.environ.get('HOME')
+    os.environ['HOME'] = home_dir
+    try:
+        yield home_dir
+    finally:
+        if previous is None:
+            del os.environ['HOME']
+        else:
+            os.environ['HOME'] = previous
+        shutil.rmtree(home_dir, ignore_errors=True)
+
+
+def check(name: str, passed: bool, details: str = '') -> bool:
+    print(f'{name}: {"OK" if passed else "FAILED"} {details}'.rstrip())
+    return passed
@@ -0,0 +1,136 @@
+#!/usr/bin/python3
+# -*- coding: ascii -*-
+""" Stand-in for steamcmd to test the workshop downloads of server.py and blueprint_downloader.py without Steam
+
+Point the STEAMCMD environment variable to this script. It handles the +force_install_dir,
++login, +workshop_download_item and +quit commands the way steamcmd does:
+
+- Writes each item into steamapps/workshop/content/<app>/<item> under the install folder (~/.steam by default)
+- Copies the files of the item from FAKE_STEAMCMD_ITEMS/<item> if that folder exists, writes a small bp.sbc otherwise
+- Records the item in the steamapps/workshop/appworkshop_<app>.acf metadata with a new manifest ID
+- Prints the success and failure lines steamcmd prints for each item
+
+Environment variables controlling it:
+- FAKE_STEAMCMD_ITEMS: folder with the content of the items by workshop ID
+- FAKE_STEAMCMD_FAIL: comma separated workshop IDs to fail
+- FAKE_STEAMCMD_TIME_UPDATED: time updated recorded in the metadata, the current time by default
+- FAKE_STEAMCMD_DELAY: seconds to sleep before each item
+- FAKE_STEAMCMD_HANG: hangs after login in a child process holding the output open, like steamcmd.sh with a hung steamcmd
+- FAKE_STEAMCMD_LOG: file to append the arguments of each run to
+
+"""
+import os
+import shutil
+import subprocess
+import sys
+from time import time, sleep
+
+BLUEPRINT = '''<?xml version="1.0"?>
+<Definitions xmlns:xsd="http://www.w3.org/2001/XMLSchema" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
+<ShipBlueprints><ShipBlueprint xsi:type="MyObjectBuilder_ShipBlueprintDefinition">
+<Id Type="MyObjectBuilder_ShipBlueprintDefinition" Subtype="Workshop %s" />
+<CubeGrids><CubeGrid><CubeBlocks><MyObjectBuilder_CubeBlock xsi:type="MyObjectBuilder_CubeBlock"><SubtypeName>LargeBlockArmorBlock</SubtypeName></MyObjectBuilder_CubeBlock></CubeBlocks></CubeGrid></CubeGrids>
+</ShipBlueprint></ShipBlueprints>
+</Definitions>
+'''
+
+
+def write_acf(acf_path: str, app_id: str, items: dict):
+    lines = ['"AppWorkshop"', '{', f'\t"appid"\t\t"{app_id}"', '\t"WorkshopItemsInstalled"', '\t{']
+    for item_id, (size, time_updated, manifest) in sorted(items.items()):
+        lines.extend([
+            f'\t\t"{item_id}"', '\t\t{',
+            f'\t\t\t"size"\t\t"{size}"',
+            f'\t\t\t"timeupdated"\t\t"{time_updated}"',
+            f'\t\t\t"manifest"\t\t"{manifest}"',
+            '\t\t}',
+        ])
+    lines.extend(['\t}', '}', ''])
+    with open(acf_path + '.tmp', 'wt') as f:
+        f.write('\n'.join(lines))
+    os.replace(acf_path + '.tmp', acf_path)
+
+
+def read_acf_items(acf_path: str) -> dict:
+    """Items of a metadata file written by write_acf"""
+    items = {}
+    if not os.path.exists(acf_path):
+        return items
+    with open(acf_path, 'rt') as f:
+        values = [line.strip().split('"')[1::2] for line in f]
+    item_id = None
+    fields = {}
+    for value in values:
+        if len(value) == 1 and value[0].isdigit():
+            item_id = value[0]
+        elif len(value) == 2 and item_id is not None:
+            fields[value[0]] = value[1]
+            if value[0] == 'manifest':
+                items[item_id] = (fields['size'], fields['timeupdated'], fields['manifest'])
+                item_id = None
+    return items
+
+
+def download_item(install_dir: str, app_id: str, item_id: str) -> str:
+    item_dir = os.path.join(install_dir, 'steamapps', 'workshop', 'content', app_id, item_id)
+    if os.path.isdir(item_dir):
+        shutil.rmtree(item_dir)
+
+    source_dir = os.path.join(os.getenv('FAKE_STEAMCMD_ITEMS', ''), item_id)
+    if os.getenv('FAKE_STEAMCMD_ITEMS') and os.path.isdir(source_dir):
+        shutil.copytree(source_dir, item_dir)
+    else:
+        os.makedirs(item_dir)
+        with open(os.path.join(item_dir, 'bp.sbc'), 'wt') as f:
+            f.write(BLUEPRINT % item_id)
+
+    size = sum(os.path.getsize(os.path.join(dirpath, fn)) for dirpath, _, filenames in os.walk(item_dir) for fn in filenames)
+    acf_path = os.path.join(install_dir, 'steamapps', 'workshop', f'appworkshop_{app_id}.acf')
+    items = read_acf_items(acf_path)
+    time_updated = os.getenv('FAKE_STEAMCMD_TIME_UPDATED') or str(int(time()))
+    items[item_id] = (str(size), time_updated, str(int(time() * 1000000)))
+    write_acf(acf_path, app_id, items)
+    return item_dir
+
+
+def main():
+    log_path = os.getenv('FAKE_STEAMCMD_LOG')
+    if log_path:
+        with open(log_path, 'at') as f:
+            f.write(' '.join(sys.argv[1:]) + '\n')
+
+    failing = set(filter(None, os.getenv('FAKE_STEAMCMD_FAIL', '').split(',')))
+    delay = float(os.getenv('FAKE_STEAMCMD_DELAY', '0'))
+    install_dir = os.path.expanduser('~/.steam')
+
+    print('Steam Console Client (c) Valve Corporation - version 1700000000 (fake)')
+    args = sys.argv[1:]
+    while args:
+        command = args.pop(0)
+        if command == '+force_install_dir':
+            install_dir = args.pop(0)
+        elif command == '+login':
+            print(f'Logging in user \'{args.pop(0)}\' to Steam Public...OK')
+            sys.stdout.flush()
+            if os.getenv('FAKE_STEAMCMD_HANG'):
+                # The child keeps the output pipe open after this process is killed
+                subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(3600)'])
+                sleep(3600)
+        elif command == '+workshop_download_item':
+            app_id = args.pop(0)
+            item_id = args.pop(0)
+            sleep(delay)
+            if item_id in failing:
+                print(f'ERROR! Download item {item_id} failed (Failure).')
+            else:
+                item_dir = download_item(install_dir, app_id, item_id)
+                print(f'Success. Downloaded item {item_id} to "{item_dir}" (1234 bytes)')
+        elif command == '+quit':
+            break
+        else:
+            print(f'Unknown command: {command}')
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()